@@ -1,19 +1,11 @@
 #!/usr/bin/env python2.7
+'''Print the qrels of a truth data XML file.
 
-from bs4 import BeautifulSoup
-import sys
+This is `trec_dd_harness export-qrels --from-xml` without a config.
+'''
 
-with open(sys.argv[1]) as xmlfile:
-    dd = BeautifulSoup(xmlfile, 'xml')
-    for psg in dd.find_all('passage'):
-        subtopic = psg.parent
-        topic = subtopic.parent
-        domain = topic.parent
+import sys
 
-        topic_id = topic['id']
-        subtopic_id = subtopic['id']
-        doc_id = psg.docno.text
-        psg_id = psg['id']
-        rating = psg.rating.text
+from trec_dd.harness.qrels import qrels_from_truth_data, write_qrels
 
-        print "\t".join([topic_id, subtopic_id, doc_id, psg_id, rating])
+write_qrels(qrels_from_truth_data(sys.argv[1]), sys.stdout)
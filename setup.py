@@ -104,12 +104,16 @@ setup(
         'mysql': [
             'kvlayer_mysql',
         ],
+        'numpy': [
+            'numpy',
+        ],
     },        
     entry_points={
         'console_scripts': [
             'trec_dd_harness = trec_dd.harness.run:main',
             'trec_dd_scorer = trec_dd.scorer.run:main',
             'trec_dd_random_system = trec_dd.system.random_system:main',
+            'trec_dd_convert_run = trec_dd.utils.runfile:main',
         ]
     },
     scripts=['bin/cubeTest.pl'],
@@ -0,0 +1,150 @@
+'''Export the truth data as qrels for ``bin/cubeTest_v3.pl``.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+
+Each qrels line is ``topic_id subtopic_id doc_id passage_id rating``,
+tab-separated.  The lines come either straight out of the truth data
+XML or from the labels loaded into a :class:`dossier.label.LabelStore`.
+Both sources drop the passages that
+:func:`~trec_dd.harness.truth_data.label_from_truth_data_file_line`
+drops, give bogus grades a rating of zero, and write negative
+judgments as -1.
+'''
+
+from __future__ import absolute_import
+import logging
+import os
+
+from dossier.label import CorefValue
+from lxml import etree
+
+from trec_dd.harness.truth_data import _utf8
+
+logger = logging.getLogger(__name__)
+
+QRELS_LINE = '%s\t%s\t%s\t%s\t%d\n'
+
+
+def qrel_from_label(label):
+    '''Return the `(topic_id, subtopic_id, doc_id, passage_id, rating)`
+    qrel of `label`.
+    '''
+    topic_id = label.meta['topic_id']
+    doc_id = label.other(topic_id)
+    if label.value == CorefValue.Negative:
+        rating = -1
+    else:
+        rating = label.rating
+    return (topic_id, label.subtopic_for(topic_id), doc_id,
+            label.subtopic_for(doc_id), rating)
+
+
+def _passage_fields(passage):
+    '''Return a dict of the text of each child of `passage` by tag.'''
+    fields = {}
+    for child in passage:
+        tag = child.tag.rpartition('}')[2]
+        if tag in fields:
+            continue
+        if len(child):
+            fields[tag] = _utf8(''.join(child.itertext()))
+        else:
+            fields[tag] = _utf8(child.text)
+    return fields
+
+
+def qrels_from_truth_data(truth_data_path):
+    '''Yield the qrel of every valid passage in the truth data XML
+    file at `truth_data_path`, in file order.
+
+    Unlike :func:`~trec_dd.harness.truth_data.iter_passages`, this
+    only stops at the end of each element, and reads the topic and
+    subtopic ids off a passage's parents, which are still in the tree.
+    Each passage, subtopic, topic and domain is thrown away once it
+    ends, so memory use does not grow with the size of the file.
+    '''
+    events = etree.iterparse(truth_data_path, events=('end',),
+                             tag=('{*}passage', '{*}subtopic', '{*}topic',
+                                  '{*}domain'),
+                             remove_comments=True)
+    for _, elem in events:
+        if etree.QName(elem).localname != 'passage':
+            # a finished subtopic, topic or domain
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+            continue
+        subtopic = elem.getparent()
+        topic = subtopic.getparent()
+        fields = _passage_fields(elem)
+        doc_id = fields.get('docno', '')
+        if not doc_id.strip():
+            logger.warn('dropping passage %r with bad docno: %r',
+                        elem.get('id'), doc_id)
+        elif not fields.get('text', '').strip():
+            logger.warn('dropping empty passage %r', elem.get('id'))
+        else:
+            grade = fields.get('rating', '')
+            try:
+                rating = max(int(grade), -1)
+            except ValueError:
+                logger.warn('replacing bogus grade with zero = %r', grade)
+                rating = 0
+            yield (_utf8(topic.get('id')), _utf8(subtopic.get('id')),
+                   doc_id, _utf8(elem.get('id')), rating)
+
+        elem.clear()
+        while elem.getprevious() is not None:
+            del subtopic[0]
+
+
+def qrels_from_label_store(label_store):
+    '''Yield the qrel of every label in `label_store`.
+    '''
+    for label in label_store.everything():
+        yield qrel_from_label(label)
+
+
+def write_qrels(qrels, fh, batch_size=10000):
+    '''Write `qrels` to the open file `fh`, `batch_size` lines at a
+    time, and return the number of lines written.
+    '''
+    num_qrels = 0
+    lines = []
+    for qrel in qrels:
+        lines.append(QRELS_LINE % qrel)
+        if len(lines) >= batch_size:
+            fh.write(''.join(lines))
+            num_qrels += len(lines)
+            del lines[:]
+    fh.write(''.join(lines))
+    return num_qrels + len(lines)
+
+
+def write_sharded_qrels(qrels, shard_dir, buffer_size=1 << 16):
+    '''Write `qrels` to one ``<topic_id>.qrels`` file per topic in
+    `shard_dir`, and return a dict mapping each topic_id to its
+    number of lines.
+
+    A topic's file stays open until every qrel has been written, so
+    the topics need not be contiguous in `qrels`.
+    '''
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    shards = {}
+    counts = {}
+    try:
+        for qrel in qrels:
+            topic_id = qrel[0]
+            fh = shards.get(topic_id)
+            if fh is None:
+                path = os.path.join(shard_dir, topic_id + '.qrels')
+                fh = shards[topic_id] = open(path, 'wb', buffer_size)
+                counts[topic_id] = 0
+            fh.write(QRELS_LINE % qrel)
+            counts[topic_id] += 1
+    finally:
+        for fh in shards.itervalues():
+            fh.close()
+    return counts
@@ -7,18 +7,30 @@
 from __future__ import absolute_import, print_function
 
 import argparse
+import cbor
 from collections import defaultdict
 from dossier.label import LabelStore, Label, CorefValue
+import functools
 import json
 import itertools
 import kvlayer
 import logging
 import os
 import sys
+import threading
 import time
 import yakonfig
 
+from trec_dd.harness.qrels import qrels_from_label_store, \
+    qrels_from_truth_data, write_qrels, write_sharded_qrels
+from trec_dd.harness.state import open_state
 from trec_dd.harness.truth_data import parse_truth_data
+from trec_dd.scorer.engine import IncrementalScorer
+from trec_dd.utils import topic_labels_by_doc
+from trec_dd.utils.runfile import BinaryRunWriter, RunFileWriter, \
+    iter_text_run, steps_from_results, truncate_text_run
+from trec_dd.utils.snapshot import TruthSnapshot, compile_snapshot
+from trec_dd.utils.timing import Timings
 
 logger = logging.getLogger(__name__)
 
@@ -35,36 +47,258 @@ TOPIC_IDS = 'trec_dd_harness_topic_ids'
 EXPECTING_STOP = 'trec_dd_harness_expecting_stop'
 SEEN_DOCS = 'trec_dd_harness_seen_docs'
 INTERACTION_SEQ = 'trec_dd_harness_interaction_seq'
+FEEDBACK = 'trec_dd_harness_feedback'
+TOPICS = 'trec_dd_harness_topics'
+ACTIVE_TOPICS = 'trec_dd_harness_active_topics'
+CHECKPOINTS = 'trec_dd_harness_checkpoints'
+RUN_CHECKPOINT = 'trec_dd_harness_run_checkpoint'
+
+#: the index of the truth data, which every run reads
+TRUTH_TABLES = {
+    FEEDBACK: (str, str,),
+    TOPICS: (str,),
+}
+
+EMPTY_LABEL_STORE = ('The label store is empty.  Have you run '
+                     '`trec_dd_harness load`?')
+
+
+def subtopic_feedback_from_labels(topic_id, labels):
+    '''Build the subtopic feedback for a document from the `labels`
+    between it and `topic_id`.
+    '''
+    # If any of the labels between the topic_id and
+    # the document are negative, we call this document
+    # off-topic. If there are no labels between this
+    # topic_id and the document, we call this document
+    # off-topic. Otherwise, we extract the subtopics
+    # from the labels and call the document on-topic.
+    if any([label.value == CorefValue.Negative for label in labels]):
+        return []
+
+    def subtopic_from_label(label):
+        subtopic = {
+            'subtopic_id': label.subtopic_for(topic_id),
+            'subtopic_name': label.meta['subtopic_name'],
+            'passage_text': label.meta['passage_text'],
+            'rating': label.rating,
+        }
+        return subtopic
+
+    return [subtopic_from_label(label) for label in labels]
+
+
+class HarnessError(Exception):
+    '''Raised when a system drives the harness incorrectly.
+
+    The command line tool reports these and exits; long-lived callers
+    can catch them and keep going.
+    '''
+    pass
+
+
+def load_truth_data(kvl, label_store, truth_data_path, workers=1):
+    '''Load the truth data XML file at `truth_data_path` into
+    `label_store`, and index it in `kvl` for the harness.  Returns
+    the number of labels loaded.
+
+    Everything that loads truth data for a harness to read goes
+    through this, so that no harness finds labels without an index.
+    '''
+    num_labels = parse_truth_data(label_store, truth_data_path,
+                                  workers=workers)
+    index_truth_data(kvl, label_store)
+    return num_labels
+
+
+def index_truth_data(kvl, label_store, batch_size=10000):
+    '''Write the topic catalog and the feedback index of the labels in
+    `label_store` to `kvl`.
+
+    One pass over the label store finds the topics, and then each
+    topic's labels are read a document at a time, so memory holds
+    only the catalog and one batch of writes, however many labels
+    there are.  Returns the catalog, as from
+    :meth:`Harness.topic_catalog`.
+    '''
+    kvl.setup_namespace(TRUTH_TABLES)
+    all_topics = dict()
+    for label in label_store.everything():
+        all_topics[(label.meta['topic_id'],)] = label.meta['topic_name']
+    build_feedback_index(
+        kvl, itertools.chain.from_iterable(
+            topic_labels_by_doc(label_store, topic_id)
+            for (topic_id,) in sorted(all_topics)),
+        batch_size=batch_size)
+    kvl.clear_table(TOPICS)
+    items = sorted(all_topics.iteritems())
+    for start in xrange(0, len(items), batch_size):
+        kvl.put(TOPICS, *items[start:start + batch_size])
+    return all_topics
+
+
+def build_feedback_index(kvl, labels_by_pair, batch_size=10000):
+    '''Precompute the feedback for every (topic_id, stream_id) pair.
+
+    `labels_by_pair` is an iterable of ((topic_id, stream_id), labels)
+    with the labels between them, as from
+    :func:`trec_dd.utils.topic_labels_by_doc`, and is consumed as it
+    goes, writing `batch_size` pairs at a time.  The feedback is
+    written to the FEEDBACK table, so that every harness process can
+    look it up without scanning the label store.  Nothing is kept in
+    memory: a harness never asks for the same pair twice in one run,
+    since `step` refuses repeated documents.
+    '''
+    kvl.clear_table(FEEDBACK)
+    puts = []
+    for (topic_id, stream_id), labels in labels_by_pair:
+        subtopic_feedback = subtopic_feedback_from_labels(topic_id, labels)
+        puts.append(((topic_id, stream_id), cbor.dumps(subtopic_feedback)))
+        if len(puts) >= batch_size:
+            kvl.put(FEEDBACK, *puts)
+            puts = []
+    if puts:
+        kvl.put(FEEDBACK, *puts)
+
+
+def synchronized(method):
+    '''Run a :class:`Harness` method holding the harness's lock, so
+    that one harness can serve a system's threads, and as one
+    transaction of its state store.  Each call's latency goes into the
+    harness's timings under the method's name.
+    '''
+    # `_stop` is timed as `stop`
+    name = method.__name__.lstrip('_')
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            with self.timings.timer(name):
+                with self.state.transaction():
+                    return method(self, *args, **kwargs)
+    return locked
+
 
 class Harness(object):
 
-    tables = {
+    #: the index of the truth data, which every run reads
+    tables = TRUTH_TABLES
+
+    #: the state of one run, kept in its own copy of these tables when
+    #: the config gives a run_id
+    state_tables = {
         TOPIC_IDS: (str,),
         EXPECTING_STOP: (str,),
         SEEN_DOCS: (str, str,),
         INTERACTION_SEQ: (str,),
+        ACTIVE_TOPICS: (str,),
+        CHECKPOINTS: (str,),
+        RUN_CHECKPOINT: (str,),
     }
 
-    def __init__(self, config, kvl, label_store):
+    def __init__(self, config, kvl, label_store, snapshot=None, state=None):
         self.kvl = kvl
         self.kvl.setup_namespace(self.tables)
+        self.run_id = config.get('run_id')
+        # the interaction state, in kvlayer unless the config picks
+        # another store from trec_dd.harness.state
+        if state is None:
+            state = open_state(config, kvl, self.state_tables)
+        self.state = state
         self.label_store = label_store
         self.truth_data_path = config.get('truth_data_path')
-        self.run_file_path = config.get('run_file_path')
+        self.truth_snapshot_path = config.get('truth_snapshot_path')
+        # a compiled truth snapshot, if there is one, replaces the
+        # label store for everything the harness reads
+        if snapshot is None and self.truth_snapshot_path:
+            snapshot = TruthSnapshot(self.truth_snapshot_path)
+        self.snapshot = snapshot
+        self.run_file_path = self.run_path(config.get('run_file_path'))
+        self.run_file = None
+        if self.run_file_path is not None:
+            self.run_file = RunFileWriter(
+                self.run_file_path,
+                flush_every=config.get('run_file_flush', 'step'),
+                fsync=bool(config.get('run_file_fsync', False)))
+        # optionally, the same run in columnar binary form
+        self.binary_run_path = self.run_path(config.get('binary_run_path'))
+        self.binary_run = None
+        if self.binary_run_path:
+            self.binary_run = BinaryRunWriter(
+                self.binary_run_path,
+                flush_every=config.get('run_file_flush', 'step'),
+                fsync=bool(config.get('run_file_fsync', False)))
         self.topic_ids = set(config.get('topic_ids', []))
         self.batch_size = int(config.get('batch_size', 5))
+        # with more than one, `start` hands out topics until this many
+        # are active, and `step` and `stop` take any of them
+        self.max_active_topics = int(config.get('max_active_topics', 1))
+        if self.max_active_topics < 1:
+            raise ValueError('max_active_topics must be at least 1, not %d'
+                             % self.max_active_topics)
+        # topic_id -> RunFileWriter holding the steps of an active topic
+        # until it is stopped, when more than one may be active
+        self.spools = dict()
+        # record where each step ends in the run files, so that
+        # `resume` can pick the run back up after a crash
+        self.checkpoint = bool(config.get('checkpoint', False))
+        self.lock = threading.RLock()
+        # latency histograms of every command and of the phases of
+        # `step`, logged by `report_timings` at exit
+        self.timings = Timings()
+        self.timings_path = config.get('timings_path')
+        # optionally, the fused scores of the run so far, kept up to
+        # date at every step
+        self.scorer = None
+        if config.get('live_scores', False):
+            if snapshot is not None:
+                self.scorer = IncrementalScorer(snapshot)
+            else:
+                self.scorer = IncrementalScorer(label_store)
+        # set once we know there is truth data, so that `start` and
+        # `step` only check once per process, along with whether it
+        # has the index `load` writes
+        self.label_store_verified = False
+        self.truth_indexed = None
 
     config_name = 'harness'
 
+    def run_path(self, path):
+        '''Fill the run_id into ``{run_id}`` in `path`, so that many
+        runs can share one config.
+        '''
+        if path and self.run_id is not None:
+            path = path.replace('{run_id}', self.run_id)
+        return path
+
+    @property
+    def concurrent(self):
+        return self.max_active_topics > 1
+
     def verify_label_store(self):
-        ls = iter(self.label_store.everything())
-        try:
-            ls.next()
-        except StopIteration:
-            sys.exit('The label store is empty.  Have you run `trec_dd_harness load`?')
-        else:
+        if self.label_store_verified:
+            return True
+        if self.snapshot is not None:
+            if len(self.snapshot) == 0:
+                raise HarnessError('The truth snapshot %r is empty.'
+                                   % self.snapshot.snapshot_path)
+            self.label_store_verified = True
+            return True
+        for _ in self.kvl.scan_keys(TOPICS):
+            self.truth_indexed = True
+            self.label_store_verified = True
             return True
+        # no index, maybe because the truth data was loaded by an older
+        # harness, so look at the labels themselves
+        for _ in self.label_store.everything():
+            logger.warn('The truth data has not been indexed, so the '
+                        'harness reads the labels directly.  Run '
+                        '`trec_dd_harness load` to index it.')
+            self.truth_indexed = False
+            self.label_store_verified = True
+            return True
+        raise HarnessError(EMPTY_LABEL_STORE)
 
+    @synchronized
     def init(self, topic_ids=None):
         '''Initialize the DB.
 
@@ -72,88 +306,478 @@ class Harness(object):
         database. It also clears out the state of the previous run
         from the system.
         '''
-        self.kvl.clear_table(SEEN_DOCS)
-        self.kvl.clear_table(TOPIC_IDS)
-        self.kvl.clear_table(INTERACTION_SEQ)
-        all_topics = dict()
-        for label in self.label_store.everything():
-            all_topics[(label.meta['topic_id'],)] = label.meta['topic_name']
+        self.state.clear_table(SEEN_DOCS)
+        self.state.clear_table(TOPIC_IDS)
+        self.state.clear_table(INTERACTION_SEQ)
+        self.state.clear_table(EXPECTING_STOP)
+        self.state.clear_table(ACTIVE_TOPICS)
+        self.state.clear_table(CHECKPOINTS)
+        self.state.clear_table(RUN_CHECKPOINT)
+        all_topics = self.topic_catalog()
+        self.remove_spools([topic_id for (topic_id,) in all_topics])
+        self.checkpoint_run()
+        if self.scorer is not None:
+            self.scorer.reset()
         # allow in-process caller to init with topic ids of its choosing
         if topic_ids is not None:
             self.topic_ids = set(topic_ids)
         if self.topic_ids:
-            for topic_id in all_topics.keys():
-                if topic_id not in self.topic_ids:
-                    all_topics.pop(topic_id)
-        self.kvl.put(TOPIC_IDS, *all_topics.items())
+            for key in all_topics.keys():
+                if key[0] not in self.topic_ids:
+                    all_topics.pop(key)
+        self.state.put(TOPIC_IDS, *all_topics.items())
         return {'num_topics': len(all_topics)}
 
-    def check_expecting_stop(self):
-        for (topic_id,), _ in self.kvl.scan(EXPECTING_STOP):
-            sys.exit('Harness was expecting you to call stop because you '
-                     'submitted fewer than batch_size results.  Fix your '
-                     'system and try again.')
+    def index_truth_data(self, batch_size=10000):
+        '''Write the topic catalog and the feedback index, as
+        :func:`index_truth_data` does.  Only `load` calls this: the
+        index is shared by every run, so a run never writes it.
+        '''
+        return index_truth_data(self.kvl, self.label_store,
+                                batch_size=batch_size)
 
-    def unset_expecting_stop(self):
-        self.kvl.clear_table(EXPECTING_STOP)
+    def topic_catalog(self):
+        '''Return a dict mapping (topic_id,) to topic name for every
+        topic in the truth data.
+        '''
+        if self.snapshot is not None:
+            return dict(((topic_id,), topic_name) for topic_id, topic_name
+                        in self.snapshot.topics().iteritems())
+        self.verify_label_store()
+        if self.truth_indexed:
+            return dict(self.kvl.scan(TOPICS))
+        # truth data loaded by an older harness, with no index; read
+        # the labels, but leave the shared tables to `load`
+        return dict(((label.meta['topic_id'],), label.meta['topic_name'])
+                    for label in self.label_store.everything())
+
+    def lookup_feedback(self, topic_id, stream_ids):
+        '''Get the subtopic feedback for each of `stream_ids`.
+
+        The whole batch is fetched from the FEEDBACK table in a single
+        `get`, or, for truth data loaded without an index, from the
+        labels of each document.  Documents with no labels for
+        `topic_id` get an empty list.
+        '''
+        if self.snapshot is not None:
+            return [self.snapshot.feedback(topic_id, stream_id)
+                    for stream_id in stream_ids]
+        if not stream_ids:
+            return []
+        self.verify_label_store()
+        if not self.truth_indexed:
+            return [subtopic_feedback_from_labels(
+                topic_id, [label for label
+                           in self.label_store.directly_connected(stream_id)
+                           if label.other(stream_id) == topic_id])
+                    for stream_id in stream_ids]
+        feedback = dict(
+            (key, [] if val is None else cbor.loads(val))
+            for key, val in self.kvl.get(
+                FEEDBACK, *[(topic_id, stream_id)
+                            for stream_id in stream_ids]))
+        return [feedback[(topic_id, stream_id)] for stream_id in stream_ids]
+
+    def check_expecting_stop(self, topic_id=None):
+        '''Raise if any topic, or just `topic_id` if it is given, is
+        waiting for its `stop`.
+        '''
+        if topic_id is None:
+            expecting = self.state.scan(EXPECTING_STOP)
+        else:
+            expecting = [(key, val) for key, val
+                         in self.state.get(EXPECTING_STOP, (topic_id,))
+                         if val is not None]
+        for (topic_id,), _ in expecting:
+            raise HarnessError('Harness was expecting you to call stop '
+                               'because you submitted fewer than batch_size '
+                               'results.  Fix your system and try again.')
+
+    def unset_expecting_stop(self, topic_id=None):
+        if topic_id is None:
+            self.state.clear_table(EXPECTING_STOP)
+        else:
+            self.state.delete(EXPECTING_STOP, (topic_id,))
 
     def set_expecting_stop(self, topic_id):
-        self.kvl.put(EXPECTING_STOP, ((topic_id,), 'YES'))
+        self.state.put(EXPECTING_STOP, ((topic_id,), 'YES'))
 
     def start_interaction_seq(self, topic_id):
-        self.kvl.put(INTERACTION_SEQ, ((topic_id,), '0'))
+        self.state.put(INTERACTION_SEQ, ((topic_id,), '0'))
 
     def incr_interaction_seq(self, topic_id):
-        last_iter_q = list(self.kvl.get(INTERACTION_SEQ, (topic_id,)))
+        last_iter_q = list(self.state.get(INTERACTION_SEQ, (topic_id,)))
         if len(last_iter_q) == 0:
-            sys.exit('Harness did not find an iteration sequence number '
-                     'for topic_id %s. Did you call '
-                     '`trec_dd_harness start`?' % topic_id)
+            raise HarnessError('Harness did not find an iteration sequence '
+                               'number for topic_id %s. Did you call '
+                               '`trec_dd_harness start`?' % topic_id)
         _topic_id, last_iter = last_iter_q[0]
         next_iter = str(int(last_iter) + 1)
-        self.kvl.put(INTERACTION_SEQ, ((topic_id,), next_iter))
+        self.state.put(INTERACTION_SEQ, ((topic_id,), next_iter))
         return int(last_iter)
-                        
+
+    def active_topics(self):
+        '''Return the topic_ids that were started and not yet stopped,
+        when more than one topic may be active.
+        '''
+        return [topic_id for (topic_id,), _ in self.state.scan(ACTIVE_TOPICS)]
+
+    def check_active(self, topic_id):
+        for _, val in self.state.get(ACTIVE_TOPICS, (topic_id,)):
+            if val is not None:
+                return
+        raise HarnessError('%r is not an active topic.  Did you call '
+                           '`trec_dd_harness start`?' % topic_id)
+
+    @synchronized
     def start(self):
         '''initiates a round of feedback to recommender under evaluation.
         '''
+        if self.concurrent:
+            return self.start_concurrent()
         self.check_expecting_stop()
         self.verify_label_store()
-        for (topic_id,), query_string in self.kvl.scan(TOPIC_IDS):
+        for (topic_id,), query_string in self.state.scan(TOPIC_IDS):
             self.start_interaction_seq(topic_id)
+            self.checkpoint_topic(topic_id, 0, False)
             return {'topic_id': topic_id, 'query': query_string}
 
         # finished all the topics, so end.
         return {'topic_id': None, 'query': None}
 
+    def start_concurrent(self):
+        '''`start` the first topic that is not active yet, if fewer
+        than `max_active_topics` are.  The topic_id is None once every
+        remaining topic is active.
+        '''
+        self.verify_label_store()
+        active = set(self.active_topics())
+        if len(active) >= self.max_active_topics:
+            raise HarnessError('%d topics are already active, as many as '
+                               'max_active_topics allows; stop one before '
+                               'starting another.' % len(active))
+        for (topic_id,), query_string in self.state.scan(TOPIC_IDS):
+            if topic_id in active:
+                continue
+            self.state.put(ACTIVE_TOPICS, ((topic_id,), query_string))
+            self.start_interaction_seq(topic_id)
+            self.checkpoint_topic(topic_id, 0, False)
+            return {'topic_id': topic_id, 'query': query_string}
+        return {'topic_id': None, 'query': None}
+
     def stop(self, topic_id):
         '''ends a round of feedback
         '''
+        response = self._stop(topic_id)
+        # logged once the `stop` itself is timed
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('timings: %s', self.timings.to_json())
+        return response
+
+    @synchronized
+    def _stop(self, topic_id):
+        if self.concurrent:
+            return self.stop_concurrent(topic_id)
         self.unset_expecting_stop()
-        for idx, ((_topic_id,), query_string) in enumerate(self.kvl.scan(TOPIC_IDS)):
+        for idx, ((_topic_id,), query_string) in enumerate(self.state.scan(TOPIC_IDS)):
             if idx == 0:
                 if topic_id != _topic_id:
-                    sys.exit('%d != %d, which is where the database says we are'
-                             % (topic_id, _topic_id))
-                self.kvl.delete(TOPIC_IDS, (topic_id,))
+                    raise HarnessError('%r != %r, which is where the database '
+                                       'says we are' % (topic_id, _topic_id))
+                if self.run_file is not None:
+                    self.run_file.stop()
+                if self.binary_run is not None:
+                    self.binary_run.stop()
+                self.checkpoint_run(stopped=topic_id)
+                self.state.delete(TOPIC_IDS, (topic_id,))
+                self.state.delete(CHECKPOINTS, (topic_id,))
+                if self.scorer is not None:
+                    self.scorer.stop(topic_id)
                 logger.info("Finished with topic: '%s'", topic_id)
         return {'finished': topic_id, 'num_remaining': idx }
 
+    def stop_concurrent(self, topic_id):
+        '''`stop` any active topic, moving its spooled steps to the run
+        file in one piece.
+        '''
+        self.check_active(topic_id)
+        self.unset_expecting_stop(topic_id)
+        self.flush_spool(topic_id)
+        # until the checkpoint says the topic is in the run file, its
+        # spool must stay, so that `resume` can go back to it
+        self.checkpoint_run(stopped=topic_id)
+        self.remove_spools([topic_id])
+        if self.scorer is not None:
+            self.scorer.stop(topic_id)
+        self.state.delete(ACTIVE_TOPICS, (topic_id,))
+        self.state.delete(TOPIC_IDS, (topic_id,))
+        self.state.delete(CHECKPOINTS, (topic_id,))
+        logger.info("Finished with topic: '%s'", topic_id)
+        num_remaining = sum(1 for _ in self.state.scan_keys(TOPIC_IDS))
+        return {'finished': topic_id, 'num_remaining': num_remaining}
+
+    def spool_path(self, topic_id):
+        '''Return the text run file that holds the steps of `topic_id`
+        until it is stopped, or None if the harness writes no run.
+        '''
+        base = self.run_file_path or self.binary_run_path
+        if base is None:
+            return None
+        return '%s.%s.spool' % (base, topic_id)
+
+    def flush_spool(self, topic_id):
+        '''Append the spooled steps of `topic_id` to the run file and
+        the binary run.
+        '''
+        spool = self.spools.pop(topic_id, None)
+        if spool is not None:
+            spool.close()
+        path = self.spool_path(topic_id)
+        if path is None or not os.path.exists(path):
+            return
+        if self.run_file is not None:
+            self.run_file.append_file(path)
+            self.run_file.stop()
+        if self.binary_run is not None:
+            try:
+                for _topic_id, results in iter_text_run(path):
+                    self.binary_run.append_steps(
+                        steps_from_results(_topic_id, results))
+            except ValueError, exc:
+                raise HarnessError('Cannot read the spool: %s' % exc)
+            self.binary_run.stop()
+
+    def remove_spools(self, topic_ids):
+        '''Throw away anything spooled for `topic_ids`.'''
+        for topic_id in topic_ids:
+            spool = self.spools.pop(topic_id, None)
+            if spool is not None:
+                spool.close()
+            path = self.spool_path(topic_id)
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    def run_sizes(self):
+        '''Return the size in bytes of the text run file and the number
+        of steps in the binary run, each None if there is none.
+        '''
+        size = binary_steps = None
+        if self.run_file is not None:
+            size = self.run_file.size()
+        if self.binary_run is not None:
+            binary_steps = self.binary_run.num_steps()
+        return size, binary_steps
+
+    def spool_size(self, topic_id):
+        spool = self.spools.get(topic_id)
+        if spool is not None:
+            spool.flush()
+        path = self.spool_path(topic_id)
+        if path is None or not os.path.exists(path):
+            return 0
+        return os.path.getsize(path)
+
+    def checkpoint_topic(self, topic_id, iteration, expecting_stop):
+        '''Record that every step of `topic_id` before `iteration` is
+        written, along with where its steps end: in the run files, or
+        in its spool when more than one topic may be active.
+        '''
+        if not self.checkpoint:
+            return
+        if self.concurrent:
+            size, binary_steps = self.spool_size(topic_id), None
+        else:
+            size, binary_steps = self.run_sizes()
+        self.state.put(CHECKPOINTS, ((topic_id,), json.dumps({
+            'iteration': iteration,
+            'expecting_stop': expecting_stop,
+            'run_file_size': size,
+            'binary_steps': binary_steps,
+        })))
+
+    def checkpoint_run(self, stopped=None):
+        '''Record where the finished topics end in the run files.
+        `stopped` is the topic whose `stop` wrote the latest of them.
+        '''
+        if not self.checkpoint:
+            return
+        size, binary_steps = self.run_sizes()
+        # where this run starts in the run file, which `init` does not
+        # empty
+        run_file_start = size
+        for _, val in self.state.get(RUN_CHECKPOINT, ('run',)):
+            if val is not None:
+                run_file_start = json.loads(val)['run_file_start']
+        self.state.put(RUN_CHECKPOINT, (('run',), json.dumps({
+            'run_file_start': run_file_start,
+            'run_file_size': size,
+            'binary_steps': binary_steps,
+            'stopped': stopped,
+        })))
+
+    def forget_seen_docs(self, topic_id, iteration=0):
+        '''Forget the documents `topic_id` submitted at `iteration` or
+        later.
+        '''
+        keys = [key for key, val
+                in self.state.scan(SEEN_DOCS, ((topic_id,), (topic_id,)))
+                if int(val or 0) >= iteration]
+        if keys:
+            self.state.delete(SEEN_DOCS, *keys)
+
+    def truncate_run(self, path, size):
+        try:
+            cut = truncate_text_run(path, size)
+        except ValueError, exc:
+            raise HarnessError('Cannot resume from the checkpoint: %s' % exc)
+        if cut:
+            logger.warn('cut %d bytes written after the checkpoint off %s',
+                        cut, path)
+
+    @synchronized
+    def resume(self):
+        '''Go back to the last checkpoint, after a crash.
+
+        This cuts the run file, the binary run and the spools back to
+        the end of the last step the harness finished, and rolls the
+        interaction sequence, seen documents and expected `stop` of
+        each unfinished topic back to match.  It returns the number of
+        topics left and the topics in progress, each with the
+        iteration its next step gets; the system carries on with
+        `step` for those.
+        '''
+        if not self.checkpoint:
+            raise HarnessError('Checkpoints are off.  Set checkpoint in '
+                               'the harness config to keep them.')
+        run_checkpoint = None
+        for _, val in self.state.get(RUN_CHECKPOINT, ('run',)):
+            if val is not None:
+                run_checkpoint = json.loads(val)
+        if run_checkpoint is None:
+            raise HarnessError('There is no checkpoint to resume from.  '
+                               'Did you call `trec_dd_harness init`?')
+        self.close()
+
+        queries = dict((topic_id, query_string) for (topic_id,), query_string
+                       in self.state.scan(TOPIC_IDS))
+        stopped = run_checkpoint['stopped']
+        if stopped in queries:
+            # the crash came after the topic was written to the run
+            # file, so finish its `stop`
+            del queries[stopped]
+            self.remove_spools([stopped])
+            self.unset_expecting_stop(stopped)
+            self.state.delete(ACTIVE_TOPICS, (stopped,))
+            self.state.delete(TOPIC_IDS, (stopped,))
+        checkpoints = dict()
+        for (topic_id,), val in self.state.scan(CHECKPOINTS):
+            if topic_id in queries:
+                checkpoints[topic_id] = json.loads(val)
+            else:
+                self.state.delete(CHECKPOINTS, (topic_id,))
+        if self.concurrent:
+            started = set(self.active_topics())
+        else:
+            started = set()
+            for (topic_id,) in self.state.scan_keys(TOPIC_IDS):
+                started.add(topic_id)
+                break
+
+        run_file_size = run_checkpoint['run_file_size']
+        binary_steps = run_checkpoint['binary_steps']
+        resumed = []
+        for topic_id in sorted(started | set(checkpoints)):
+            checkpoint = checkpoints.get(topic_id)
+            if topic_id not in started or checkpoint is None:
+                # the crash came before it was started, so start over
+                self.remove_spools([topic_id])
+                self.unset_expecting_stop(topic_id)
+                self.forget_seen_docs(topic_id)
+                self.state.delete(INTERACTION_SEQ, (topic_id,))
+                self.state.delete(ACTIVE_TOPICS, (topic_id,))
+                self.state.delete(CHECKPOINTS, (topic_id,))
+                continue
+            iteration = checkpoint['iteration']
+            self.state.put(INTERACTION_SEQ, ((topic_id,), str(iteration)))
+            if checkpoint['expecting_stop']:
+                self.set_expecting_stop(topic_id)
+            else:
+                self.unset_expecting_stop(topic_id)
+            self.forget_seen_docs(topic_id, iteration)
+            if not self.concurrent:
+                run_file_size = checkpoint['run_file_size']
+                binary_steps = checkpoint['binary_steps']
+            elif self.spool_path(topic_id) is not None:
+                self.truncate_run(self.spool_path(topic_id),
+                                  checkpoint['run_file_size'])
+            resumed.append({'topic_id': topic_id,
+                            'query': queries[topic_id],
+                            'iteration': iteration,
+                            'expecting_stop': checkpoint['expecting_stop']})
+
+        if self.run_file is not None and run_file_size is not None:
+            self.truncate_run(self.run_file_path, run_file_size)
+        if self.binary_run is not None and binary_steps is not None:
+            try:
+                self.binary_run.truncate(binary_steps)
+            except ValueError, exc:
+                raise HarnessError('Cannot resume from the checkpoint: %s'
+                                   % exc)
+        if self.scorer is not None:
+            self.replay_scores(run_checkpoint['run_file_start'],
+                               [topic['topic_id'] for topic in resumed])
+        logger.info('resumed %d topics, with %d left to run',
+                    len(resumed), len(queries))
+        return {'num_topics': len(queries), 'topics': resumed}
+
+    def replay_scores(self, run_file_start, topic_ids):
+        '''Rebuild the live scores from the run file, which this run
+        starts writing at `run_file_start`, and from the spools of the
+        unfinished `topic_ids`.
+        '''
+        self.scorer.reset()
+        try:
+            self._replay_scores(run_file_start, topic_ids)
+        except ValueError, exc:
+            raise HarnessError('Cannot replay the scores: %s' % exc)
+
+    def _replay_scores(self, run_file_start, topic_ids):
+        if self.run_file_path is not None and run_file_start is not None:
+            for topic_id, results in iter_text_run(self.run_file_path,
+                                                   run_file_start):
+                self.scorer.add_results(topic_id, results)
+                if topic_id not in topic_ids:
+                    self.scorer.stop(topic_id)
+        if self.concurrent:
+            for topic_id in topic_ids:
+                path = self.spool_path(topic_id)
+                if path is None or not os.path.exists(path):
+                    continue
+                for _, results in iter_text_run(path):
+                    self.scorer.add_results(topic_id, results)
+
+    @synchronized
     def step(self, topic_id, results):
         '''Generates feedback on one round of recommendations
         '''
-        self.check_expecting_stop()
-        self.verify_label_store()
-        query_string = None
-        for (_topic_id,), query_string in self.kvl.scan(TOPIC_IDS):
-            break
-        if query_string is None:
-            sys.exit('got out of sync: topic_id=%r' % topic_id)
-        if topic_id != _topic_id:
-            sys.exit('%d != %d, which is where the database says we are'
-                     % (topic_id, _topic_id))
-
-        iteration = self.incr_interaction_seq(topic_id)
+        if self.concurrent:
+            self.check_active(topic_id)
+            self.check_expecting_stop(topic_id)
+            self.verify_label_store()
+        else:
+            self.check_expecting_stop()
+            self.verify_label_store()
+            query_string = None
+            for (_topic_id,), query_string in self.state.scan(TOPIC_IDS):
+                break
+            if query_string is None:
+                raise HarnessError('got out of sync: topic_id=%r' % topic_id)
+            if topic_id != _topic_id:
+                raise HarnessError('%r != %r, which is where the database '
+                                   'says we are' % (topic_id, _topic_id))
+
+        with self.timings.timer('state_update'):
+            iteration = self.incr_interaction_seq(topic_id)
             
         if len(results) > 2 * self.batch_size:
             logger.warn('command="step" allows up to twice batch_size (2 x %d = %d) '
@@ -161,7 +785,8 @@ class Harness(object):
                         self.batch_size, 2 * self.batch_size, len(results), results)
             return {'error': 'MUST EXIT: submitted too many results'}
 
-        if len(results) < 2 * self.batch_size:
+        expecting_stop = len(results) < 2 * self.batch_size
+        if expecting_stop:
             logger.warn('fewer than the batch size, so automatically calling `stop` '
                         'this query; you must call `start` to move on to the next query.')
             self.set_expecting_stop(topic_id)
@@ -170,61 +795,39 @@ class Harness(object):
         results = [(stream_id, int(conf))
                    for stream_id, conf in itertools.izip_longest(*pairs)]
 
-        # verify that the system hasn't repeated any stream items.
-        for stream_id, _ in results:
-            key_range = ((topic_id, stream_id), (topic_id, stream_id))
-            for (topic_id, doc_id), _ in self.kvl.scan(SEEN_DOCS, key_range):
-                msg = 'Your system submitted document {} twice as a result.'
-                msg = msg.format(doc_id)
-                sys.exit(msg)
-
-            key = (topic_id, stream_id)
-            val = ''
-            self.kvl.put(SEEN_DOCS, (key, val))
+        # verify that the system hasn't repeated any stream items,
+        # checking and recording the whole batch at once
+        keys = [(topic_id, stream_id) for stream_id, _ in results]
+        with self.timings.timer('seen_docs'):
+            seen = set(key for key, val in self.state.get(SEEN_DOCS, *keys)
+                       if val is not None)
+            for key in keys:
+                if key in seen:
+                    msg = ('Your system submitted document {} twice as a '
+                           'result.')
+                    msg = msg.format(key[1])
+                    raise HarnessError(msg)
+                seen.add(key)
+            # keep each document's iteration, so `resume` can forget
+            # the documents of steps after its checkpoint
+            self.state.put(SEEN_DOCS,
+                           *[(key, str(iteration)) for key in keys])
+
+        with self.timings.timer('label_lookup'):
+            subtopic_feedbacks = self.lookup_feedback(
+                topic_id, [stream_id for stream_id, _ in results])
 
         # private function for constructing feedback, used in `map` below
-        def feedback_for_result(result):
+        def feedback_for_result(result, subtopic_feedback):
             stream_id, confidence = result
             if len(stream_id.strip()) == 0:
-                sys.exit('Your system submitted a bogus document identifier: %r'
-                         % stream_id)
+                raise HarnessError('Your system submitted a bogus document '
+                                   'identifier: %r' % stream_id)
             try:
                 assert 0 <= int(confidence) <= 1000
             except:
-                sys.exit('Your system submitted a bogus confidence value: %r'
-                         % confidence)
-
-            labels_for_doc = self.label_store.directly_connected(stream_id)
-            labels_for_doc = filter(lambda l: l.other(stream_id) == topic_id,
-                                    labels_for_doc)
-
-            # If any of the labels between the topic_id and
-            # the document are negative, we call this document
-            # off-topic. If there are no labels between this
-            # topic_id and the document, we call this document
-            # off-topic. Otherwise, we extract the subtopics
-            # from the labels and call the document on-topic.
-            if any([label.value == CorefValue.Negative
-                    for label in labels_for_doc]):
-                subtopic_feedback = []
-            else:
-                def subtopic_from_label(label):
-                    subtopic_id = label.subtopic_for(stream_id)
-                    subtopic = {
-                        'subtopic_id': label.subtopic_for(topic_id),
-                        'subtopic_name': label.meta['subtopic_name'],
-                        'passage_text': label.meta['passage_text'],
-                        'rating': label.rating,
-                    }
-                    return subtopic
-
-                subtopic_feedback = [subtopic_from_label(label)
-                                     for label in labels_for_doc]
-
-                #subtopic_feedback = []
-                #for _, data in subtopic_id_to_data.iteritems():
-                #    best = max(data, key=lambda d: d['rating'])
-                #    subtopic_feedback.append(best)
+                raise HarnessError('Your system submitted a bogus confidence '
+                                   'value: %r' % confidence)
 
             feedback = {
                 'topic_id': topic_id,
@@ -236,45 +839,82 @@ class Harness(object):
 
             return feedback
 
-        all_feedback = map(feedback_for_result, results)
-        self.write_feedback_to_run_file(iteration, all_feedback)
+        all_feedback = map(feedback_for_result, results, subtopic_feedbacks)
+        with self.timings.timer('run_file_write'):
+            self.write_feedback_to_run_file(iteration, all_feedback)
+        with self.timings.timer('state_update'):
+            self.checkpoint_topic(topic_id, iteration + 1, expecting_stop)
+        if self.scorer is not None:
+            self.scorer.update(topic_id, all_feedback)
         return all_feedback
 
+    @synchronized
+    def scores(self, topic_id=None):
+        '''Return the live scores of `topic_id`, or of every topic with
+        results so far, in the form of ``run['scores']``.  Stopped
+        topics have their final scores.
+
+        This needs ``live_scores`` in the config, and only covers the
+        steps taken by this harness object, such as one kept open by
+        `serve`.
+        '''
+        if self.scorer is None:
+            raise HarnessError('Live scores are off.  Set live_scores in '
+                               'the harness config to keep them.')
+        if topic_id is None:
+            return self.scorer.scores()
+        return self.scorer.scores([topic_id])
+
 
     def write_feedback_to_run_file(self, iteration, feedback):
-        if self.run_file_path is None:
+        if not feedback:
             return
-
-        # *append* to the run file
-        run_file = open(self.run_file_path, 'a')
-
-        for entry in feedback:
-            subtopic_stanza = 'NULL'
-            if entry['subtopics']:
-                subtopic_tuples = []
-                for subtopic in entry['subtopics']:
-                    subtopic_tuple = ':'.join([subtopic['subtopic_id'],
-                                               str(subtopic['rating'])])
-                    subtopic_tuples.append(subtopic_tuple)
-                subtopic_stanza = '|'.join(subtopic_tuples)
-
-            # <topic> <iteration> <document-id> <confidence> <on_topic> <subtopic data>
-            run_file_line = ('%(topic_id)s\t%(iteration)s\t%(stream_id)s\t%(confidence).6f'
-                             '\t%(on_topic)d\t%(subtopic_stanza)s\n')
-            output_dict = {'subtopic_stanza': subtopic_stanza,
-                           'topic_id': entry['topic_id'],
-                           'iteration': iteration,
-                           'stream_id': entry['stream_id'],
-                           'confidence': entry['confidence'],
-                           'on_topic': entry['on_topic'],
-                           }
-            to_write = run_file_line % output_dict
-
-            assert len(run_file_line.split()) == 6
-
-            run_file.write(to_write)
-
-        run_file.close()
+        topic_id = feedback[0]['topic_id']
+        rows = [(entry['stream_id'], entry['confidence'], entry['on_topic'],
+                 [(subtopic['subtopic_id'], subtopic['rating'])
+                  for subtopic in entry['subtopics']])
+                for entry in feedback]
+        if self.concurrent:
+            # each topic's steps stay together in the run file
+            path = self.spool_path(topic_id)
+            if path is None:
+                return
+            if topic_id not in self.spools:
+                self.spools[topic_id] = RunFileWriter(path)
+            self.spools[topic_id].write_step(topic_id, iteration, rows)
+            return
+        if self.run_file is not None:
+            self.run_file.write_step(topic_id, iteration, rows)
+        if self.binary_run is not None:
+            self.binary_run.append_step(topic_id, iteration, rows)
+
+    @synchronized
+    def close(self):
+        '''Flush and close the run files.  The harness stays usable, and
+        reopens them if they are written to again.
+        '''
+        if self.run_file is not None:
+            self.run_file.close()
+        if self.binary_run is not None:
+            self.binary_run.close()
+        for spool in self.spools.itervalues():
+            spool.close()
+
+    def report_timings(self):
+        '''Log the timings of this harness object as JSON, and append
+        them, with the run_id, as one line to timings_path if the
+        config sets it.  Each process running a harness command
+        reports its own.
+        '''
+        timings = self.timings.to_dict()
+        if not timings:
+            return
+        logger.info('timings: %s', json.dumps(timings, sort_keys=True))
+        if self.timings_path:
+            record = {'run_id': self.run_id, 'time': time.time(),
+                      'timings': timings}
+            with open(self.timings_path, 'a') as fh:
+                fh.write(json.dumps(record, sort_keys=True) + '\n')
 
 usage = '''The purpose of this harness is to interact with your TREC DD system
 by issuing queries to your system, and providing feedback (truth data)
@@ -289,7 +929,8 @@ invoke stop.   Every invocation  must include the  -c argument  with a
 path   to    a   valid    config.yaml   file,   as    illustrated   in
 example/config.yaml.  For  efficiency, the first  time you run  with a
 new configuration,  the truth data  must be loaded into  your database
-using the `load` command.  
+using the `load` command.  `load --workers N` converts the truth data
+in N processes while a separate thread writes it to the database.
 
 By default, when you score a system using the harness, all of the
 topics are applied to the system in an order selected by the harness.
@@ -300,6 +941,17 @@ The harness keeps track of the topic_ids that have not yet been used
 in building your system's run file.  To reset this state, you must run
 the `init` command.
 
+Every harness command reads the truth data from the database.  The
+`compile` command writes all of it to one memory-mapped snapshot file
+instead; set truth_snapshot_path in the config.yaml to that file and
+the harness, trec_dd_scorer and trec_dd_random_system will read the
+snapshot without touching the label store.
+
+The `export-qrels` command writes the truth data as qrels for
+bin/cubeTest_v3.pl, from the label store or, with --from-xml, straight
+from the truth data XML.  `export-qrels --shard-dir DIR` writes one
+DIR/<topic_id>.qrels file per topic.
+
 To progress through the topics, your system must execute this double
 while loop, which is exactly what is implemented in the
 trec_dd/system/ambassador_cli.py example:
@@ -317,6 +969,25 @@ trec_dd/system/ambassador_cli.py example:
                     your system processes the feedback
             `stop`
 
+Set max_active_topics in the config.yaml to have `start` hand out up
+to that many topics at once; `step` and `stop` then accept any active
+topic, and each topic's steps are appended to the run file together
+at its `stop`.
+
+Many simulations can share one truth data store at once.  Give each
+its own run_id, in the config.yaml or with --run-id, and its harness
+keeps its state in tables of its own, prefixed with the run_id, and
+fills the run_id into any {run_id} in run_file_path and
+binary_run_path.
+
+With checkpoint set in the config.yaml, the harness records where
+every step ends in the run file along with each topic's state.  After
+a crash, the `resume` command cuts anything written after the last
+finished step off the run file and rolls the topic state back to
+match.  It returns the topics in progress, with the iteration of
+their next step, so your system can carry on stepping them instead of
+starting the run over.
+
 Each of the five commands returns a JSON dictionary which your system
 can read using a JSON library.  The harness always provides feedback
 for every result, even if the feedback is that the system has no truth
@@ -328,6 +999,18 @@ exit.
 See trec_dd/system/ambassador_cli.py for an example of using the
 harness from python.
 
+Starting a new process for every command is slow.  The `serve` command
+keeps one harness open and reads one JSON request per line from stdin,
+such as {"command": "step", "args": ["topic_id", "doc1", "244"]},
+writing one JSON response per line to stdout.  `serve --socket PATH`
+listens on a Unix socket instead.  HarnessAmbassadorServer in
+trec_dd/system/ambassador_cli.py drives the harness this way.
+
+With live_scores set in the config.yaml, the harness keeps the scores
+trec_dd_scorer computes in one pass up to date at every step, and
+{"command": "scores"} or {"command": "scores", "args": ["topic_id"]}
+returns them from a `serve` harness without reading the run file.
+
 '''
 
 def main():
@@ -335,7 +1018,13 @@ def main():
         'Command line interface to the office TREC DD jig.',
         usage=usage,
         conflict_handler='resolve')
-    parser.add_argument('command', help='must be "load", "init", "start", "step", or "stop"')
+    parser.add_argument('command', help='must be "load", "compile", '
+                        '"export-qrels", "init", "start", "step", "stop", '
+                        '"resume", or "serve"')
+    parser.add_argument('--run-id', default=None,
+                        help='keep the state of this run apart from other '
+                        'runs sharing the truth data; overrides run_id in '
+                        'the config')
     parser.add_argument('args', help='input for given command',
                         nargs=argparse.REMAINDER)
     modules = [yakonfig, kvlayer, Harness]
@@ -343,42 +1032,140 @@ def main():
 
     logging.basicConfig(level=logging.DEBUG)
 
-    if args.command not in set(['load', 'init', 'start', 'step', 'stop']):
-        sys.exit('The only valid commands are "load", "init", "start", "step", and "stop".')
+    commands = ['load', 'compile', 'export-qrels', 'init', 'start', 'step',
+                'stop', 'resume', 'serve']
+    if args.command not in set(commands):
+        sys.exit('The only valid commands are "load", "compile", '
+                 '"export-qrels", "init", "start", "step", "stop", '
+                 '"resume", and "serve".')
 
     kvl = kvlayer.client()
     label_store = LabelStore(kvl)
     config = yakonfig.get_global_config('harness')
-    harness = Harness(config, kvl, label_store)
-
-    if args.command == 'load':
+    if args.run_id is not None:
+        config = dict(config, run_id=args.run_id)
+    if args.command == 'compile':
+        # the snapshot does not exist yet, so do not try to open it
+        config = dict(config, truth_snapshot_path=None)
+    try:
+        harness = Harness(config, kvl, label_store)
+    except ValueError, exc:
+        sys.exit(str(exc))
+
+    try:
+        run_command(harness, label_store, config, args.command, args.args)
+    except HarnessError, exc:
+        sys.exit(str(exc))
+    finally:
+        harness.close()
+        harness.report_timings()
+
+
+def run_command(harness, label_store, config, command, args):
+    if command == 'load':
+        load_parser = argparse.ArgumentParser('trec_dd_harness load')
+        load_parser.add_argument(
+            '--workers', type=int, default=1,
+            help='number of processes converting truth data passages')
+        load_args = load_parser.parse_args(args)
         if not config.get('truth_data_path'):
             sys.exit('Must provide --truth-data-path as an argument')
         if not os.path.exists(config['truth_data_path']):
             sys.exit('%r does not exist' % config['truth_data_path'])
-        parse_truth_data(label_store, config['truth_data_path'])
+        load_truth_data(harness.kvl, label_store,
+                        config['truth_data_path'],
+                        workers=load_args.workers)
         logger.info('Done!  The truth data was loaded into this '
                      'kvlayer backend:\n%s',
                     json.dumps(yakonfig.get_global_config('kvlayer'),
                                indent=4, sort_keys=True))
 
-    elif args.command == 'init':
+    elif command == 'compile':
+        compile_parser = argparse.ArgumentParser('trec_dd_harness compile')
+        compile_parser.add_argument(
+            'snapshot_path', nargs='?',
+            default=yakonfig.get_global_config('harness').get(
+                'truth_snapshot_path'),
+            help='file to write, by default truth_snapshot_path '
+            'from the config')
+        compile_args = compile_parser.parse_args(args)
+        if not compile_args.snapshot_path:
+            sys.exit('Must provide a snapshot path or set '
+                     'truth_snapshot_path in the config')
+        num_labels = compile_snapshot(label_store, compile_args.snapshot_path)
+        if num_labels == 0:
+            sys.exit('The label store is empty.  Have you run '
+                     '`trec_dd_harness load`?')
+        logger.info('Wrote %d labels to %s', num_labels,
+                    compile_args.snapshot_path)
+
+    elif command == 'export-qrels':
+        export_parser = argparse.ArgumentParser('trec_dd_harness export-qrels')
+        export_parser.add_argument(
+            'qrels_path', nargs='?',
+            help='file to write, by default standard output')
+        export_parser.add_argument(
+            '--from-xml', action='store_true', default=False,
+            help='stream the truth data XML at truth_data_path instead '
+            'of reading the label store')
+        export_parser.add_argument(
+            '--shard-dir', help='write one <topic_id>.qrels file per '
+            'topic to this directory instead')
+        export_args = export_parser.parse_args(args)
+        if export_args.from_xml:
+            if not config.get('truth_data_path'):
+                sys.exit('Must provide --truth-data-path as an argument')
+            qrels = qrels_from_truth_data(config['truth_data_path'])
+        else:
+            qrels = qrels_from_label_store(label_store)
+        if export_args.shard_dir:
+            counts = write_sharded_qrels(qrels, export_args.shard_dir)
+            num_qrels = sum(counts.itervalues())
+        elif export_args.qrels_path:
+            with open(export_args.qrels_path, 'wb', 1 << 16) as fh:
+                num_qrels = write_qrels(qrels, fh)
+        else:
+            num_qrels = write_qrels(qrels, sys.stdout)
+        if num_qrels == 0 and not export_args.from_xml:
+            sys.exit('The label store is empty.  Have you run '
+                     '`trec_dd_harness load`?')
+        logger.info('Wrote %d qrels', num_qrels)
+
+    elif command == 'init':
         response = harness.init()
         print(json.dumps(response))
 
-    elif args.command == 'start':
+    elif command == 'start':
         response = harness.start()
         print(json.dumps(response))
 
-    elif args.command == 'stop':
-        response = harness.stop(args.args[0])
+    elif command == 'stop':
+        response = harness.stop(args[0])
         print(json.dumps(response))
 
-    elif args.command == 'step':
-        parts = args.args
+    elif command == 'step':
+        parts = args
         topic_id = parts.pop(0)
         feedback = harness.step(topic_id, parts)
         print(json.dumps(feedback))
 
+    elif command == 'resume':
+        response = harness.resume()
+        print(json.dumps(response))
+
+    elif command == 'serve':
+        # imported here because trec_dd.harness.serve imports this module
+        from trec_dd.harness.serve import serve_socket, serve_stream
+        serve_parser = argparse.ArgumentParser('trec_dd_harness serve')
+        serve_parser.add_argument(
+            '--socket', help='listen on this Unix socket path instead of '
+            'reading requests from stdin')
+        serve_args = serve_parser.parse_args(args)
+        if serve_args.socket:
+            serve_socket(harness, serve_args.socket)
+        else:
+            serve_stream(harness, sys.stdin, sys.stdout)
+
+
 if __name__ == '__main__':
     main()
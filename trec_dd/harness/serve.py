@@ -0,0 +1,99 @@
+'''trec_dd.harness.serve keeps one Harness open and answers commands
+as line-delimited JSON.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+
+Running ``trec_dd_harness -c config.yaml serve`` pays for the
+configuration, kvlayer connection and label store setup once, and then
+reads one JSON request per line from stdin, writing one JSON response
+per line to stdout.  ``serve --socket PATH`` does the same over a Unix
+domain socket instead.  A request looks like::
+
+    {"command": "step", "args": ["DD15-1", "doc1", "244", "doc2", "100"]}
+
+where ``args`` are exactly the arguments that would follow the command
+on the ``trec_dd_harness`` command line.  A request that fails gets
+``{"error": "..."}`` back and the server keeps running.
+'''
+
+from __future__ import absolute_import
+import json
+import logging
+import os
+import SocketServer
+
+from trec_dd.harness.run import HarnessError
+
+logger = logging.getLogger(__name__)
+
+
+def dispatch(harness, command, args):
+    '''Run one harness `command` with its command-line style `args`.
+    '''
+    # kvlayer wants byte strings, the way they arrive from sys.argv
+    args = [arg.encode('utf-8') if isinstance(arg, unicode) else str(arg)
+            for arg in args]
+    if command == 'init':
+        return harness.init()
+    elif command == 'start':
+        return harness.start()
+    elif command == 'stop':
+        return harness.stop(args[0])
+    elif command == 'step':
+        return harness.step(args[0], list(args[1:]))
+    elif command == 'resume':
+        return harness.resume()
+    elif command == 'scores':
+        return harness.scores(*args[:1])
+    elif command == 'timings':
+        return harness.timings.to_dict()
+    else:
+        raise HarnessError('unknown command for serve: %r' % command)
+
+
+def handle_request(harness, line):
+    '''Parse one request `line` and return the JSON response line.
+    '''
+    try:
+        request = json.loads(line)
+        response = dispatch(harness, request['command'],
+                            request.get('args', []))
+    except HarnessError, exc:
+        logger.error('%s', exc)
+        response = {'error': str(exc)}
+    except (ValueError, KeyError, IndexError, TypeError), exc:
+        logger.error('bad request %r', line, exc_info=True)
+        response = {'error': 'bad request: %s' % exc}
+    return json.dumps(response) + '\n'
+
+
+def serve_stream(harness, infile, outfile):
+    '''Answer requests from `infile` on `outfile` until end of file.
+    '''
+    for line in iter(infile.readline, ''):
+        if not line.strip():
+            continue
+        outfile.write(handle_request(harness, line))
+        outfile.flush()
+
+
+def serve_socket(harness, socket_path):
+    '''Answer requests on a Unix domain socket at `socket_path`.
+
+    Connections are served one at a time, since a single harness
+    tracks a single run.
+    '''
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            serve_stream(harness, self.rfile, self.wfile)
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = SocketServer.UnixStreamServer(socket_path, Handler)
+    logger.info('serving harness on %s', socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
@@ -0,0 +1,242 @@
+'''trec_dd.harness.state keeps the harness's interaction state.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+
+The harness remembers which topics are left, each topic's iteration,
+the documents it has seen and whether it expects a `stop` in a few
+small tables.  :class:`KvlayerState`, the default, keeps them in the
+kvlayer backend next to the truth data, so every `get`, `put` and
+`scan` is a round trip to that backend.  :class:`SQLiteState` keeps
+them in one SQLite file in WAL mode, which any number of harness
+processes on one machine can share, and commits each harness command
+as one transaction.
+
+Both have the parts of the :mod:`kvlayer` client interface the harness
+uses, with keys that are tuples of strings, plus a
+:meth:`~SQLiteState.transaction` context manager.  Set
+``state_backend: sqlite`` and ``state_path`` in the ``harness`` config
+to use SQLite.
+
+Given a `run_id`, either store prefixes every table name with it, so
+any number of simulations can keep their own state side by side in
+one kvlayer namespace or one SQLite file, next to the truth data they
+all read.
+'''
+
+from __future__ import absolute_import
+from contextlib import contextmanager
+import logging
+import re
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+state_backends = ('kvlayer', 'sqlite')
+
+#: what a run_id may look like, so that it makes a valid table name
+RUN_ID_RE = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+
+
+def run_table(table, run_id=None):
+    '''Return the name of `table` for the run `run_id`.'''
+    if run_id is None:
+        return table
+    if not RUN_ID_RE.match(run_id):
+        raise ValueError('run_id must be a letter followed by letters, '
+                         'digits and underscores, not %r' % run_id)
+    return '%s_%s' % (run_id, table)
+
+
+def open_state(config, kvl, tables):
+    '''Return the harness state store the `config` asks for, with
+    `tables` mapping each table name to the types of its keys.  `kvl`
+    holds the tables of the default kvlayer backend.
+    '''
+    backend = config.get('state_backend', 'kvlayer')
+    run_id = config.get('run_id')
+    if backend == 'kvlayer':
+        return KvlayerState(kvl, tables, run_id)
+    elif backend == 'sqlite':
+        path = config.get('state_path')
+        if not path:
+            raise ValueError('state_backend sqlite needs a state_path')
+        return SQLiteState(path, run_id)
+    raise ValueError('state_backend must be one of %r, not %r'
+                     % (state_backends, backend))
+
+
+class KvlayerState(object):
+    '''Harness state in the `tables` of the kvlayer client `kvl`,
+    named for `run_id` by :func:`run_table`.
+
+    kvlayer has no transactions, so :meth:`transaction` only groups
+    the calls for the reader.
+    '''
+
+    def __init__(self, kvl, tables, run_id=None):
+        self.kvl = kvl
+        self.names = dict((table, run_table(table, run_id))
+                          for table in tables)
+        self.kvl.setup_namespace(dict((self.names[table], key_types)
+                                      for table, key_types
+                                      in tables.iteritems()))
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+    def clear_table(self, table):
+        self.kvl.clear_table(self.names[table])
+
+    def put(self, table, *pairs):
+        self.kvl.put(self.names[table], *pairs)
+
+    def get(self, table, *keys):
+        return self.kvl.get(self.names[table], *keys)
+
+    def delete(self, table, *keys):
+        self.kvl.delete(self.names[table], *keys)
+
+    def scan(self, table, *key_ranges):
+        return self.kvl.scan(self.names[table], *key_ranges)
+
+    def scan_keys(self, table, *key_ranges):
+        return self.kvl.scan_keys(self.names[table], *key_ranges)
+
+    def close(self):
+        pass
+
+
+# separates the parts of a key; keys sort as their tuples do
+SEP = '\0'
+
+# keys per `get` statement, well under SQLite's oldest default limit
+# of 999 bound variables
+GET_CHUNK = 500
+
+
+def _encode_key(key):
+    return SEP.join(key)
+
+
+def _decode_key(key):
+    return tuple(str(key).split(SEP))
+
+
+class SQLiteState(object):
+    '''Harness state in one SQLite database file at `path`.
+
+    Every table lives in a single ``state`` table of ``(tbl, key,
+    value)`` rows, keyed on the table name, as named for `run_id` by
+    :func:`run_table`, and the key's parts joined by NUL, so rows sort
+    in the order of their key tuples, as kvlayer scans them.  Outside
+    :meth:`transaction`, each call commits on its own.
+    '''
+
+    def __init__(self, path, run_id=None):
+        self.path = path
+        self.run_id = run_id
+        # fail now on a bad run_id, not at the first call
+        self._name('')
+        # the harness serializes its own threads
+        self.conn = sqlite3.connect(path, isolation_level=None,
+                                    check_same_thread=False, timeout=60)
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS state ('
+                          'tbl TEXT NOT NULL, key BLOB NOT NULL, '
+                          'value BLOB NOT NULL, PRIMARY KEY (tbl, key))')
+        self.depth = 0
+
+    @contextmanager
+    def transaction(self):
+        '''Commit everything done inside as one transaction, or none of
+        it if an exception escapes.  Transactions nest, and only the
+        outermost one commits.
+        '''
+        if self.depth == 0:
+            # take the write lock up front, so that concurrent harness
+            # processes cannot both read and then fail to write
+            self.conn.execute('BEGIN IMMEDIATE')
+        self.depth += 1
+        try:
+            yield
+        except:
+            self.depth -= 1
+            if self.depth == 0:
+                self.conn.execute('ROLLBACK')
+            raise
+        else:
+            self.depth -= 1
+            if self.depth == 0:
+                self.conn.execute('COMMIT')
+
+    def _name(self, table):
+        return run_table(table, self.run_id)
+
+    def clear_table(self, table):
+        self.conn.execute('DELETE FROM state WHERE tbl = ?',
+                          (self._name(table),))
+
+    def put(self, table, *pairs):
+        name = self._name(table)
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO state (tbl, key, value) VALUES (?, ?, ?)',
+            [(name, sqlite3.Binary(_encode_key(key)), sqlite3.Binary(value))
+             for key, value in pairs])
+
+    def get(self, table, *keys):
+        '''Return `(key, value)` for each of `keys`, with None for the
+        value of a missing key.  All of `keys` are read in one
+        statement, or one per :data:`GET_CHUNK` keys.
+        '''
+        name = self._name(table)
+        encoded = [_encode_key(key) for key in keys]
+        values = dict()
+        for start in xrange(0, len(encoded), GET_CHUNK):
+            chunk = encoded[start:start + GET_CHUNK]
+            sql = ('SELECT key, value FROM state WHERE tbl = ? AND key IN '
+                   '(%s)' % ', '.join('?' * len(chunk)))
+            args = [name] + [sqlite3.Binary(key) for key in chunk]
+            for key, value in self.conn.execute(sql, args):
+                values[str(key)] = str(value)
+        return [(key, values.get(encoded_key))
+                for key, encoded_key in zip(keys, encoded)]
+
+    def delete(self, table, *keys):
+        name = self._name(table)
+        self.conn.executemany(
+            'DELETE FROM state WHERE tbl = ? AND key = ?',
+            [(name, sqlite3.Binary(_encode_key(key))) for key in keys])
+
+    def _rows(self, columns, table, key_ranges):
+        # read every row first, since the harness changes the table
+        # while it looks through a scan
+        rows = []
+        if not key_ranges:
+            key_ranges = [(None, None)]
+        for start, end in key_ranges:
+            sql = 'SELECT %s FROM state WHERE tbl = ?' % columns
+            args = [self._name(table)]
+            if start:
+                sql += ' AND key >= ?'
+                args.append(sqlite3.Binary(_encode_key(start)))
+            if end:
+                # a key range includes every key its end is a prefix of
+                sql += ' AND key < ?'
+                args.append(sqlite3.Binary(_encode_key(end) + '\1'))
+            rows.extend(self.conn.execute(sql + ' ORDER BY key', args))
+        return rows
+
+    def scan(self, table, *key_ranges):
+        for key, value in self._rows('key, value', table, key_ranges):
+            yield _decode_key(key), str(value)
+
+    def scan_keys(self, table, *key_ranges):
+        for (key,) in self._rows('key', table, key_ranges):
+            yield _decode_key(key)
+
+    def close(self):
+        self.conn.close()
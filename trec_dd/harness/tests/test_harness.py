@@ -1,9 +1,17 @@
 from __future__ import absolute_import
 
-from ..run import Harness
+from ..run import FEEDBACK, TOPICS, Harness, HarnessError, \
+    subtopic_feedback_from_labels
+from ..serve import serve_stream
+from ..state import SQLiteState
+from trec_dd.utils import labels_by_topic_and_doc
+from trec_dd.utils.runfile import binary_to_text
 
 from dossier.label import LabelStore, Label, CorefValue
+import cbor
+from cStringIO import StringIO
 import csv
+import json
 import kvlayer
 import os
 import pytest
@@ -15,12 +23,25 @@ def local_kvl():
                          storage_type='local',
                          namespace='test',
                          app_name='test')
+    # local storage is shared by every client in the process
+    kvl.delete_namespace()
 
     build_test_data(kvl)
+    # as `trec_dd_harness load` does after loading the labels
+    Harness(dict(), kvl, LabelStore(kvl)).index_truth_data()
 
     return kvl
 
 
+@pytest.fixture(params=['kvlayer', 'sqlite'])
+def state_config(request, tmpdir):
+    '''Harness config for each state backend.'''
+    if request.param == 'sqlite':
+        return dict(state_backend='sqlite',
+                    state_path=str(tmpdir.join('state.sqlite')))
+    return dict()
+
+
 def build_test_data(kvl):
     topics = ['topic1', 'topic2', 'topic3']
     subtopics = ['subtopic1', 'subtopic2', 'subtopic3']
@@ -98,3 +119,513 @@ def test_step(local_kvl, tmpdir):
             assert subtopic
         else:
             assert subtopic_data == 'NULL'
+
+
+def test_serve_stream(local_kvl, tmpdir):
+    run_file_path = os.path.join(str(tmpdir), 'runfile.txt')
+    label_store = LabelStore(local_kvl)
+    config = dict(run_file_path=run_file_path)
+    harness = Harness(config, local_kvl, label_store)
+
+    requests = [
+        {'command': 'init'},
+        {'command': 'start'},
+        {'command': 'step', 'args': ['0', 'doc02', '244', 'doc01', '100']},
+        {'command': 'step', 'args': ['0', 'doc00', '300']},
+        {'command': 'stop', 'args': ['0']},
+    ]
+    infile = StringIO(''.join(json.dumps(r) + '\n' for r in requests))
+    outfile = StringIO()
+    serve_stream(harness, infile, outfile)
+
+    responses = [json.loads(line)
+                 for line in outfile.getvalue().splitlines()]
+    assert len(responses) == len(requests)
+    assert responses[0] == {'num_topics': 3}
+    assert responses[1]['topic_id'] == '0'
+    assert [fb['stream_id'] for fb in responses[2]] == ['doc02', 'doc01']
+    # the previous step was short, so the server reports the error and
+    # keeps going
+    assert 'error' in responses[3]
+    assert responses[4]['finished'] == '0'
+
+
+def test_feedback_index(local_kvl):
+    label_store = LabelStore(local_kvl)
+    label_store.put(Label('1', 'doc10', 'other', CorefValue.Negative,
+                          subtopic_id1='subtopic1', subtopic_id2='0,1',
+                          meta=dict(topic_name='topic2', topic_id='1',
+                                    passage_text='nope',
+                                    subtopic_name='bye bye')))
+    Harness(dict(), local_kvl, label_store).index_truth_data()
+
+    # a fresh harness, like a new `trec_dd_harness step` process, reads
+    # the index that `load` stored in kvlayer
+    harness = Harness(dict(), local_kvl, label_store)
+    stream_ids = ['doc00', 'doc01', 'doc10', 'doc11', 'nope']
+    for topic_id in ['0', '1']:
+        expected = []
+        for stream_id in stream_ids:
+            labels = [l for l in label_store.directly_connected(stream_id)
+                      if l.other(stream_id) == topic_id]
+            expected.append(subtopic_feedback_from_labels(topic_id, labels))
+        assert harness.lookup_feedback(topic_id, stream_ids) == expected
+    assert harness.lookup_feedback('1', ['doc10']) == [[]]
+    assert harness.lookup_feedback('1', ['doc11'])[0][0]['rating'] == 2
+
+
+def test_step_duplicates(local_kvl):
+    label_store = LabelStore(local_kvl)
+    harness = Harness(dict(), local_kvl, label_store)
+    harness.init()
+    topic_id = harness.start()['topic_id']
+    harness.step(topic_id, ['doc00', 10, 'doc01', 20, 'doc02', 30,
+                            'a', 1, 'b', 2])
+    with pytest.raises(HarnessError):
+        harness.step(topic_id, ['c', 10, 'doc01', 20])
+
+    harness.init()
+    topic_id = harness.start()['topic_id']
+    with pytest.raises(HarnessError):
+        harness.step(topic_id, ['doc00', 10, 'doc00', 20])
+
+
+def test_init_reads_topic_catalog(local_kvl):
+    label_store = LabelStore(local_kvl)
+    Harness(dict(), local_kvl, label_store).index_truth_data()
+
+    def no_scans(*args, **kwargs):
+        raise AssertionError('scanned the whole label store')
+    label_store.everything = no_scans
+
+    harness = Harness(dict(), local_kvl, label_store)
+    assert harness.init() == {'num_topics': 3}
+    topic_id = harness.start()['topic_id']
+    feedback = harness.step(topic_id, ['doc00', 10, 'doc01', 20])
+    assert [fb['on_topic'] for fb in feedback] == [1, 1]
+    assert harness.label_store_verified
+
+
+def test_index_truth_data_in_batches(local_kvl):
+    label_store = LabelStore(local_kvl)
+    # a second annotator, so that some pairs have several labels
+    label_store.put(Label('1', 'doc10', 'you', CorefValue.Positive,
+                          subtopic_id1='subtopic2', subtopic_id2='1,5',
+                          rating=1,
+                          meta=dict(topic_name='topic2', topic_id='1',
+                                    passage_text='hi',
+                                    subtopic_name='bye bye')))
+    expected = dict(
+        (pair, subtopic_feedback_from_labels(pair[0], labels))
+        for pair, labels
+        in labels_by_topic_and_doc(label_store.everything()).iteritems())
+
+    harness = Harness(dict(), local_kvl, label_store)
+    puts = []
+    put = local_kvl.put
+    def recording_put(table, *pairs):
+        puts.append(len(pairs))
+        put(table, *pairs)
+    local_kvl.put = recording_put
+    try:
+        all_topics = harness.index_truth_data(batch_size=2)
+    finally:
+        local_kvl.put = put
+    assert all_topics == {('0',): 'topic1', ('1',): 'topic2',
+                          ('2',): 'topic3'}
+    assert max(puts) == 2
+    feedback = dict((key, cbor.loads(val))
+                    for key, val in local_kvl.scan(FEEDBACK))
+    assert feedback == expected
+    assert len(feedback[('1', 'doc10')]) == 2
+
+
+def test_run_file_flushes_at_stop(local_kvl, tmpdir, monkeypatch):
+    synced = []
+    monkeypatch.setattr(os, 'fsync', synced.append)
+    run_file_path = os.path.join(str(tmpdir), 'runfile.txt')
+    label_store = LabelStore(local_kvl)
+    config = dict(run_file_path=run_file_path, run_file_flush='stop',
+                  run_file_fsync=True, batch_size=1)
+    harness = Harness(config, local_kvl, label_store)
+    harness.init()
+    topic_id = harness.start()['topic_id']
+    harness.step(topic_id, ['doc%s0' % topic_id, 500])
+    harness.step(topic_id, ['doc%s1' % topic_id, 400])
+    # nothing is flushed or synced until the topic stops
+    assert os.path.getsize(run_file_path) == 0
+    assert synced == []
+    harness.stop(topic_id)
+    with open(run_file_path) as fh:
+        assert len(fh.readlines()) == 2
+    assert synced == [harness.run_file.fh.fileno()]
+
+    topic_id = harness.start()['topic_id']
+    harness.step(topic_id, ['doc%s0' % topic_id, 500])
+    harness.close()
+    with open(run_file_path) as fh:
+        assert len(fh.readlines()) == 3
+    assert len(synced) == 2
+
+
+def test_concurrent_topics(local_kvl, tmpdir):
+    label_store = LabelStore(local_kvl)
+    sequential_path = str(tmpdir.join('sequential.txt'))
+    concurrent_path = str(tmpdir.join('concurrent.txt'))
+    submissions = {'0': [['doc00', 900, 'doc01', 800], ['doc02', 700]],
+                   '1': [['doc10', 900]],
+                   '2': [['doc20', 900, 'junk', 10], ['doc21', 800]]}
+
+    harness = Harness(dict(run_file_path=sequential_path, batch_size=2),
+                      local_kvl, label_store)
+    harness.init()
+    for topic_id in ['0', '1', '2']:
+        assert harness.start()['topic_id'] == topic_id
+        for results in submissions[topic_id]:
+            harness.step(topic_id, results)
+        harness.stop(topic_id)
+    harness.close()
+
+    binary_path = str(tmpdir.join('concurrent.bin'))
+    harness = Harness(dict(run_file_path=concurrent_path, batch_size=2,
+                           binary_run_path=binary_path,
+                           max_active_topics=2),
+                      local_kvl, label_store)
+    assert harness.init() == {'num_topics': 3}
+    assert harness.start()['topic_id'] == '0'
+    assert harness.start()['topic_id'] == '1'
+    with pytest.raises(HarnessError):
+        harness.start()
+    with pytest.raises(HarnessError):
+        harness.step('2', ['doc20', 900])
+
+    # the topics' steps interleave, and topic 1 finishes first
+    harness.step('0', submissions['0'][0])
+    harness.step('1', submissions['1'][0])
+    with pytest.raises(HarnessError):
+        # topic 1 submitted fewer than batch_size results
+        harness.step('1', ['doc11', 900])
+    assert harness.stop('1') == {'finished': '1', 'num_remaining': 2}
+    assert harness.start()['topic_id'] == '2'
+    harness.step('2', submissions['2'][0])
+    harness.step('0', submissions['0'][1])
+    harness.step('2', submissions['2'][1])
+    assert harness.stop('0') == {'finished': '0', 'num_remaining': 1}
+    assert harness.stop('2') == {'finished': '2', 'num_remaining': 0}
+    assert harness.start()['topic_id'] is None
+    harness.close()
+
+    # each topic's lines are together, in the order topics stopped
+    with open(sequential_path) as fh:
+        sequential = fh.readlines()
+    with open(concurrent_path) as fh:
+        concurrent = fh.readlines()
+    by_topic = lambda lines, topic_id: [l for l in lines
+                                        if l.startswith(topic_id + '\t')]
+    assert concurrent == sum([by_topic(sequential, topic_id)
+                              for topic_id in ['1', '0', '2']], [])
+    assert not [name for name in os.listdir(str(tmpdir))
+                if name.endswith('.spool')]
+
+    text_path = str(tmpdir.join('converted.txt'))
+    binary_to_text(binary_path, text_path)
+    with open(text_path) as fh:
+        assert fh.readlines() == concurrent
+
+
+def crash_once(monkeypatch, name):
+    '''Make the next call of Harness.`name` fail, as if the harness
+    died there.
+    '''
+    def crash(self, *args, **kwargs):
+        monkeypatch.undo()
+        raise RuntimeError('crashed in %s' % name)
+    monkeypatch.setattr(Harness, name, crash)
+
+
+def test_resume(local_kvl, tmpdir, monkeypatch, state_config):
+    label_store = LabelStore(local_kvl)
+    submissions = {'0': [['doc00', 900, 'doc01', 800], ['doc02', 700]],
+                   '1': [['doc10', 900]],
+                   '2': [['doc20', 900, 'junk', 10], ['doc21', 800]]}
+
+    def run_topics(harness, topic_ids):
+        for topic_id in topic_ids:
+            assert harness.start()['topic_id'] == topic_id
+            for results in submissions[topic_id]:
+                harness.step(topic_id, results)
+            harness.stop(topic_id)
+        harness.close()
+
+    expected_path = str(tmpdir.join('expected.txt'))
+    harness = Harness(dict(run_file_path=expected_path, batch_size=2,
+                           live_scores=True),
+                      local_kvl, label_store)
+    harness.init()
+    run_topics(harness, ['0', '1', '2'])
+    expected_scores = harness.scores()
+
+    run_file_path = str(tmpdir.join('run.txt'))
+    binary_path = str(tmpdir.join('run.bin'))
+    config = dict(run_file_path=run_file_path, binary_run_path=binary_path,
+                  batch_size=2, checkpoint=True, live_scores=True,
+                  **state_config)
+    harness = Harness(config, local_kvl, label_store)
+    harness.init()
+    run_topics(harness, ['0', '1'])
+    harness.start()
+    harness.step('2', submissions['2'][0])
+    # the step reaches the run file, but the checkpoint does not
+    crash_once(monkeypatch, 'checkpoint_topic')
+    with pytest.raises(RuntimeError):
+        harness.step('2', submissions['2'][1])
+    harness.close()
+    with open(run_file_path, 'ab') as fh:
+        fh.write('2\t2\tdoc2')
+
+    harness = Harness(config, local_kvl, label_store)
+    response = harness.resume()
+    assert response['num_topics'] == 1
+    assert [(topic['topic_id'], topic['iteration'], topic['expecting_stop'])
+            for topic in response['topics']] == [('2', 1, False)]
+    # the documents of the lost step can be submitted again
+    harness.step('2', submissions['2'][1])
+    harness.stop('2')
+    harness.close()
+
+    with open(expected_path) as fh:
+        expected = fh.readlines()
+    with open(run_file_path) as fh:
+        assert fh.readlines() == expected
+    text_path = str(tmpdir.join('converted.txt'))
+    binary_to_text(binary_path, text_path)
+    with open(text_path) as fh:
+        assert fh.readlines() == expected
+    assert harness.scores() == expected_scores
+
+
+def test_resume_rejects_invalid_run_file(local_kvl, tmpdir, state_config):
+    run_file_path = str(tmpdir.join('run.txt'))
+    config = dict(run_file_path=run_file_path, batch_size=2,
+                  checkpoint=True, live_scores=True, **state_config)
+    harness = Harness(config, local_kvl, LabelStore(local_kvl))
+    harness.init()
+    harness.start()
+    harness.step('0', ['doc00', 900, 'doc01', 800])
+    harness.close()
+    with open(run_file_path) as fh:
+        lines = fh.readlines()
+    # the same size, so only reading it back finds the damage
+    lines[1] = lines[1].replace('\t', ' ', 1).replace(' ', '_', 1)
+    with open(run_file_path, 'wb') as fh:
+        fh.writelines(lines)
+
+    harness = Harness(config, local_kvl, LabelStore(local_kvl))
+    with pytest.raises(HarnessError) as exc:
+        harness.resume()
+    assert 'at line 2 (byte %d)' % len(lines[0]) in str(exc.value)
+
+
+def test_resume_concurrent(local_kvl, tmpdir, monkeypatch, state_config):
+    label_store = LabelStore(local_kvl)
+    run_file_path = str(tmpdir.join('run.txt'))
+    config = dict(run_file_path=run_file_path, batch_size=2,
+                  max_active_topics=2, checkpoint=True, **state_config)
+    harness = Harness(config, local_kvl, label_store)
+    harness.init()
+    harness.start()
+    harness.start()
+    harness.step('0', ['doc00', 900, 'doc01', 800])
+    harness.step('1', ['doc10', 900])
+    harness.step('0', ['doc02', 700])
+    # the topic reaches the run file, but the checkpoint does not
+    crash_once(monkeypatch, 'checkpoint_run')
+    with pytest.raises(RuntimeError):
+        harness.stop('1')
+    harness.close()
+
+    harness = Harness(config, local_kvl, label_store)
+    response = harness.resume()
+    assert response['num_topics'] == 3
+    assert [(topic['topic_id'], topic['iteration'])
+            for topic in response['topics']] == [('0', 2), ('1', 1)]
+    assert os.path.getsize(run_file_path) == 0
+    with pytest.raises(HarnessError):
+        harness.step('1', ['doc11', 900])
+    harness.stop('1')
+    harness.stop('0')
+    # a crash after the checkpoint only has to finish the `stop`, unless
+    # the state store undid the whole `stop`
+    assert harness.start()['topic_id'] == '2'
+    harness.step('2', ['doc20', 900])
+    crash_once(monkeypatch, 'remove_spools')
+    with pytest.raises(RuntimeError):
+        harness.stop('2')
+    harness.close()
+
+    harness = Harness(config, local_kvl, label_store)
+    response = harness.resume()
+    if state_config:
+        assert response['topics'][0]['topic_id'] == '2'
+        harness.stop('2')
+    else:
+        assert response == {'num_topics': 0, 'topics': []}
+    assert harness.start()['topic_id'] is None
+    harness.close()
+    with open(run_file_path) as fh:
+        assert [line.split('\t')[:3] for line in fh] == [
+            ['1', '0', 'doc10'], ['0', '0', 'doc00'], ['0', '0', 'doc01'],
+            ['0', '1', 'doc02'], ['2', '0', 'doc20']]
+    assert not [name for name in os.listdir(str(tmpdir))
+                if name.endswith('.spool')]
+
+
+def test_sqlite_state(tmpdir):
+    path = str(tmpdir.join('state.sqlite'))
+    state = SQLiteState(path)
+    state.put('seen', (('b', 'doc1'), '1'), (('a', 'doc2'), '0'),
+              (('a', 'doc1'), '2'), (('ab', 'doc1'), '3'))
+    assert list(state.scan_keys('seen')) == \
+        [('a', 'doc1'), ('a', 'doc2'), ('ab', 'doc1'), ('b', 'doc1')]
+    assert list(state.scan('seen', (('a',), ('a',)))) == \
+        [(('a', 'doc1'), '2'), (('a', 'doc2'), '0')]
+    assert list(state.get('seen', ('b', 'doc1'), ('c', 'doc1'))) == \
+        [(('b', 'doc1'), '1'), (('c', 'doc1'), None)]
+
+    # everything in a failed transaction is undone
+    with pytest.raises(HarnessError):
+        with state.transaction():
+            state.delete('seen', ('b', 'doc1'))
+            with state.transaction():
+                state.put('seq', (('a',), '1'))
+            raise HarnessError('step failed')
+    assert list(state.scan('seq')) == []
+    with state.transaction():
+        state.put('seq', (('a',), '1'))
+        state.clear_table('seen')
+    state.close()
+
+    state = SQLiteState(path)
+    assert list(state.scan('seq')) == [(('a',), '1')]
+    assert list(state.scan('seen')) == []
+
+
+def test_sqlite_state_batches_get(tmpdir, monkeypatch):
+    from .. import state as state_module
+    monkeypatch.setattr(state_module, 'GET_CHUNK', 3)
+    state = SQLiteState(str(tmpdir.join('state.sqlite')))
+    state.put('seen', *[(('a', 'doc%d' % idx), str(idx))
+                        for idx in xrange(0, 8, 2)])
+
+    class CountingConnection(object):
+        def __init__(self, conn):
+            self.conn = conn
+            self.statements = 0
+        def execute(self, *args):
+            self.statements += 1
+            return self.conn.execute(*args)
+    conn = state.conn = CountingConnection(state.conn)
+
+    keys = [('a', 'doc%d' % idx) for idx in reversed(xrange(8))]
+    expected = [(key, key[1][3:] if int(key[1][3:]) % 2 == 0 else None)
+                for key in keys]
+    assert state.get('seen', *keys) == expected
+    # one statement per chunk of keys, not one per key
+    assert conn.statements == 3
+    assert state.get('seen') == []
+    assert conn.statements == 3
+
+
+def test_runs_share_truth_data(local_kvl, tmpdir, state_config):
+    label_store = LabelStore(local_kvl)
+    config = dict(run_file_path=str(tmpdir.join('{run_id}.txt')),
+                  batch_size=2, **state_config)
+    harnesses = [Harness(dict(config, run_id=run_id), local_kvl, label_store)
+                 for run_id in ('nightly_a', 'nightly_b')]
+    for harness in harnesses:
+        assert harness.init() == {'num_topics': 3}
+    # the runs interleave, and submit the same documents
+    for topic_id in ['0', '1']:
+        for harness in harnesses:
+            assert harness.start()['topic_id'] == topic_id
+        for harness in harnesses:
+            harness.step(topic_id, ['doc%s0' % topic_id, 900,
+                                    'doc%s1' % topic_id, 800])
+        for harness in harnesses:
+            harness.step(topic_id, ['doc%s2' % topic_id, 700])
+            harness.stop(topic_id)
+    # starting over one run leaves the other alone
+    assert harnesses[0].init() == {'num_topics': 3}
+    assert harnesses[0].start()['topic_id'] == '0'
+    assert harnesses[1].start()['topic_id'] == '2'
+    for harness in harnesses:
+        harness.close()
+
+    with open(str(tmpdir.join('nightly_a.txt'))) as fh:
+        lines = fh.readlines()
+    assert len(lines) == 6
+    with open(str(tmpdir.join('nightly_b.txt'))) as fh:
+        assert fh.readlines() == lines
+
+    with pytest.raises(ValueError):
+        Harness(dict(config, run_id='bad-id'), local_kvl, label_store)
+
+
+def test_timings(local_kvl, tmpdir):
+    label_store = LabelStore(local_kvl)
+    timings_path = str(tmpdir.join('timings.jsonl'))
+    config = dict(run_file_path=str(tmpdir.join('runfile.txt')),
+                  timings_path=timings_path, run_id='timed')
+    harness = Harness(config, local_kvl, label_store)
+    harness.init()
+    topic_id = harness.start()['topic_id']
+    harness.step(topic_id, ['doc02', 244, 'doc01', 100])
+    # the response to `stop` stays as it was
+    assert harness.stop(topic_id) == {'finished': topic_id,
+                                      'num_remaining': 2}
+    harness.close()
+    harness.report_timings()
+
+    timings = harness.timings.to_dict()
+    for name in ['init', 'start', 'step', 'stop', 'close']:
+        assert timings[name]['count'] == 1
+    for name in ['seen_docs', 'label_lookup', 'run_file_write']:
+        assert timings[name]['count'] == 1
+    # the interaction sequence, and the checkpoint
+    assert timings['state_update']['count'] == 2
+    step = timings['step']
+    assert step['min'] <= step['p50'] <= step['max']
+    assert sum(step['buckets'].values()) == 1
+    assert step['total'] >= timings['label_lookup']['total']
+
+    with open(timings_path) as fh:
+        records = [json.loads(line) for line in fh]
+    assert len(records) == 1
+    assert records[0]['run_id'] == 'timed'
+    assert records[0]['timings'] == json.loads(json.dumps(timings))
+
+
+def test_init_reads_unindexed_truth_data(local_kvl):
+    label_store = LabelStore(local_kvl)
+    indexed = Harness(dict(), local_kvl, label_store)
+    indexed.init()
+    topic_id = indexed.start()['topic_id']
+    stream_ids = ['doc00', 'doc01', 'doc10', 'nope']
+    expected = indexed.lookup_feedback(topic_id, stream_ids)
+
+    # truth data loaded by an older harness, with no index
+    local_kvl.clear_table(TOPICS)
+    local_kvl.clear_table(FEEDBACK)
+    harness = Harness(dict(run_id='nightly_a'), local_kvl, label_store)
+    assert harness.init() == {'num_topics': 3}
+    assert harness.start()['topic_id'] == topic_id
+    assert harness.lookup_feedback(topic_id, stream_ids) == expected
+    assert not harness.truth_indexed
+    # the shared truth data index is left to `load`
+    assert list(local_kvl.scan(TOPICS)) == []
+    assert list(local_kvl.scan(FEEDBACK)) == []
+
+    label_store.delete_all()
+    with pytest.raises(HarnessError) as exc:
+        Harness(dict(), local_kvl, label_store).init()
+    assert 'trec_dd_harness load' in str(exc.value)
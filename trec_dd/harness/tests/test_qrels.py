@@ -0,0 +1,68 @@
+from __future__ import absolute_import
+
+from cStringIO import StringIO
+from dossier.label import LabelStore
+import kvlayer
+import os
+
+from ..qrels import qrels_from_label_store, qrels_from_truth_data, \
+    write_qrels, write_sharded_qrels
+from ..truth_data import parse_truth_data
+from .test_truth_data import truth_data_path
+
+
+def export(qrels, **kwargs):
+    fh = StringIO()
+    num_qrels = write_qrels(qrels, fh, **kwargs)
+    lines = fh.getvalue().splitlines()
+    assert num_qrels == len(lines)
+    return lines
+
+
+def test_qrels_sources_agree():
+    kvl = kvlayer.client(config={}, storage_type='local',
+                         namespace='test_qrels', app_name='test')
+    kvl.delete_namespace()
+    label_store = LabelStore(kvl)
+    parse_truth_data(label_store, truth_data_path)
+
+    lines = export(qrels_from_truth_data(truth_data_path), batch_size=3)
+    # the passages with an empty docno and empty text are dropped
+    assert len(lines) == 7
+    assert 'DD15-1\tDD15-1.1\t1421405887-0de7103ff270d313037c75fd9d265ea8' \
+        '\t101\t3' in lines
+    assert sorted(lines) == sorted(export(qrels_from_label_store(label_store)))
+
+
+def test_sharded_qrels(tmpdir):
+    shard_dir = str(tmpdir.join('shards'))
+    counts = write_sharded_qrels(qrels_from_truth_data(truth_data_path),
+                                 shard_dir)
+    assert sorted(os.listdir(shard_dir)) == \
+        ['DD15-1.qrels', 'DD15-2.qrels', 'DD15-3.qrels']
+    lines = []
+    for topic_id, count in counts.iteritems():
+        with open(os.path.join(shard_dir, topic_id + '.qrels')) as fh:
+            shard = fh.read().splitlines()
+        assert len(shard) == count
+        assert all(line.startswith(topic_id + '\t') for line in shard)
+        lines.extend(shard)
+    assert sorted(lines) == \
+        sorted(export(qrels_from_truth_data(truth_data_path)))
+
+
+def test_qrels_from_truth_data_frees_elements(monkeypatch):
+    from .. import qrels
+    parsers = []
+    iterparse = qrels.etree.iterparse
+    def recording_iterparse(*args, **kwargs):
+        parsers.append(iterparse(*args, **kwargs))
+        return parsers[-1]
+    monkeypatch.setattr(qrels.etree, 'iterparse', recording_iterparse)
+
+    assert len(list(qrels_from_truth_data(truth_data_path))) == 7
+    # every domain, topic, subtopic and passage was cleared and removed
+    # but the last, so nothing but that empty last domain is left
+    root = parsers[0].root
+    assert len(root) == 1
+    assert len(root[0]) == 0
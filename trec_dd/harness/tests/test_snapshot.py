@@ -0,0 +1,47 @@
+from __future__ import absolute_import
+
+from dossier.label import LabelStore
+import kvlayer
+import os
+
+from trec_dd.utils import get_all_subtopics
+from trec_dd.utils.snapshot import TruthSnapshot, compile_snapshot
+from ..run import Harness, load_truth_data
+from .test_truth_data import truth_data_path
+
+
+def test_snapshot_matches_label_store(tmpdir):
+    kvl = kvlayer.client(config={}, storage_type='local',
+                         namespace='test_snapshot', app_name='test')
+    kvl.delete_namespace()
+    label_store = LabelStore(kvl)
+    load_truth_data(kvl, label_store, truth_data_path)
+    snapshot_path = os.path.join(str(tmpdir), 'truth.snapshot')
+    assert compile_snapshot(label_store, snapshot_path) == 7
+    snapshot = TruthSnapshot(snapshot_path)
+
+    harness = Harness(dict(), kvl, label_store)
+    harness.init()
+    topics = dict((l.meta['topic_id'], l.meta['topic_name'])
+                  for l in label_store.everything())
+    assert snapshot.topics() == topics
+
+    for topic_id in sorted(topics) + ['no-such-topic']:
+        assert sorted(snapshot.all_subtopics(topic_id)) == \
+            sorted(set(get_all_subtopics(label_store, topic_id)))
+        doc_ids = set(l.other(topic_id)
+                      for l in label_store.directly_connected(topic_id))
+        assert set(snapshot.doc_ids(topic_id)) == doc_ids
+        doc_ids = sorted(doc_ids) + ['no-such-doc']
+        assert [snapshot.feedback(topic_id, doc_id) for doc_id in doc_ids] \
+            == harness.lookup_feedback(topic_id, doc_ids)
+
+    # a harness reading the snapshot gives the same answers
+    snapshot_harness = Harness(dict(truth_snapshot_path=snapshot_path),
+                               kvl, label_store)
+    assert snapshot_harness.init() == {'num_topics': 3}
+    topic_id = snapshot_harness.start()['topic_id']
+    feedback = snapshot_harness.step(
+        topic_id, ['1421405887-0de7103ff270d313037c75fd9d265ea8', 10])
+    assert [s['subtopic_id'] for s in feedback[0]['subtopics']] == \
+        ['DD15-1.1', 'DD15-1.2']
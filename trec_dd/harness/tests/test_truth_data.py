@@ -0,0 +1,110 @@
+from __future__ import absolute_import
+
+from bs4 import BeautifulSoup
+from dossier.label import LabelStore
+import kvlayer
+import os
+
+from ..truth_data import iter_passages, iter_topic_ranges, \
+    labels_from_topic_range, parse_passage, parse_truth_data
+
+truth_data_path = os.path.join(os.path.dirname(__file__), 'truth_data.xml')
+
+
+def test_iter_passages_matches_beautifulsoup():
+    soup = BeautifulSoup(open(truth_data_path), 'xml')
+    expected = [parse_passage(p) for p in soup.find_all('passage')]
+    assert list(iter_passages(truth_data_path)) == expected
+
+
+def test_parse_truth_data():
+    kvl = kvlayer.client(config={}, storage_type='local',
+                         namespace='test_truth_data', app_name='test')
+    kvl.delete_namespace()
+    label_store = LabelStore(kvl)
+    parse_truth_data(label_store, truth_data_path, batch_size=3)
+
+    labels = list(label_store.everything())
+    # the passages with an empty docno and empty text are dropped
+    assert len(labels) == 7
+    by_passage = dict((l.subtopic_for(l.meta['topic_id']), l)
+                      for l in labels if l.meta['topic_id'] == 'DD15-2')
+    assert by_passage.keys() == ['DD15-2.1']
+    label = by_passage['DD15-2.1']
+    assert label.meta['passage_text'] == 'Clinics in Freetown.'
+    assert label.rating == 1
+
+
+def test_parse_truth_data_parallel():
+    kvl = kvlayer.client(config={}, storage_type='local',
+                         namespace='test_truth_data', app_name='test')
+    kvl.delete_namespace()
+    label_store = LabelStore(kvl)
+    num_labels = parse_truth_data(label_store, truth_data_path,
+                                  batch_size=2, workers=2)
+    assert num_labels == 7
+
+    def key(label):
+        d = label.as_dict()
+        d.pop('epoch_ticks')
+        return sorted(d.items())
+
+    parallel = sorted(map(key, label_store.everything()))
+    label_store.delete_all()
+    parse_truth_data(label_store, truth_data_path)
+    serial = sorted(map(key, label_store.everything()))
+    assert parallel == serial
+
+
+def test_iter_topic_ranges(tmpdir):
+    path = str(tmpdir.join('truth.xml'))
+    with open(path, 'w') as fh:
+        fh.write('<trecdd><!-- <topic id="no"> -->\n'
+                 '<domain id="1" name="caf&#233;">'
+                 '<topic id="T1" name="one"><subtopic id="T1.1" name="s">'
+                 '<passage id="1"><docno>d1</docno><rating>2</rating>'
+                 '<text><![CDATA[not a </topic> tag]]></text></passage>'
+                 '</subtopic></topic></domain></trecdd>')
+    [chunk] = list(iter_topic_ranges(path))
+    assert chunk[1:3] == ('1', 'caf\xc3\xa9')
+    [label] = labels_from_topic_range(chunk)
+    assert label.meta['topic_id'] == 'T1'
+    assert label.meta['domain_name'] == 'caf\xc3\xa9'
+    assert label.meta['passage_text'] == 'not a </topic> tag'
+
+
+def test_parse_truth_data_parallel_bounds_pending_topics(monkeypatch):
+    from .. import truth_data
+
+    class FakePool(object):
+        '''Runs each task when its result is collected, and records how
+        many were handed over but not yet collected.'''
+        def __init__(self, workers):
+            self.pending = 0
+            self.max_pending = 0
+            pools.append(self)
+        def apply_async(self, func, args):
+            pool = self
+            pool.pending += 1
+            pool.max_pending = max(pool.max_pending, pool.pending)
+            class Result(object):
+                def get(self):
+                    pool.pending -= 1
+                    return func(*args)
+            return Result()
+        def terminate(self):
+            pass
+        def join(self):
+            pass
+    pools = []
+    monkeypatch.setattr(truth_data.multiprocessing, 'Pool', FakePool)
+
+    kvl = kvlayer.client(config={}, storage_type='local',
+                         namespace='test_truth_data', app_name='test')
+    kvl.delete_namespace()
+    label_store = LabelStore(kvl)
+    assert truth_data.parse_truth_data_parallel(
+        label_store, truth_data_path, 2, batch_size=2,
+        max_pending_topics=2) == 7
+    assert len(list(iter_topic_ranges(truth_data_path))) == 3
+    assert pools[0].max_pending == 2
@@ -8,10 +8,20 @@ truth data the harness understands.
 
 from __future__ import absolute_import
 import argparse
+from collections import deque
+from cStringIO import StringIO
 import json
 from bs4 import BeautifulSoup
 import logging
+import mmap
+import multiprocessing
+import os
+import Queue
+import re
 import sys
+import threading
+
+from lxml import etree
 
 from dossier.label import Label, LabelStore, CorefValue
 import kvlayer
@@ -39,7 +49,135 @@ def parse_passage(p):
     line_data['docno'] = p.docno.text.encode('utf-8')
     line_data['grade'] = p.rating.text.encode('utf-8')
     return line_data
-    
+
+def _utf8(text):
+    '''lxml hands back str for ASCII and unicode otherwise.'''
+    if text is None:
+        return ''
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+def _soup_string(text):
+    '''BeautifulSoup collapses whitespace-only strings to one character.'''
+    if not text or text.strip():
+        return text
+    elif '\n' in text:
+        return '\n'
+    else:
+        return ' '
+
+def _child_text(elem, tag):
+    '''Text of the first descendant of `elem` named `tag`, like
+    BeautifulSoup's `elem.tag.text`.
+    '''
+    for child in elem.iter(tag):
+        return _utf8(''.join(map(_soup_string, child.itertext())))
+    raise AttributeError('passage %r has no <%s>' % (elem.get('id'), tag))
+
+def iter_passages(truth_data_path, context=None):
+    '''Stream line_data dicts, as from :func:`parse_passage`, out of the
+    truth data XML file at `truth_data_path`.
+
+    This uses :func:`lxml.etree.iterparse` and throws away each passage
+    once it has been converted, so memory use does not grow with the
+    size of the file.  The enclosing domain, topic and subtopic are
+    tracked on a stack as their start tags go by; `context` seeds that
+    stack with (id, name) pairs when parsing a fragment of the file.
+    '''
+    context = list(context or [])
+    events = etree.iterparse(truth_data_path, events=('start', 'end'),
+                             remove_comments=True)
+    for event, elem in events:
+        tag = etree.QName(elem).localname
+        if event == 'start':
+            if tag in ('domain', 'topic', 'subtopic'):
+                context.append((_utf8(elem.get('id')),
+                                _utf8(elem.get('name'))))
+            continue
+
+        if tag == 'passage':
+            (domain_id, domain_name), (topic_id, topic_name), \
+                (subtopic_id, subtopic_name) = context[-3:]
+            line_data = {}
+            line_data['domain_id'] = domain_id
+            line_data['domain_name'] = domain_name
+            line_data['userid'] = 'dropped'
+            line_data['username'] = 'dropped'
+            line_data['topic_id'] = topic_id
+            line_data['topic_name'] = topic_name
+            line_data['subtopic_id'] = subtopic_id
+            line_data['subtopic_name'] = subtopic_name
+            line_data['passage_id'] = _utf8(elem.get('id'))
+            line_data['passage_name'] = _child_text(elem, 'text')
+            line_data['docno'] = _child_text(elem, 'docno')
+            line_data['grade'] = _child_text(elem, 'rating')
+            yield line_data
+        elif tag in ('domain', 'topic', 'subtopic'):
+            context.pop()
+        else:
+            # children of a passage are needed until the passage ends
+            continue
+
+        # free the finished element and anything before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+# the tags that split the file by topic, and the comments and CDATA
+# sections that might look like them
+_TOPIC_SPLIT_RE = re.compile(
+    r'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<(/?)(domain|topic)\b[^>]*>', re.S)
+
+
+def iter_topic_ranges(truth_data_path):
+    '''Split the truth data XML file into one byte range per topic.
+
+    Yields ``(truth_data_path, domain_id, domain_name, start, end)``
+    tuples, where the ``<topic>`` element is bytes `start` to `end` of
+    the file, suitable for :func:`labels_from_topic_range` in another
+    process.  This scans the raw bytes for the domain and topic tags,
+    skipping comments and CDATA, instead of parsing the file, so each
+    topic is parsed once, by the process that converts it.  Like the
+    truth data as distributed, the file must be UTF-8.
+    '''
+    if os.path.getsize(truth_data_path) == 0:
+        return
+    with open(truth_data_path, 'rb') as fh:
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            domain = (None, None)
+            start = None
+            for match in _TOPIC_SPLIT_RE.finditer(data):
+                closing, tag = match.group(1), match.group(2)
+                if tag == 'domain' and not closing:
+                    elem = etree.fromstring(match.group(0) + '</domain>')
+                    domain = (_utf8(elem.get('id')), _utf8(elem.get('name')))
+                elif tag == 'topic':
+                    if not closing:
+                        start = match.start()
+                    elif start is not None:
+                        yield (truth_data_path,) + domain + \
+                            (start, match.end())
+                        start = None
+        finally:
+            data.close()
+
+def labels_from_topic_range(chunk):
+    '''Convert one topic from :func:`iter_topic_ranges` into labels.
+    '''
+    truth_data_path, domain_id, domain_name, start, end = chunk
+    with open(truth_data_path, 'rb') as fh:
+        fh.seek(start)
+        topic_xml = fh.read(end - start)
+    labels = []
+    for line_data in iter_passages(StringIO(topic_xml),
+                                   context=[(domain_id, domain_name)]):
+        label = label_from_truth_data_file_line(line_data)
+        if label is not None:
+            labels.append(label)
+    return labels
+
 def make_full_doc_id(doc_id, offset_start, offset_end):
     '''A full doc_id is of the form: doc_id#offset_start,offset_end
     '''
@@ -104,14 +242,19 @@ def label_from_truth_data_file_line(line_data):
                   rating=rating, meta=meta)
     return label
 
-def parse_truth_data(label_store, truth_data_path, batch_size=10000):
-    data_file = open(truth_data_path, 'r')
-    data = BeautifulSoup(data_file, 'xml')
+def parse_truth_data(label_store, truth_data_path, batch_size=10000,
+                     workers=1):
+    '''Load the truth data XML file into `label_store`.
 
+    With more than one worker, this hands off to
+    :func:`parse_truth_data_parallel`.
+    '''
+    if workers > 1:
+        return parse_truth_data_parallel(label_store, truth_data_path,
+                                         workers, batch_size=batch_size)
     labels_to_put = []
     num_labels = 0
-    for psg in data.find_all('passage'):
-        line_data = parse_passage(psg)
+    for line_data in iter_passages(truth_data_path):
         label = label_from_truth_data_file_line(line_data)
         if label is not None:
             labels_to_put.append(label)
@@ -123,18 +266,93 @@ def parse_truth_data(label_store, truth_data_path, batch_size=10000):
                 labels_to_put = []
     if len(labels_to_put) > 0:
         label_store.put(*labels_to_put)
+    return num_labels
+
+def parse_truth_data_parallel(label_store, truth_data_path, workers,
+                              batch_size=10000, max_pending_batches=4,
+                              max_pending_topics=None):
+    '''Load the truth data XML file into `label_store` using a pipeline.
+
+    The file is split by topic (:func:`iter_topic_ranges`), a pool of
+    `workers` processes turns topics into labels, and a single writer
+    thread puts batches of labels into `label_store`.  At most
+    `max_pending_topics`, by default twice `workers`, are handed to
+    the pool before their labels are collected, and batches wait for
+    the writer in a queue of at most `max_pending_batches`, so neither
+    a large file nor a slow backend fills memory.
+    '''
+    if max_pending_topics is None:
+        max_pending_topics = 2 * workers
+    batches = Queue.Queue(maxsize=max_pending_batches)
+    failures = []
+
+    def writer():
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            if failures:
+                # keep draining so the producer never blocks forever
+                continue
+            try:
+                label_store.put(*batch)
+            except Exception, exc:
+                logger.critical('failed to write labels', exc_info=True)
+                failures.append(exc)
+
+    writer_thread = threading.Thread(target=writer, name='label-writer')
+    writer_thread.daemon = True
+    writer_thread.start()
+
+    pool = multiprocessing.Pool(workers)
+    labels_to_put = []
+    num_labels = 0
+    # topics handed to the pool, in file order
+    pending = deque()
+    topics = iter_topic_ranges(truth_data_path)
+    try:
+        while not failures:
+            for chunk in topics:
+                pending.append(
+                    pool.apply_async(labels_from_topic_range, (chunk,)))
+                if len(pending) >= max_pending_topics:
+                    break
+            if not pending:
+                break
+            labels = pending.popleft().get()
+            labels_to_put.extend(labels)
+            num_labels += len(labels)
+            if len(labels_to_put) >= batch_size:
+                logger.debug('Converted %d labels.', num_labels)
+                batches.put(labels_to_put)
+                labels_to_put = []
+        if labels_to_put and not failures:
+            batches.put(labels_to_put)
+    finally:
+        pool.terminate()
+        pool.join()
+        batches.put(None)
+        writer_thread.join()
+    if failures:
+        raise failures[0]
+    return num_labels
 
 def main():
     parser = argparse.ArgumentParser('test tool for checking that we can load '
                                      'the truth data as distributed by NIST for '
                                      'TREC 2015')
     parser.add_argument('truth_data_path', help='path to truth data file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes converting passages')
     modules = [yakonfig, kvlayer]
     args = yakonfig.parse_args(parser, modules)
     logging.basicConfig(level=logging.DEBUG)
+    # imported here because trec_dd.harness.run imports this module
+    from trec_dd.harness.run import load_truth_data
     kvl = kvlayer.client()
     label_store = LabelStore(kvl)
-    parse_truth_data(label_store, args.truth_data_path)
+    load_truth_data(kvl, label_store, args.truth_data_path,
+                    workers=args.workers)
     logger.debug('Done!  The truth data was loaded into this kvlayer backend: %r',
                  json.dumps(yakonfig.get_global_config('kvlayer'), indent=4,
                             sort_keys=True))
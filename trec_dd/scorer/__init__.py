@@ -5,6 +5,7 @@ from trec_dd.scorer.reciprocal_rank_at_recall import reciprocal_rank_at_recall
 from trec_dd.scorer.precision_at_recall import precision_at_recall
 from trec_dd.scorer.modified_precision_at_recall import modified_precision_at_recall
 from trec_dd.scorer.average_err import average_err
+from trec_dd.scorer.cube_test import cube_test, average_cube_test
 
 
 def average_err_harmonic(run, label_store):
@@ -30,5 +31,11 @@ available_scorers = {
     'average_err_arithmetic': average_err_arithmetic,
     'average_err_harmonic': average_err_harmonic,
     'average_err_arithmetic_binary': average_err_arithmetic_binary,
-    'average_err_harmonic_binary': average_err_harmonic_binary
+    'average_err_harmonic_binary': average_err_harmonic_binary,
+    'cube_test': cube_test,
+    'average_cube_test': average_cube_test,
 }
+
+#: scorers whose score for one topic depends on the other topics of
+#: the run, so they must see the whole run at once
+whole_run_scorers = set(['cube_test', 'average_cube_test'])
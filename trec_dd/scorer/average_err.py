@@ -89,6 +89,8 @@ def average_err(run, label_store, mean_type='arithmetic', relevance_metric='grad
     macro_avg = mean(scores_by_topic.values())
 
     scorer_name = 'average_err_%s' % mean_type
+    if relevance_metric != 'graded':
+        scorer_name += '_%s' % relevance_metric
 
     run['scores'][scorer_name] = \
         {'scores_by_topic': scores_by_topic, 'macro_average': macro_avg}
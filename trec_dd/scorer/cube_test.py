@@ -0,0 +1,168 @@
+'''trec_dd.scorer.cube_test provides the Cube Test scores of
+``bin/cubeTest_v3.pl``.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+
+Each subtopic of a topic is a column of a cube with base area
+``1 / num_subtopics`` and height `max_height`.  A document pours
+water into the columns of the subtopics it is judged relevant for:
+``gamma ** n * qrel`` into a subtopic's column for the ``n``-th
+document of the run to cover it, times `beta`, until the column is
+full.  A document's qrel for a subtopic is the sum of its passage
+ratings, sorted in descending order, each divided by ``log2(rank +
+1)``; ratings of zero count as one, and negative labels are left out.
+
+``cube_test`` is the water poured in by the documents of iterations
+up to `cutoff`, as a fraction of the cube's volume, divided by the
+number of those iterations.  ``average_cube_test`` averages the same
+ratio over every one of those documents, as if the run had stopped
+right after it.  Iterations are counted from one, and no further than
+the last iteration of the whole run.  Topics with no judgments are
+not scored.
+
+Since the water a subtopic's column holds only depends on the
+documents covering that subtopic, each topic's gains come out of
+cumulative sums over a (document x subtopic) matrix when numpy is
+installed.
+'''
+
+from __future__ import absolute_import, division
+from collections import defaultdict
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from trec_dd.scorer.average_err import mean
+from trec_dd.utils import get_topic_qrels
+
+#: the defaults of ``bin/cubeTest_v3.pl``
+MAX_HEIGHT = 5
+GAMMA = 0.5
+BETA = 1
+CUTOFF = 10
+
+
+def discounted_qrels(topic_qrels):
+    '''Turn the passage ratings in `topic_qrels`, as returned by
+    :func:`trec_dd.utils.get_topic_qrels`, into one qrel per
+    (doc_id, subtopic_id).
+    '''
+    qrels = {}
+    for doc_id, subtopics in topic_qrels.iteritems():
+        qrels[doc_id] = {}
+        for subtopic_id, ratings in subtopics.iteritems():
+            ratings = sorted((rating or 1 for rating in ratings),
+                             reverse=True)
+            qrels[doc_id][subtopic_id] = sum(
+                rating / math.log(rank + 2, 2)
+                for rank, rating in enumerate(ratings))
+    return qrels
+
+
+def document_gains(doc_ids, qrels, max_height=MAX_HEIGHT, gamma=GAMMA,
+                   beta=BETA):
+    '''Return the water each of `doc_ids` pours into the cube, in
+    order, given the topic's `qrels` from :func:`discounted_qrels`.
+    '''
+    subtopic_ids = sorted(set(subtopic_id for subtopics in qrels.values()
+                              for subtopic_id in subtopics))
+    if not subtopic_ids:
+        return [0.0] * len(doc_ids)
+    area = 1 / len(subtopic_ids)
+
+    if np is None:
+        heights = defaultdict(float)
+        cover = defaultdict(int)
+        gains = []
+        for doc_id in doc_ids:
+            gain = 0.0
+            for subtopic_id, qrel in qrels.get(doc_id, {}).iteritems():
+                cover[subtopic_id] += 1
+                if heights[subtopic_id] < max_height:
+                    height = min(gamma ** cover[subtopic_id] * qrel,
+                                 max_height - heights[subtopic_id])
+                    heights[subtopic_id] += height
+                    gain += beta * area * height
+            gains.append(gain)
+        return gains
+
+    columns = dict((subtopic_id, idx)
+                   for idx, subtopic_id in enumerate(subtopic_ids))
+    qrel_matrix = np.zeros((len(doc_ids), len(subtopic_ids)))
+    for row, doc_id in enumerate(doc_ids):
+        for subtopic_id, qrel in qrels.get(doc_id, {}).iteritems():
+            qrel_matrix[row, columns[subtopic_id]] = qrel
+    # how many documents so far have covered each subtopic
+    cover = np.cumsum(qrel_matrix > 0, axis=0)
+    poured = gamma ** cover * qrel_matrix
+    # the water in each column, which stops rising once it is full
+    filled = np.minimum(np.cumsum(poured, axis=0), max_height)
+    heights = np.diff(np.vstack([np.zeros((1, len(subtopic_ids))), filled]),
+                      axis=0)
+    return list(beta * area * heights.sum(axis=1))
+
+
+def cube_test_scores(run, label_store, cutoff=CUTOFF,
+                     max_height=MAX_HEIGHT, gamma=GAMMA, beta=BETA):
+    '''Return `(cube_test, average_cube_test)`, each a dict mapping
+    every judged topic_id in `run` to its score.
+    '''
+    max_iteration = max([result['iteration'] + 1
+                         for results in run['results'].values()
+                         for result in results] or [0])
+
+    cube_test = {}
+    average_cube_test = {}
+    for topic_id, results in run['results'].items():
+        qrels = discounted_qrels(get_topic_qrels(label_store, topic_id))
+        if not qrels or not results:
+            continue
+        iterations = []
+        for result in results:
+            if result['iteration'] + 1 > cutoff:
+                break
+            iterations.append(result['iteration'] + 1)
+        gains = document_gains([result['stream_id']
+                                for result in results[:len(iterations)]],
+                               qrels, max_height, gamma, beta)
+
+        total = 0.0
+        ratios = []
+        for iteration, gain in zip(iterations, gains):
+            total += gain
+            ratios.append(total / max_height /
+                          min(iteration, max_iteration))
+        cube_test[topic_id] = \
+            total / max_height / min(cutoff, max_iteration)
+        average_cube_test[topic_id] = mean(ratios)
+    return cube_test, average_cube_test
+
+
+def cube_test(run, label_store, cutoff=CUTOFF, max_height=MAX_HEIGHT,
+              gamma=GAMMA, beta=BETA):
+    '''Add the ``ct@cutoff`` score of ``bin/cubeTest_v3.pl`` to
+    ``run['scores']``.
+    '''
+    scores_by_topic, _ = cube_test_scores(run, label_store, cutoff,
+                                          max_height, gamma, beta)
+    run['scores']['cube_test'] = {
+        'scores_by_topic': scores_by_topic,
+        'macro_average': mean(scores_by_topic.values()),
+    }
+
+
+def average_cube_test(run, label_store, cutoff=CUTOFF,
+                      max_height=MAX_HEIGHT, gamma=GAMMA, beta=BETA):
+    '''Add the ``avg_ct@cutoff`` score of ``bin/cubeTest_v3.pl`` to
+    ``run['scores']``.
+    '''
+    _, scores_by_topic = cube_test_scores(run, label_store, cutoff,
+                                          max_height, gamma, beta)
+    run['scores']['average_cube_test'] = {
+        'scores_by_topic': scores_by_topic,
+        'macro_average': mean(scores_by_topic.values()),
+    }
@@ -0,0 +1,270 @@
+'''trec_dd.scorer.engine computes every TREC DD score in one pass
+over each topic's results.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+
+Each function in :data:`trec_dd.scorer.available_scorers` walks the
+whole run on its own and picks the best rating of every subtopic in
+every result again.  :class:`TopicScorer` keeps the running state of
+all of them at once, so :func:`score_run` looks at each result once
+and stops as soon as none of the requested scores can change.  The
+scores it writes into ``run['scores']`` are the same as the per-scorer
+functions produce.
+'''
+
+from __future__ import absolute_import, division
+
+from trec_dd.scorer.average_err import mean, harmonic_mean, relevance_metrics
+from trec_dd.utils import get_all_subtopics
+
+#: scorer name -> (relevance metric, mean type) for the ERR scores
+err_scorers = {
+    'average_err_arithmetic': ('graded', 'arithmetic'),
+    'average_err_harmonic': ('graded', 'harmonic'),
+    'average_err_arithmetic_binary': ('binary', 'arithmetic'),
+    'average_err_harmonic_binary': ('binary', 'harmonic'),
+}
+
+#: scores that only look at results up to full subtopic recall
+recall_scorers = set([
+    'reciprocal_rank_at_recall',
+    'precision_at_recall',
+    'modified_precision_at_recall',
+])
+
+#: every scorer name the engine can compute
+fused_scorers = recall_scorers | set(err_scorers)
+
+
+class TopicScorer(object):
+    '''Running state of every fused score for one topic.
+
+    Feed the topic's results to :meth:`update` in rank order, then
+    call :meth:`finalize` for the scores.  Once :attr:`done` is true,
+    further results cannot change any of the requested scores.
+
+    `subtopic_ids` are all of the topic's subtopics, as returned by
+    :func:`trec_dd.utils.get_all_subtopics`, and `scorer_names`
+    limits the state kept to what those scores need.
+    '''
+
+    def __init__(self, subtopic_ids, scorer_names=None):
+        if scorer_names is None:
+            scorer_names = fused_scorers
+        self.scorer_names = [name for name in scorer_names
+                             if name in fused_scorers]
+        self.num_subtopics = len(set(subtopic_ids))
+        self.num_results = 0
+
+        self.want_recall = any(name in recall_scorers
+                               for name in self.scorer_names)
+        #: rank at which every subtopic has been seen, if it was
+        self.recall_rank = None
+        self.seen_subtopics = set()
+        self.relevant_docs = 0
+        self.modified_relevant_docs = 0
+
+        #: relevance metric -> (relevance function, p_continue, err)
+        self.err = {}
+        for name in self.scorer_names:
+            if name in err_scorers:
+                metric = err_scorers[name][0]
+                self.err[metric] = (relevance_metrics[metric], {}, {})
+
+    @property
+    def done(self):
+        return not self.err and \
+            (self.recall_rank is not None or not self.want_recall)
+
+    def update(self, result):
+        '''Account for the next `result` of the topic.'''
+        assert self.num_results == result['rank'] - 1
+        self.num_results += 1
+        # the same best rating per subtopic as get_best_subtopics
+        best = {}
+        for subtopic, conf in result['subtopics']:
+            if subtopic not in best or conf > best[subtopic]:
+                best[subtopic] = conf
+
+        if self.want_recall and self.recall_rank is None:
+            if best:
+                new = sum(1 for subtopic in best
+                          if subtopic not in self.seen_subtopics)
+                self.modified_relevant_docs += new / len(best)
+                self.seen_subtopics.update(best)
+            if result['on_topic']:
+                self.relevant_docs += 1
+            if len(self.seen_subtopics) == self.num_subtopics:
+                self.recall_rank = self.num_results
+
+        rank = self.num_results
+        for relevance_func, p_continue, err in self.err.itervalues():
+            for subtopic, conf in best.iteritems():
+                rel = relevance_func(conf)
+                p = p_continue.get(subtopic, 1)
+                err[subtopic] = err.get(subtopic, 0.0) + p * rel / rank
+                p_continue[subtopic] = p * (1 - rel)
+
+    def finalize(self):
+        '''Return a dict of scorer name to this topic's score.'''
+        # without full recall, the recall scores cover every result
+        cutoff = self.recall_rank or self.num_results
+        scores = {}
+        for name in self.scorer_names:
+            if name in err_scorers:
+                metric, mean_type = err_scorers[name]
+                values = self.err[metric][2].values()
+                if mean_type == 'arithmetic':
+                    scores[name] = mean(values)
+                else:
+                    scores[name] = harmonic_mean(values)
+            elif cutoff == 0:
+                scores[name] = 0.0
+            elif name == 'reciprocal_rank_at_recall':
+                scores[name] = 1 / cutoff
+            elif name == 'precision_at_recall':
+                scores[name] = self.relevant_docs / cutoff
+            elif name == 'modified_precision_at_recall':
+                scores[name] = self.modified_relevant_docs / cutoff
+        return scores
+
+
+class IncrementalScorer(object):
+    '''Running fused scores of a run while it is being written.
+
+    Feed the feedback :meth:`trec_dd.harness.run.Harness.step` returns
+    to :meth:`update`, and call :meth:`stop` when each topic ends.
+    Each step only costs work in proportion to its results, so a
+    simulation's scores can be watched as it goes, without reading
+    the run file.  Once every topic has been stopped, :meth:`scores`
+    matches what :func:`score_run` computes for the run file.
+    '''
+
+    def __init__(self, label_store, scorer_names=None):
+        if scorer_names is None:
+            scorer_names = fused_scorers
+        self.label_store = label_store
+        self.scorer_names = sorted(name for name in scorer_names
+                                   if name in fused_scorers)
+        self.reset()
+
+    def reset(self):
+        '''Forget every topic.'''
+        #: topic_ids in the order their first results arrived
+        self.topic_ids = []
+        #: topic_id -> TopicScorer of each topic not stopped yet
+        self.active = {}
+        #: topic_id -> final scores of each stopped topic
+        self.finished = {}
+
+    def update(self, topic_id, feedback):
+        '''Account for the next step of `topic_id`, whose `feedback`
+        is a list of dicts as returned by ``Harness.step``.
+        '''
+        self.add_results(topic_id, [{
+            'on_topic': entry['on_topic'],
+            'subtopics': [(subtopic['subtopic_id'], subtopic['rating'])
+                          for subtopic in entry['subtopics']],
+        } for entry in feedback])
+
+    def add_results(self, topic_id, results):
+        '''Account for more `results` of `topic_id`, each with
+        ``on_topic`` and ``subtopics`` like a
+        :class:`~trec_dd.utils.runfile.Result`.
+        '''
+        if not results:
+            return
+        scorer = self.active.get(topic_id)
+        if scorer is None:
+            scorer = TopicScorer(get_all_subtopics(self.label_store,
+                                                   topic_id),
+                                 self.scorer_names)
+            self.active[topic_id] = scorer
+            if topic_id not in self.finished:
+                self.topic_ids.append(topic_id)
+        for result in results:
+            if scorer.done:
+                break
+            scorer.update({
+                'rank': scorer.num_results + 1,
+                'on_topic': result['on_topic'],
+                'subtopics': result['subtopics'],
+            })
+
+    def stop(self, topic_id):
+        '''Finalize the scores of `topic_id`.'''
+        scorer = self.active.pop(topic_id, None)
+        if scorer is not None:
+            self.finished[topic_id] = scorer.finalize()
+
+    def topic_scores(self, topic_id):
+        '''Return a dict of scorer name to the score of `topic_id` so
+        far, or None if it has no results yet.
+        '''
+        if topic_id in self.active:
+            return self.active[topic_id].finalize()
+        return self.finished.get(topic_id)
+
+    def scores(self, topic_ids=None):
+        '''Return the scores so far of `topic_ids`, by default every
+        topic with results, in the form of ``run['scores']``.
+        '''
+        if topic_ids is None:
+            topic_ids = self.topic_ids
+        scores_by_topic = dict((name, {}) for name in self.scorer_names)
+        for topic_id in topic_ids:
+            topic_scores = self.topic_scores(topic_id)
+            if topic_scores is None:
+                continue
+            for name, score in topic_scores.iteritems():
+                scores_by_topic[name][topic_id] = score
+        return dict((name, {
+            'scores_by_topic': scores_by_topic[name],
+            'macro_average': mean(scores_by_topic[name].values()),
+        }) for name in self.scorer_names)
+
+
+def score_topics(topics, label_store, scorer_names):
+    '''Compute the `scorer_names` scores of `topics`, an iterable of
+    `(topic_id, results)` pairs such as :func:`trec_dd.scorer.run.iter_run`
+    yields, and return them in the form of ``run['scores']``.
+
+    All of `scorer_names` must be in :data:`fused_scorers`.
+    '''
+    scores_by_topic = dict((name, {}) for name in scorer_names)
+    for topic_id, results in topics:
+        scorer = TopicScorer(get_all_subtopics(label_store, topic_id),
+                             scorer_names)
+        for result in results:
+            if scorer.done:
+                break
+            scorer.update(result)
+        for name, score in scorer.finalize().iteritems():
+            scores_by_topic[name][topic_id] = score
+
+    return dict((name, {
+        'scores_by_topic': scores_by_topic[name],
+        'macro_average': mean(scores_by_topic[name].values()),
+    }) for name in scorer_names)
+
+
+def score_run(run, label_store, scorer_names, scorers=None):
+    '''Add the `scorer_names` scores to ``run['scores']``.
+
+    This is a drop-in replacement for calling each scorer in
+    :data:`trec_dd.scorer.available_scorers` on `run`.  Scorers the
+    engine does not know are still run on their own, looked up in
+    `scorers` if it is given.
+    '''
+    if scorers is None:
+        from trec_dd.scorer import available_scorers as scorers
+
+    fused = [name for name in scorer_names if name in fused_scorers]
+    if fused:
+        run['scores'].update(score_topics(run['results'].items(),
+                                          label_store, fused))
+
+    for name in scorer_names:
+        if name not in fused_scorers:
+            scorers[name](run, label_store)
@@ -10,14 +10,24 @@ from __future__ import absolute_import, print_function, division
 import argparse
 from dossier.label import LabelStore
 from collections import defaultdict
+from functools import partial
+import glob
 import json
 import kvlayer
 import logging
+import multiprocessing
 import os
 import sys
 import yakonfig
 
-from trec_dd.scorer import available_scorers
+from trec_dd.scorer import available_scorers, whole_run_scorers
+from trec_dd.scorer import engine, vectorized
+from trec_dd.scorer.average_err import mean
+from trec_dd.scorer.cube_test import BETA, CUTOFF, GAMMA, MAX_HEIGHT, \
+    average_cube_test, cube_test
+from trec_dd.utils import SubtopicUniverse
+from trec_dd.utils.runfile import iter_run, json_default
+from trec_dd.utils.snapshot import TruthSnapshot
 
 
 logger = logging.getLogger(__name__)
@@ -25,63 +35,21 @@ logger = logging.getLogger(__name__)
 
 def load_run(run_file_path):
     '''factory function that loads a run file into memory, checking its
-validity, and returning a dictionary keyed on topic_id with values
-that are dictionaries of
+validity, and returning a dictionary with a `results` dictionary keyed
+on topic_id with values that are sequences of
+:class:`~trec_dd.utils.runfile.Result`, each with
 
-    topic_id, iteration, stream_id, confidence, on_topic, subtopics
+    rank, iteration, stream_id, confidence, on_topic, subtopics
 
-where subtopics is a pipe-delimited list of colon-delimited two-tuples
-of (subtopic_id, rating)
+where subtopics is a tuple of (subtopic_id, rating) pairs, and an
+empty `scores` dictionary.  `run_file_path` may be a text run file or
+a binary run directory.  See :func:`~trec_dd.utils.runfile.iter_run`
+to read one topic at a time instead.
 
     '''
-    fh = open(run_file_path)
     results_by_topic = dict(scores=defaultdict(dict), results=defaultdict(list))
-    prev_team_id = None
-    prev_system_id = None
-    prev_batch_num = None
-    prev_topic_id = None
-    seen_topic_ids = set()
-    rank = 1
-    for line in fh:
-        if line.startswith('#'): continue
-        parts = line.split()
-        if len(parts) != 6:
-            sys.exit('Your run file is invalid, because line '
-                     '%d has %d parts instead of 5' 
-                     % (line_idx, len(parts)))
-
-        topic_id, iteration, stream_id, confidence, on_topic, subtopics_and_ratings = parts
-        on_topic = bool(int(on_topic))
-        confidence = float(confidence)
-
-        if prev_topic_id is None: prev_topic_id = topic_id
-        if prev_topic_id != topic_id:
-            ## switching to a new topic!!!
-            if topic_id in seen_topic_ids:
-                sys.exit('run file returns to a previously finished topic!\n%r' % line)
-            else:
-                rank = 1
-                seen_topic_ids.add(topic_id)
-                prev_topic_id = topic_id
-                assert rank == 1, line
-                prev_batch_num = None
-
-        subtopics = []
-        if subtopics_and_ratings == 'NULL':
-            assert on_topic is False, (line, subtopics_and_ratings)
-
-        else:
-            for rec in subtopics_and_ratings.split('|'):
-                subtopic_id, rating = rec.split(':')
-                subtopics.append((subtopic_id, int(rating)))
-
-        results_by_topic['results'][topic_id].append(dict(
-                rank=rank,
-                stream_id=stream_id, confidence=confidence, on_topic=on_topic,
-                subtopics=subtopics,
-                ))
-        rank += 1
-
+    for topic_id, results in iter_run(run_file_path):
+        results_by_topic['results'][topic_id] = results
     return results_by_topic
 
 
@@ -95,13 +63,269 @@ def format_scores(run):
     return '\n'.join(parts)
 
 
+def format_table(scores_by_run):
+    '''Format the macro averages of many runs as one table, with a
+    row per run and a column per scorer.
+
+    `scores_by_run` maps each run file path to its ``run['scores']``.
+    '''
+    scorer_names = sorted(set(name for scores in scores_by_run.values()
+                              for name in scores))
+    parts = ['\t'.join(['run'] + scorer_names)]
+    for run_file_path, scores in sorted(scores_by_run.items()):
+        cells = [run_file_path]
+        for name in scorer_names:
+            if name in scores:
+                cells.append('%.3f' % scores[name]['macro_average'])
+            else:
+                cells.append('-')
+        parts.append('\t'.join(cells))
+    return '\n'.join(parts)
+
+
+def score_run(run, label_store, scorer_names, backend='fused', scorers=None):
+    '''Add the scores of `scorer_names` to ``run['scores']``, computed
+    with `backend`.
+    '''
+    if scorers is None:
+        scorers = available_scorers
+    modules = {'fused': engine, 'numpy': vectorized}
+    if backend in modules:
+        modules[backend].score_run(run, label_store, scorer_names, scorers)
+    else:
+        for scorer_name in scorer_names:
+            # this modifies the run['scores'] object itself
+            scorers[scorer_name](run, label_store)
+
+
+# what each topic shard worker scores; set before the pool forks
+_shard_state = {}
+
+
+def _score_shard(item):
+    scorer_names, topic_ids = item
+    state = _shard_state
+    results = state['run']['results']
+    shard = dict(scores=defaultdict(dict),
+                 results=dict((topic_id, results[topic_id])
+                              for topic_id in topic_ids))
+    score_run(shard, state['label_store'], scorer_names, state['backend'],
+              state['scorers'])
+    return dict((name, shard['scores'][name]['scores_by_topic'])
+                for name in scorer_names)
+
+
+def score_run_parallel(run, label_store, scorer_names, backend='fused',
+                       processes=1, scorers=None):
+    '''Like :func:`score_run`, with the work split across `processes`
+    worker processes.
+
+    The topics of `run` are dealt round-robin into shards, and every
+    shard is scored once per group of scorers: all of the fused
+    scorers together under the fused and numpy backends, and each
+    other scorer on its own.  The workers inherit `run` and
+    `label_store` when they fork.  Each scorer's topics are merged
+    back in the order of ``run['results']`` before its macro average
+    is taken, so ``run['scores']`` comes out exactly as
+    :func:`score_run` leaves it.  The scorers in
+    :data:`~trec_dd.scorer.whole_run_scorers` need every topic at
+    once, and are run on the whole run in this process.
+    '''
+    topic_ids = list(run['results'])
+    sharded = [name for name in scorer_names
+               if name not in whole_run_scorers]
+    if processes <= 1 or not topic_ids or not sharded:
+        score_run(run, label_store, scorer_names, backend, scorers)
+        return
+
+    if backend in ('fused', 'numpy'):
+        fused = [name for name in sharded if name in engine.fused_scorers]
+        groups = [[name] for name in sharded
+                  if name not in engine.fused_scorers]
+        if fused:
+            groups.insert(0, fused)
+    else:
+        groups = [[name] for name in sharded]
+    # several shards per process, so one slow topic does not hold up
+    # the others
+    num_shards = min(len(topic_ids), processes * 4)
+    shards = [topic_ids[idx::num_shards] for idx in xrange(num_shards)]
+    items = [(group, shard) for group in groups for shard in shards]
+
+    _shard_state.update(run=run, label_store=label_store, backend=backend,
+                        scorers=scorers)
+    try:
+        pool = multiprocessing.Pool(min(processes, len(items)))
+        try:
+            parts = pool.map(_score_shard, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _shard_state.clear()
+
+    merged = defaultdict(dict)
+    for part in parts:
+        for name, scores_by_topic in part.iteritems():
+            merged[name].update(scores_by_topic)
+    for name in sharded:
+        scores_by_topic = {}
+        for topic_id in topic_ids:
+            if topic_id in merged[name]:
+                scores_by_topic[topic_id] = merged[name][topic_id]
+        run['scores'][name] = {
+            'scores_by_topic': scores_by_topic,
+            'macro_average': mean(scores_by_topic.values()),
+        }
+    whole = [name for name in scorer_names if name in whole_run_scorers]
+    if whole:
+        score_run(run, label_store, whole, backend, scorers)
+
+
+def score_run_file(run_file_path, output_path, label_store, scorer_names,
+                   backend='fused', scorers=None, processes=1):
+    '''Score one run file, write the scored run to `output_path` as
+    JSON, and return its ``run['scores']``.
+
+    `scorers` maps scorer names to functions, and defaults to
+    :data:`trec_dd.scorer.available_scorers`.
+
+    The fused and numpy backends read and score the run one topic at a
+    time, writing each topic's results out as they go, so only one
+    topic is held in memory.  With more than one process, the whole
+    run is loaded and its topics are scored by
+    :func:`score_run_parallel`.
+
+    The scored run is written next to `output_path` and renamed into
+    place once it is complete, so an invalid run file, which raises
+    :exc:`ValueError`, leaves no partial output behind.
+    '''
+    tmp_path = output_path + '.tmp'
+    try:
+        scores = _write_scored_run(run_file_path, tmp_path, label_store,
+                                   scorer_names, backend, scorers,
+                                   processes)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.rename(tmp_path, output_path)
+    return scores
+
+
+def _write_scored_run(run_file_path, output_path, label_store, scorer_names,
+                      backend, scorers, processes):
+    modules = {'fused': engine, 'numpy': vectorized}
+    streaming = processes <= 1 and backend in modules and \
+        all(name in engine.fused_scorers for name in scorer_names)
+    if not streaming:
+        run = load_run(run_file_path)
+        logger.info('running %s on %s', ', '.join(scorer_names),
+                    run_file_path)
+        score_run_parallel(run, label_store, scorer_names, backend,
+                           processes, scorers)
+        with open(output_path, 'wb') as fh:
+            fh.write(json.dumps(run, indent=4, default=json_default))
+        return run['scores']
+
+    logger.info('running %s on %s', ', '.join(scorer_names), run_file_path)
+    with open(output_path, 'wb') as fh:
+        # the same JSON object as above, with the results streamed out
+        fh.write('{\n    "results": {')
+
+        def topics():
+            sep = '\n'
+            for topic_id, results in iter_run(run_file_path):
+                fh.write('%s        %s: %s' % (
+                    sep, json.dumps(topic_id),
+                    json.dumps(results, default=json_default)))
+                sep = ',\n'
+                yield topic_id, results
+
+        scores = modules[backend].score_topics(topics(), label_store,
+                                               scorer_names)
+        fh.write('\n    },\n    "scores": %s\n}' % json.dumps(scores))
+    return scores
+
+
+def expand_run_file_paths(paths):
+    '''Expand any glob patterns in `paths`, keeping their order and
+    dropping duplicates.
+    '''
+    run_file_paths = []
+    for path in paths:
+        matches = sorted(glob.glob(path)) or [path]
+        for match in matches:
+            if match not in run_file_paths:
+                run_file_paths.append(match)
+    return run_file_paths
+
+
+def scored_output_path(output_dir, run_file_path):
+    return os.path.join(output_dir,
+                        os.path.basename(run_file_path) + '.json')
+
+
+# what each pool worker scores with; set before the pool forks
+_batch_state = {}
+
+
+def _score_in_worker(job):
+    run_file_path, output_path = job
+    state = _batch_state
+    scores = score_run_file(run_file_path, output_path,
+                            state['label_store'], state['scorer_names'],
+                            state['backend'], state['scorers'],
+                            state['processes'])
+    return run_file_path, scores
+
+
+def score_run_files(jobs, label_store, scorer_names, backend='fused',
+                    processes=1, scorers=None):
+    '''Score many run files against one `label_store`.
+
+    `jobs` is a list of ``(run_file_path, output_path)`` pairs; each
+    scored run is written to its output path as JSON.  With more than
+    one process, the runs are scored by a :class:`multiprocessing.Pool`
+    whose workers inherit `label_store` when they fork, so the truth
+    data is only read once.  Returns a dict mapping each run file path
+    to its ``run['scores']``.  A single run file is instead split by
+    topic across the processes, with :func:`score_run_parallel`.
+    '''
+    # pool workers cannot start pools of their own
+    _batch_state.update(label_store=label_store, scorer_names=scorer_names,
+                        backend=backend, scorers=scorers,
+                        processes=processes if len(jobs) == 1 else 1)
+    try:
+        if processes > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(processes, len(jobs)))
+            try:
+                results = pool.map(_score_in_worker, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_score_in_worker, jobs)
+    finally:
+        _batch_state.clear()
+    return dict(results)
+
+
 def main():
     parser = argparse.ArgumentParser(__doc__,
                                      conflict_handler='resolve')
-    parser.add_argument('run_file_path', help='path to run file to score.')
-    parser.add_argument('scored_run_file_output_path',
-                        help='path to file to create with scores inserted'
-                        'into run file.')
+    parser.add_argument('paths', nargs='+', metavar='path',
+                        help='a run file to score and the path of the '
+                        'scored run file to create; with --output-dir, '
+                        'any number of run files or glob patterns')
+    parser.add_argument('--output-dir', default=None,
+                        help='score every run file given, writing each '
+                        'scored run to this directory as '
+                        '<run file name>.json')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes scoring run files '
+                        'in parallel; a single run file is split by topic '
+                        'across them')
     parser.add_argument('--overwrite', action='store_true', default=False,
                         help='overwrite any existing run file.')
     parser.add_argument('--verbose', action='store_true', default=False,
@@ -109,15 +333,55 @@ def main():
     parser.add_argument('--scorer', action='append', default=[],
         dest='scorers', help='names of scorer functions to run;'
                         ' if none are provided, it runs all of them')
+    parser.add_argument('--backend', choices=['fused', 'numpy', 'serial'],
+                        default='fused',
+                        help='`fused` computes every score in one pass over '
+                        'each topic; `numpy` computes them with numpy arrays; '
+                        '`serial` runs each scorer on its own')
+    parser.add_argument('--truth-snapshot', default=None,
+                        help='read the truth data from a snapshot built by '
+                        '`trec_dd_harness compile` instead of kvlayer; '
+                        'defaults to harness.truth_snapshot_path')
+    group = parser.add_argument_group('cube test')
+    group.add_argument('--cutoff', type=int, default=CUTOFF,
+                       help='score the documents of this many iterations')
+    group.add_argument('--max-height', type=float, default=MAX_HEIGHT,
+                       help='height of the cube')
+    group.add_argument('--gamma', type=float, default=GAMMA,
+                       help='discount of each further document covering '
+                       'a subtopic')
+    group.add_argument('--beta', type=float, default=BETA,
+                       help='weight of the gain in a subtopic')
 
     modules = [yakonfig, kvlayer]
     args = yakonfig.parse_args(parser, modules)
 
-    if os.path.exists(args.scored_run_file_output_path):
-        if args.overwrite:
-            os.remove(args.scored_run_file_output_path)
-        else:
-            sys.exit('%r already exists' % args.scored_run_file_output_path)
+    if args.backend == 'numpy' and vectorized.np is None:
+        sys.exit('--backend numpy requires numpy to be installed')
+
+    if args.output_dir is None:
+        if len(args.paths) != 2:
+            sys.exit('give a run file and an output path, '
+                     'or use --output-dir to score many run files')
+        jobs = [tuple(args.paths)]
+    else:
+        run_file_paths = expand_run_file_paths(args.paths)
+        jobs = [(path, scored_output_path(args.output_dir, path))
+                for path in run_file_paths]
+        output_paths = [output_path for _, output_path in jobs]
+        if len(set(output_paths)) != len(output_paths):
+            sys.exit('run files in --output-dir must have distinct names')
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+
+    for run_file_path, output_path in jobs:
+        if not os.path.exists(run_file_path):
+            sys.exit('%r does not exist' % run_file_path)
+        if os.path.exists(output_path):
+            if args.overwrite:
+                os.remove(output_path)
+            else:
+                sys.exit('%r already exists' % output_path)
 
     if args.verbose:
         level = logging.DEBUG
@@ -125,24 +389,39 @@ def main():
         level = logging.INFO
     logging.basicConfig(level=level)
 
-    kvl = kvlayer.client()
-    label_store = LabelStore(kvl)
-
-    run = load_run(args.run_file_path)
+    truth_snapshot_path = args.truth_snapshot
+    if truth_snapshot_path is None:
+        harness_config = yakonfig.get_global_config().get('harness', {})
+        truth_snapshot_path = harness_config.get('truth_snapshot_path')
+    if truth_snapshot_path:
+        label_store = TruthSnapshot(truth_snapshot_path)
+    else:
+        kvl = kvlayer.client()
+        # read each topic's subtopics once, instead of once per scorer
+        # and run
+        label_store = SubtopicUniverse(LabelStore(kvl))
 
     if len(args.scorers) == 0:
         args.scorers = available_scorers.keys()
-
-    for scorer_name in args.scorers:
-        scorer = available_scorers.get(scorer_name)
-        logger.info('running %s', scorer_name)
-        # this modifies the run['scores'] object itself
-        scorer(run, label_store)
-
-    print(format_scores(run))
-
-    open(args.scored_run_file_output_path, 'wb').\
-        write(json.dumps(run, indent=4))
+    if args.cutoff < 1:
+        sys.exit('--cutoff must be at least 1')
+    cube_test_options = dict(cutoff=args.cutoff, max_height=args.max_height,
+                             gamma=args.gamma, beta=args.beta)
+    scorers = dict(available_scorers,
+                   cube_test=partial(cube_test, **cube_test_options),
+                   average_cube_test=partial(average_cube_test,
+                                             **cube_test_options))
+
+    try:
+        scores_by_run = score_run_files(jobs, label_store, args.scorers,
+                                        args.backend, args.jobs, scorers)
+    except ValueError, exc:
+        sys.exit(str(exc))
+
+    if args.output_dir is None:
+        print(format_scores(dict(scores=scores_by_run[jobs[0][0]])))
+    else:
+        print(format_table(scores_by_run))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+from __future__ import absolute_import
+
+import os
+import pytest
+
+from trec_dd.harness.run import Harness
+from trec_dd.scorer import available_scorers, vectorized
+from trec_dd.scorer.run import load_run
+from trec_dd.utils import SubtopicUniverse
+from trec_dd.utils.runfile import BinaryRun, BinaryRunWriter, iter_run, \
+    binary_to_text, text_to_binary
+from .test_scorers import label_store, run_file_path, score, submissions
+
+pytest.importorskip('numpy')
+
+
+def results_of(path):
+    return [(topic_id, [r.to_dict() for r in results])
+            for topic_id, results in iter_run(path)]
+
+
+def test_harness_writes_binary_run(label_store, tmpdir):
+    text_path = str(tmpdir.join('run.txt'))
+    binary_path = str(tmpdir.join('run.bin'))
+    harness = Harness(dict(run_file_path=text_path,
+                           binary_run_path=binary_path, batch_size=2),
+                      label_store.kvl, label_store)
+    harness.init()
+    topic_id = harness.start()['topic_id']
+    harness.step(topic_id, [submissions['DD15-1'][1], 500,
+                            submissions['DD15-1'][2], 400])
+    harness.step(topic_id, [submissions['DD15-1'][4], 300])
+    harness.stop(topic_id)
+
+    assert results_of(binary_path) == results_of(text_path)
+    run = BinaryRun(binary_path)
+    assert run.steps.tolist() == [[0, 0, 0, 2], [0, 1, 2, 1]]
+    assert run.ids[0] == 'DD15-1'
+
+
+def test_convert_round_trip(run_file_path, tmpdir):
+    binary_path = str(tmpdir.join('run.bin'))
+    text_path = str(tmpdir.join('run.txt'))
+    assert text_to_binary(run_file_path, binary_path) == 13
+    assert results_of(binary_path) == results_of(run_file_path)
+    assert binary_to_text(binary_path, text_path) == 13
+    with open(text_path) as fh, open(run_file_path) as expected:
+        assert fh.read() == expected.read()
+
+
+
+def test_topic_results_indexing(run_file_path, tmpdir):
+    binary_path = str(tmpdir.join('run.bin'))
+    text_to_binary(run_file_path, binary_path)
+    for topic_id, results in BinaryRun(binary_path).iter_topics():
+        expected = [r.to_dict() for r in results]
+        assert [results[idx].to_dict()
+                for idx in range(len(results))] == expected
+        assert results[-1].to_dict() == expected[-1]
+        for part in (slice(None, 2), slice(1, None, 2), slice(-2, None)):
+            assert [r.to_dict() for r in results[part]] == expected[part]
+        with pytest.raises(IndexError):
+            results[len(results)]
+
+
+def test_score_binary_run(label_store, run_file_path, tmpdir):
+    binary_path = str(tmpdir.join('run.bin'))
+    text_to_binary(run_file_path, binary_path)
+    assert score(binary_path, label_store) == \
+        score(run_file_path, label_store)
+
+    run = load_run(binary_path)
+    names = sorted(available_scorers)
+    vectorized.score_run(run, SubtopicUniverse(label_store), names)
+    for name, rec in score(run_file_path, label_store).iteritems():
+        assert run['scores'][name]['scores_by_topic'] == \
+            pytest.approx(rec['scores_by_topic'])
+
+
+def test_writer_drops_unfinished_step(tmpdir):
+    path = str(tmpdir.join('run.bin'))
+    writer = BinaryRunWriter(path)
+    writer.append_step('t1', 0, [('doc1', 10, True, [('t1.1', 3)])])
+    writer.close()
+    # a step that died before writing its index row
+    for name in ('confidence', 'stream_ids', 'subtopics', 'ids'):
+        with open(os.path.join(path, name), 'ab') as fh:
+            fh.write('garbage')
+    writer.append_step('t1', 1, [('doc2', 20, False, [])])
+    writer.close()
+
+    [(topic_id, results)] = list(BinaryRun(path).iter_topics())
+    assert topic_id == 't1'
+    assert [r.to_dict() for r in results] == [
+        dict(rank=1, iteration=0, stream_id='doc1', confidence=10.0,
+             on_topic=True, subtopics=(('t1.1', 3),)),
+        dict(rank=2, iteration=1, stream_id='doc2', confidence=20.0,
+             on_topic=False, subtopics=()),
+    ]
+
+
+def test_writer_column_sizes(tmpdir):
+    path = str(tmpdir.join('run.bin'))
+    writer = BinaryRunWriter(path)
+    writer.append_step('t1', 0, [('doc1', 10, True, [('t1.1', 3)]),
+                                 ('doc22', 20, False, [])])
+    # the same sizes on every platform, whatever its C long is
+    sizes = dict((name, os.path.getsize(os.path.join(path, name)))
+                 for name in ('steps', 'confidence', 'on_topic',
+                              'stream_end', 'subtopic_end', 'subtopics',
+                              'ratings'))
+    assert sizes == dict(steps=16, confidence=16, on_topic=2,
+                         stream_end=16, subtopic_end=16, subtopics=4,
+                         ratings=4)
+    with open(os.path.join(path, 'stream_end'), 'rb') as fh:
+        assert fh.read() == '\x04' + '\0' * 7 + '\x09' + '\0' * 7
+
+
+def test_writer_keeps_files_open(tmpdir, monkeypatch):
+    from trec_dd.utils import runfile
+    path = str(tmpdir.join('run.bin'))
+    writer = BinaryRunWriter(path, flush_every='stop')
+    writer.append_step('t1', 0, [('doc1', 10, True, [('t1.1', 3)])])
+
+    def no_syscalls(*args, **kwargs):
+        raise AssertionError('opened or statted a file in a step')
+    monkeypatch.setattr(runfile, 'open', no_syscalls, raising=False)
+    monkeypatch.setattr(runfile.os.path, 'getsize', no_syscalls)
+    writer.append_step('t1', 1, [('doc2', 20, False, [])])
+    # no step is in the index until the topic stops
+    assert os.stat(os.path.join(path, 'steps')).st_size == 0
+    writer.stop()
+    assert os.stat(os.path.join(path, 'steps')).st_size == 32
+    monkeypatch.undo()
+    writer.close()
+
+    [(topic_id, results)] = list(BinaryRun(path).iter_topics())
+    assert [r.stream_id for r in results] == ['doc1', 'doc2']
@@ -0,0 +1,347 @@
+from __future__ import absolute_import
+
+from dossier.label import LabelStore
+import importlib
+import json
+import kvlayer
+import os
+import pytest
+import subprocess
+
+from trec_dd.harness.qrels import qrels_from_label_store, write_qrels
+from trec_dd.harness.run import Harness, load_truth_data
+from trec_dd.harness.tests.test_truth_data import truth_data_path
+from trec_dd.scorer import available_scorers
+from trec_dd.scorer.engine import fused_scorers, score_run
+from trec_dd.scorer import vectorized
+from trec_dd.scorer.run import format_table, load_run, \
+    score_run_file, score_run_files, score_run_parallel
+from trec_dd.utils import SubtopicUniverse
+from trec_dd.utils.runfile import iter_run, iter_text_run
+from trec_dd.utils.snapshot import TruthSnapshot, compile_snapshot
+
+# the module, which trec_dd.scorer.cube_test the function hides
+cube_test = importlib.import_module('trec_dd.scorer.cube_test')
+
+# documents each topic's simulated system submits, in order
+submissions = {
+    'DD15-1': ['junk1', '1421367917-3dbee01ac22eaef1057361d068b5870b',
+               '1421410151-3392e7d55ff537489009b1f632a11833', 'junk2',
+               '1421405887-0de7103ff270d313037c75fd9d265ea8',
+               '1421410151-3392e7d55ff537489009b1f632a11834', 'junk3'],
+    'DD15-2': ['1421362984-ee6360ee71c6a102056cf600e46373b8'],
+    'DD15-3': ['junk4', 'junk5', 'junk6', 'junk7', 'junk8'],
+}
+
+
+@pytest.fixture
+def label_store():
+    kvl = kvlayer.client(config={}, storage_type='local',
+                         namespace='test_scorers', app_name='test')
+    kvl.delete_namespace()
+    label_store = LabelStore(kvl)
+    load_truth_data(kvl, label_store, truth_data_path)
+    return label_store
+
+
+@pytest.fixture
+def run_file_path(label_store, tmpdir):
+    '''Drive a harness through `submissions` and return its run file.'''
+    path = os.path.join(str(tmpdir), 'run.txt')
+    harness = Harness(dict(run_file_path=path, batch_size=2),
+                      label_store.kvl, label_store)
+    simulate(harness)
+    return path
+
+
+def simulate(harness):
+    '''Submit `submissions` to `harness`, one topic at a time.'''
+    harness.init()
+    while True:
+        topic_id = harness.start()['topic_id']
+        if topic_id is None:
+            break
+        docs = submissions[topic_id]
+        for start in xrange(0, len(docs), 2):
+            results = []
+            for offset, doc_id in enumerate(docs[start:start + 2]):
+                results += [doc_id, 900 - 10 * (start + offset)]
+            harness.step(topic_id, results)
+            if len(results) < 4:
+                break
+        harness.stop(topic_id)
+    harness.close()
+
+
+def score(run_file_path, label_store, scorer_names=None):
+    run = load_run(run_file_path)
+    for name in scorer_names or sorted(available_scorers):
+        available_scorers[name](run, label_store)
+    return run['scores']
+
+
+def assert_scores_match(scores, expected):
+    '''Check `scores` against `expected`, up to float rounding, since
+    the backends sum in different orders.
+    '''
+    assert sorted(scores) == sorted(expected)
+    for name, rec in expected.iteritems():
+        assert scores[name]['scores_by_topic'] == \
+            pytest.approx(rec['scores_by_topic'])
+        assert scores[name]['macro_average'] == \
+            pytest.approx(rec['macro_average'])
+
+
+def test_subtopic_universe(label_store, run_file_path):
+    run = load_run(run_file_path)
+    universe = SubtopicUniverse(label_store, run['results'].keys())
+    assert sorted(universe.all_subtopics('DD15-1')) == \
+        ['DD15-1.1', 'DD15-1.2']
+    assert universe.all_subtopics('no-such-topic') == []
+    assert score(run_file_path, universe) == \
+        score(run_file_path, label_store)
+    assert score(run_file_path, SubtopicUniverse(label_store)) == \
+        score(run_file_path, label_store)
+
+
+def test_binary_err_scores_are_kept(label_store, run_file_path):
+    scores = score(run_file_path, label_store)
+    assert 'average_err_arithmetic_binary' in scores
+    assert 'average_err_harmonic_binary' in scores
+    assert scores['average_err_arithmetic'] != \
+        scores['average_err_arithmetic_binary']
+
+
+@pytest.mark.parametrize('scorer_names', [
+    None,
+    ['reciprocal_rank_at_recall'],
+    ['precision_at_recall', 'average_err_harmonic_binary'],
+])
+def test_fused_engine_matches_scorers(label_store, run_file_path,
+                                      scorer_names):
+    run = load_run(run_file_path)
+    score_run(run, label_store, scorer_names or sorted(available_scorers))
+    assert_scores_match(run['scores'],
+                        score(run_file_path, label_store, scorer_names))
+
+
+@pytest.mark.parametrize('scorer_names', [
+    None,
+    ['modified_precision_at_recall', 'average_err_harmonic'],
+])
+def test_numpy_backend_matches_scorers(label_store, run_file_path,
+                                       scorer_names):
+    pytest.importorskip('numpy')
+    run = load_run(run_file_path)
+    vectorized.score_run(run, label_store,
+                         scorer_names or sorted(available_scorers))
+    assert_scores_match(run['scores'],
+                        score(run_file_path, label_store, scorer_names))
+
+
+def test_score_run_files(label_store, run_file_path, tmpdir):
+    universe = SubtopicUniverse(label_store)
+    other_path = str(tmpdir.join('other.txt'))
+    with open(run_file_path) as fh:
+        # a run that stops after the first result of each topic
+        lines = [line for line in fh if line.startswith('#') or
+                 line.split()[1] == '0']
+    with open(other_path, 'w') as fh:
+        fh.writelines(lines)
+    jobs = [(path, str(tmpdir.join(os.path.basename(path) + '.json')))
+            for path in (run_file_path, other_path)]
+
+    scores_by_run = score_run_files(jobs, universe, sorted(available_scorers),
+                                    processes=2)
+    assert_scores_match(scores_by_run[run_file_path],
+                        score(run_file_path, label_store))
+    assert_scores_match(scores_by_run[other_path],
+                        score(other_path, label_store))
+    assert scores_by_run[run_file_path] != scores_by_run[other_path]
+    for run_file_path, output_path in jobs:
+        with open(output_path) as fh:
+            assert json.load(fh)['scores'] == \
+                json.loads(json.dumps(scores_by_run[run_file_path]))
+
+    table = format_table(scores_by_run).splitlines()
+    assert table[0].split('\t') == ['run'] + sorted(available_scorers)
+    assert [row.split('\t')[0] for row in table[1:]] == \
+        sorted(scores_by_run)
+
+
+@pytest.mark.parametrize('backend', ['fused', 'numpy', 'serial'])
+def test_score_run_parallel(label_store, run_file_path, backend):
+    if backend == 'numpy':
+        pytest.importorskip('numpy')
+    universe = SubtopicUniverse(label_store)
+    runs = []
+    for processes in (1, 2):
+        run = load_run(run_file_path)
+        score_run_parallel(run, universe, sorted(available_scorers), backend,
+                           processes)
+        runs.append(run)
+    assert runs[1]['scores'] == runs[0]['scores']
+    if backend != 'numpy':
+        assert_scores_match(runs[1]['scores'],
+                            score(run_file_path, label_store))
+
+
+def test_score_one_run_file_by_topic(label_store, run_file_path, tmpdir):
+    output_path = str(tmpdir.join('run.json'))
+    scores_by_run = score_run_files([(run_file_path, output_path)],
+                                    SubtopicUniverse(label_store),
+                                    sorted(fused_scorers), processes=3)
+    scores = scores_by_run[run_file_path]
+    assert_scores_match(scores, score(run_file_path, label_store,
+                                      sorted(fused_scorers)))
+    with open(output_path) as fh:
+        assert json.load(fh)['scores'] == json.loads(json.dumps(scores))
+
+
+def test_live_scores(label_store, tmpdir):
+    path = str(tmpdir.join('run.txt'))
+    harness = Harness(dict(run_file_path=path, batch_size=2,
+                           live_scores=True),
+                      label_store.kvl, label_store)
+    simulate(harness)
+    run = load_run(path)
+    score_run(run, label_store, sorted(fused_scorers))
+    assert harness.scores() == run['scores']
+    topic_scores = harness.scores('DD15-1')
+    for name, rec in topic_scores.iteritems():
+        assert rec['scores_by_topic'] == \
+            {'DD15-1': run['scores'][name]['scores_by_topic']['DD15-1']}
+
+    # init starts over
+    harness.init()
+    assert harness.scores()['precision_at_recall']['scores_by_topic'] == {}
+
+
+def test_iter_run(run_file_path):
+    topics = list(iter_run(run_file_path))
+    assert [topic_id for topic_id, _ in topics] == \
+        ['DD15-1', 'DD15-2', 'DD15-3']
+    results = topics[0][1]
+    assert [r['rank'] for r in results] == range(1, 8)
+    assert results[0]['stream_id'] == 'junk1'
+    assert results[0]['subtopics'] == ()
+    assert results[1].subtopics == (('DD15-1.1', 2),)
+    assert results[1].to_dict() == dict(
+        rank=2, iteration=0, stream_id=submissions['DD15-1'][1], confidence=890.0,
+        on_topic=True, subtopics=(('DD15-1.1', 2),))
+
+
+def test_load_run_rejects_returning_topic(run_file_path, tmpdir):
+    with open(run_file_path) as fh:
+        lines = fh.readlines()
+    path = str(tmpdir.join('bad.txt'))
+    with open(path, 'w') as fh:
+        fh.writelines(lines + [l for l in lines if l.startswith('DD15-1')])
+    with pytest.raises(ValueError) as excinfo:
+        load_run(path)
+    assert 'line %d (byte %d)' % (len(lines) + 1, len(''.join(lines))) \
+        in str(excinfo.value)
+
+
+def test_iter_text_run_reports_byte_offset(run_file_path, tmpdir):
+    with open(run_file_path) as fh:
+        lines = fh.readlines()
+    path = str(tmpdir.join('bad.txt'))
+    with open(path, 'w') as fh:
+        fh.writelines(lines + ['DD15-9 0 too few parts\n'])
+    offset = len(lines[0])
+    with pytest.raises(ValueError) as excinfo:
+        list(iter_text_run(path, offset))
+    assert 'at byte %d: the line has 5 parts' % len(''.join(lines)) \
+        in str(excinfo.value)
+
+
+def test_score_run_file_leaves_no_partial_output(label_store, run_file_path,
+                                                 tmpdir):
+    with open(run_file_path) as fh:
+        lines = fh.readlines()
+    path = str(tmpdir.join('bad.txt'))
+    with open(path, 'w') as fh:
+        fh.writelines(lines + [l for l in lines if l.startswith('DD15-1')])
+    output_path = str(tmpdir.join('bad.json'))
+    with pytest.raises(ValueError):
+        score_run_file(path, output_path, SubtopicUniverse(label_store),
+                       sorted(fused_scorers))
+    assert sorted(os.listdir(str(tmpdir))) == ['bad.txt', 'run.txt']
+
+
+@pytest.mark.parametrize('backend', ['fused', 'numpy'])
+def test_score_run_file_streams(label_store, run_file_path, tmpdir,
+                                backend):
+    if backend == 'numpy':
+        pytest.importorskip('numpy')
+    universe = SubtopicUniverse(label_store)
+    # only the fused scorers can score a topic at a time
+    names = sorted(fused_scorers)
+    serial_path = str(tmpdir.join('serial.json'))
+    streamed_path = str(tmpdir.join('streamed.json'))
+    score_run_file(run_file_path, serial_path, universe, names, 'serial')
+    scores = score_run_file(run_file_path, streamed_path, universe, names,
+                            backend)
+    with open(serial_path) as fh:
+        serial = json.load(fh)
+    with open(streamed_path) as fh:
+        streamed = json.load(fh)
+    assert streamed['results'] == serial['results']
+    assert streamed['scores'] == json.loads(json.dumps(scores))
+    for name, rec in serial['scores'].iteritems():
+        assert streamed['scores'][name]['macro_average'] == \
+            pytest.approx(rec['macro_average'])
+
+
+def perl_cube_test(qrels_path, run_file_path, cutoff):
+    output = subprocess.check_output(
+        ['perl', os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                              'bin', 'cubeTest_v3.pl'),
+         qrels_path, run_file_path, str(cutoff)])
+    scores = {}
+    for line in output.splitlines()[1:]:
+        _, topic_id, ct, avg_ct = line.split(',')
+        scores[topic_id] = (float(ct), float(avg_ct))
+    return scores
+
+
+@pytest.mark.parametrize('cutoff', [1, 2, 10])
+@pytest.mark.parametrize('with_numpy', [True, False])
+def test_cube_test_matches_perl(label_store, run_file_path, tmpdir,
+                                monkeypatch, cutoff, with_numpy):
+    if with_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(cube_test, 'np', None)
+    qrels_path = str(tmpdir.join('qrels.txt'))
+    with open(qrels_path, 'w') as fh:
+        write_qrels(qrels_from_label_store(label_store), fh)
+    try:
+        expected = perl_cube_test(qrels_path, run_file_path, cutoff)
+    except OSError:
+        pytest.skip('perl is not installed')
+
+    run = load_run(run_file_path)
+    cube_test.cube_test(run, label_store, cutoff=cutoff)
+    cube_test.average_cube_test(run, label_store, cutoff=cutoff)
+    for idx, name in enumerate(['cube_test', 'average_cube_test']):
+        scores = run['scores'][name]
+        assert sorted(scores['scores_by_topic']) == \
+            sorted(topic_id for topic_id in expected if topic_id != 'all')
+        for topic_id, score in scores['scores_by_topic'].iteritems():
+            assert score == pytest.approx(expected[topic_id][idx])
+        assert scores['macro_average'] == \
+            pytest.approx(expected['all'][idx])
+
+
+def test_cube_test_truth_sources(label_store, run_file_path, tmpdir):
+    snapshot_path = str(tmpdir.join('truth.snapshot'))
+    compile_snapshot(label_store, snapshot_path)
+    names = ['cube_test', 'average_cube_test']
+    expected = score(run_file_path, label_store, names)
+    assert expected['cube_test']['macro_average'] > 0
+    assert score(run_file_path, SubtopicUniverse(label_store), names) == \
+        expected
+    assert score(run_file_path, TruthSnapshot(snapshot_path), names) == \
+        expected
@@ -0,0 +1,172 @@
+'''trec_dd.scorer.vectorized computes the TREC DD scores with numpy.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+
+Each topic's results become a dense (rank x subtopic) matrix of the
+best rating every result gives each subtopic.  ERR is then a
+cumulative product of continue probabilities down the ranks, and the
+rank of full subtopic recall comes from a cumulative count of newly
+seen subtopics, with no per-result Python state.  The scores match the
+pure-Python scorers to within floating point rounding.
+
+numpy is optional: install ``trec_dd[numpy]`` to use this backend.
+'''
+
+from __future__ import absolute_import, division
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from trec_dd.scorer.average_err import mean
+from trec_dd.scorer.engine import err_scorers, fused_scorers
+from trec_dd.utils import get_all_subtopics
+
+
+def rating_matrix(results):
+    '''Return `(ratings, on_topic)` for one topic's `results`.
+
+    ``ratings[i, j]`` is the best rating that the result at rank
+    ``i + 1`` gives the ``j``-th distinct subtopic in the results, or
+    -1 if that result does not mention it.
+    '''
+    columns = {}
+    rows = []
+    cols = []
+    values = []
+    on_topic = np.zeros(len(results), dtype=bool)
+    for idx, result in enumerate(results):
+        assert idx == result['rank'] - 1
+        on_topic[idx] = result['on_topic']
+        for subtopic, conf in result['subtopics']:
+            rows.append(idx)
+            cols.append(columns.setdefault(subtopic, len(columns)))
+            values.append(conf)
+    ratings = np.full((len(results), len(columns)), -1, dtype=np.int64)
+    np.maximum.at(ratings, (np.array(rows, dtype=np.intp),
+                            np.array(cols, dtype=np.intp)),
+                  np.array(values, dtype=np.int64))
+    return ratings, on_topic
+
+
+def rating_matrix_from_columns(results):
+    ''':func:`rating_matrix` for the
+    :class:`~trec_dd.utils.runfile.TopicResults` of a binary run,
+    built straight from its memory-mapped columns.
+    '''
+    on_topic, rows, codes, values = results.columns()
+    subtopic_codes, cols = np.unique(codes, return_inverse=True)
+    ratings = np.full((len(results), len(subtopic_codes)), -1,
+                      dtype=np.int64)
+    np.maximum.at(ratings, (rows, cols), values.astype(np.int64))
+    return ratings, on_topic
+
+
+def err_by_subtopic(ratings, relevance_metric):
+    '''Return the ERR of every column of `ratings`.'''
+    present = ratings >= 0
+    if relevance_metric == 'graded':
+        rel = np.where(present, (2.0 ** ratings - 1) / 2 ** 4, 0.0)
+    else:
+        rel = np.where(present & (ratings > 0), 1.0, 0.0)
+    # probability of reaching each rank without having stopped
+    p_continue = np.ones_like(rel)
+    np.cumprod(1 - rel[:-1], axis=0, out=p_continue[1:])
+    ranks = np.arange(1, len(rel) + 1, dtype=float)
+    return (p_continue * rel / ranks[:, np.newaxis]).sum(axis=0)
+
+
+def recall_scores(ratings, on_topic, num_subtopics):
+    '''Return `(cutoff, relevant_docs, modified_relevant_docs)` at the
+    rank where every one of `num_subtopics` subtopics has been seen,
+    or at the last rank if that never happens.
+    '''
+    present = ratings >= 0
+    num_results = len(ratings)
+    # number of subtopics each rank sees for the first time
+    first_seen = present.argmax(axis=0)
+    new = np.bincount(first_seen, minlength=num_results)
+    complete = np.cumsum(new) == num_subtopics
+    if complete.any():
+        cutoff = complete.argmax() + 1
+    else:
+        cutoff = num_results
+
+    per_result = present.sum(axis=1)
+    frac = np.where(per_result > 0, new / np.maximum(per_result, 1), 0.0)
+    return (cutoff, int(on_topic[:cutoff].sum()),
+            float(frac[:cutoff].sum()))
+
+
+def topic_scores(results, subtopic_ids, scorer_names):
+    '''Return a dict of scorer name to score for one topic.'''
+    if not results:
+        return dict((name, 0.0) for name in scorer_names)
+    if hasattr(results, 'columns'):
+        ratings, on_topic = rating_matrix_from_columns(results)
+    else:
+        ratings, on_topic = rating_matrix(results)
+    scores = {}
+    errs = {}
+    recall = None
+    for name in scorer_names:
+        if name in err_scorers:
+            metric, mean_type = err_scorers[name]
+            if metric not in errs:
+                errs[metric] = err_by_subtopic(ratings, metric)
+            err = errs[metric]
+            if mean_type == 'arithmetic':
+                scores[name] = float(err.mean()) if len(err) else 0.0
+            elif len(err) == 0 or (err == 0).any():
+                scores[name] = 0.0
+            else:
+                scores[name] = float(len(err) / (1 / err).sum())
+            continue
+        if recall is None:
+            recall = recall_scores(ratings, on_topic,
+                                   len(set(subtopic_ids)))
+        cutoff, relevant_docs, modified_relevant_docs = recall
+        if name == 'reciprocal_rank_at_recall':
+            scores[name] = 1 / cutoff
+        elif name == 'precision_at_recall':
+            scores[name] = relevant_docs / cutoff
+        elif name == 'modified_precision_at_recall':
+            scores[name] = modified_relevant_docs / cutoff
+    return scores
+
+
+def score_topics(topics, label_store, scorer_names):
+    '''Like :func:`trec_dd.scorer.engine.score_topics`, but with numpy.
+    '''
+    if np is None:
+        raise ImportError('the numpy scoring backend requires numpy')
+    scores_by_topic = dict((name, {}) for name in scorer_names)
+    for topic_id, results in topics:
+        scores = topic_scores(
+            results, get_all_subtopics(label_store, topic_id), scorer_names)
+        for name, score in scores.iteritems():
+            scores_by_topic[name][topic_id] = score
+
+    return dict((name, {
+        'scores_by_topic': scores_by_topic[name],
+        'macro_average': mean(scores_by_topic[name].values()),
+    }) for name in scorer_names)
+
+
+def score_run(run, label_store, scorer_names, scorers=None):
+    '''Add the `scorer_names` scores to ``run['scores']``, like
+    :func:`trec_dd.scorer.engine.score_run` but with numpy.
+    '''
+    if scorers is None:
+        from trec_dd.scorer import available_scorers as scorers
+
+    vectorized = [name for name in scorer_names if name in fused_scorers]
+    if vectorized:
+        run['scores'].update(score_topics(run['results'].items(),
+                                          label_store, vectorized))
+
+    for name in scorer_names:
+        if name not in fused_scorers:
+            scorers[name](run, label_store)
@@ -7,10 +7,12 @@
 from __future__ import absolute_import
 import json
 import logging
-import time
+import socket
 import subprocess
 import sys
 
+from trec_dd.utils.timing import Timings, clock
+
 logger = logging.getLogger(__name__)
 
 class HarnessAmbassadorCLI(object):
@@ -28,10 +30,10 @@ class HarnessAmbassadorCLI(object):
         self.num_steps = 0
         self.topic_id = None
         self.query = None
-        self.search_elapsed = 0
-        self.feedback_elapsed = 0
-        self.process_elapsed = 0
-        self.total_start = time.time()
+        # latency histograms of the system's `search`, the harness's
+        # `step` and the system's `process_feedback`
+        self.timings = Timings()
+        self.total_start = clock()
 
     @staticmethod
     def run_command(cmd):
@@ -49,16 +51,26 @@ class HarnessAmbassadorCLI(object):
             logger.critical(err)
             sys.exit(err)
 
+    def harness_command(self, command, *args):
+        '''Run one harness `command` and return its decoded response.
+        '''
+        cmd = ['trec_dd_harness', '-c', self.config_file_path, command]
+        cmd += list(args)
+        return self.run_command(cmd)
+
+    def close(self):
+        '''Release any connection to the harness.
+        '''
+        pass
+
     def init_harness(self):
-        out = self.run_command(['trec_dd_harness', '-c', 
-                                self.config_file_path, 'init'])
+        out = self.harness_command('init')
         assert 'num_topics' in out, out
 
     def start(self):
         '''Start harness evaluation on a given topic.
         '''
-        out = self.run_command(['trec_dd_harness', '-c', 
-                          self.config_file_path, 'start'])
+        out = self.harness_command('start')
         assert 'topic_id' in out, out
         assert 'query' in out, out
         self.topic_id = out['topic_id']
@@ -75,8 +87,7 @@ class HarnessAmbassadorCLI(object):
         '''
         logger.info('Stopping topic %s: %r', self.topic_id, self.query)
         if out is None:
-            out = self.run_command(['trec_dd_harness', '-c', 
-                                    self.config_file_path, 'stop', self.topic_id])
+            out = self.harness_command('stop', self.topic_id)
 
         assert 'finished' in out, out
         assert 'num_remaining' in out, out
@@ -84,11 +95,14 @@ class HarnessAmbassadorCLI(object):
         self.query = None
         self.num_steps = 0
 
-        total_elapsed = time.time() - self.total_start
+        total_elapsed = clock() - self.total_start
         logger.info('%.1f seconds spent so far, %.1f in search, %.1f in '
                     'generating feedback, %.1f in processing feedback',
-                    total_elapsed, self.search_elapsed, 
-                    self.feedback_elapsed, self.process_elapsed)
+                    total_elapsed, self.timings.total('search'),
+                    self.timings.total('feedback'),
+                    self.timings.total('process_feedback'))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('timings: %s', self.timings.to_json())
 
     def step(self):
         '''Go through one iteration of harness evaluation.
@@ -102,11 +116,10 @@ class HarnessAmbassadorCLI(object):
         logger.info('Doing step %d for topic %s: %r',
                     self.num_steps, self.query, self.topic_id)
 
-        start_time = time.time()
-        results = self.system.search(self.query, self.num_steps)
-        self.search_elapsed += time.time() - start_time
+        with self.timings.timer('search'):
+            results = self.system.search(self.query, self.num_steps)
 
-        logger.info('got %d results for %r page %d', 
+        logger.info('got %d results for %r page %d',
                     len(results), self.query, self.num_steps)
         if not results:
             # signal to run loop that we are done with this topic
@@ -115,26 +128,90 @@ class HarnessAmbassadorCLI(object):
         assert len(results) % 2 == 0
         # expect [str, int, str, int, ... up to batch_size pairs]
 
-        cmd = ['trec_dd_harness', '-c', 
-               self.config_file_path, 'step', self.topic_id]
-        cmd += results
-        feedback = self.run_command(cmd)
+        with self.timings.timer('feedback'):
+            feedback = self.harness_command('step', self.topic_id, *results)
         assert isinstance(feedback, list), feedback
 
-        start_time = time.time()
-        self.system.process_feedback(feedback)
-        self.process_elapsed += time.time() - start_time
+        with self.timings.timer('process_feedback'):
+            self.system.process_feedback(feedback)
 
         logger.info(json.dumps(feedback, indent=4, sort_keys=True))
         return feedback
 
     def run(self):
-        self.init_harness()
-        while 1:
-            self.start()
-            if self.topic_id is None: break
+        try:
+            self.init_harness()
             while 1:
-                feedback = self.step()
-                if feedback is None or len(feedback) < self.batch_size: break
-            self.stop()
+                self.start()
+                if self.topic_id is None: break
+                while 1:
+                    feedback = self.step()
+                    if feedback is None or len(feedback) < self.batch_size: break
+                self.stop()
+        finally:
+            self.close()
         logger.info('finished run loop')
+        logger.info('timings: %s', self.timings.to_json())
+
+
+class HarnessAmbassadorServer(HarnessAmbassadorCLI):
+    '''Talks to one long-lived ``trec_dd_harness serve`` process instead
+    of starting a new harness process for every command.
+
+    If `socket_path` is given, this connects to a harness already
+    serving on that Unix socket.  Otherwise it starts ``trec_dd_harness
+    serve`` itself and talks to it over stdin/stdout.
+
+    '''
+
+    def __init__(self, system, config_file_path, batch_size=5,
+                 socket_path=None):
+        super(HarnessAmbassadorServer, self).__init__(
+            system, config_file_path, batch_size)
+        self.socket_path = socket_path
+        self.process = None
+        self.sock = None
+        self.reader = None
+        self.writer = None
+
+    def connect(self):
+        if self.socket_path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.socket_path)
+            self.reader = self.sock.makefile('rb')
+            self.writer = self.sock.makefile('wb')
+        else:
+            # stderr is inherited so that the harness log cannot fill
+            # up a pipe that nobody is reading
+            self.process = subprocess.Popen(
+                ['trec_dd_harness', '-c', self.config_file_path, 'serve'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.reader = self.process.stdout
+            self.writer = self.process.stdin
+
+    def harness_command(self, command, *args):
+        if self.writer is None:
+            self.connect()
+        request = {'command': command, 'args': list(args)}
+        self.writer.write(json.dumps(request) + '\n')
+        self.writer.flush()
+        line = self.reader.readline()
+        if not line:
+            raise Exception('harness server went away during %r' % command)
+        out = json.loads(line)
+        if isinstance(out, dict) and 'error' in out:
+            raise Exception(out['error'])
+        return out
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader.close()
+        if self.sock is not None:
+            self.sock.close()
+        if self.process is not None:
+            self.process.wait()
+        self.process = None
+        self.sock = None
+        self.reader = None
+        self.writer = None
@@ -0,0 +1,157 @@
+'''Drive a Harness through several topics at once.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+
+A system whose ``search`` and ``process_feedback`` wait on remote
+calls spends most of a run idle.  :class:`ConcurrentAmbassador` runs
+the ambassador loop for up to `concurrency` topics at a time, each
+topic in its own thread, so a run takes about as long as its slowest
+topics instead of the sum of all of them.
+'''
+
+from __future__ import absolute_import
+import logging
+import sys
+import threading
+
+from trec_dd.utils.timing import Timings, clock
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrentAmbassador(object):
+    '''Runs the loop of :meth:`HarnessAmbassadorCLI.run
+    <trec_dd.system.ambassador_cli.HarnessAmbassadorCLI.run>` for up
+    to `concurrency` topics at once.
+
+    `ambassador` is any of the ambassadors in :mod:`trec_dd.system`;
+    only its ``harness_command`` and ``close`` are used, one command
+    at a time.  The harness must allow at least `concurrency` active
+    topics, through ``max_active_topics`` in its config.
+
+    Each topic is driven by one thread, so its steps and its `stop`
+    happen in order.  The system's ``search`` and ``process_feedback``
+    are called from several threads at once, each for its own query.
+    '''
+
+    def __init__(self, ambassador, concurrency):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1, not %d'
+                             % concurrency)
+        harness = getattr(ambassador, 'harness', None)
+        if harness is not None and harness.max_active_topics < concurrency:
+            raise ValueError('the harness allows %d active topics; set its '
+                             'max_active_topics to at least %d'
+                             % (harness.max_active_topics, concurrency))
+        self.ambassador = ambassador
+        self.system = ambassador.system
+        self.batch_size = ambassador.batch_size
+        self.concurrency = concurrency
+        # one harness command at a time, whatever the transport
+        self.command_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.active_topics = set()
+        self.failed = threading.Event()
+        self.errors = []
+
+        self.num_topics = 0
+        # safe to add to from every topic's thread
+        self.timings = Timings()
+        self.total_start = clock()
+
+    def harness_command(self, command, *args):
+        with self.command_lock:
+            return self.ambassador.harness_command(command, *args)
+
+    def start(self):
+        '''Start the next topic, and return `(topic_id, query)`.'''
+        with self.command_lock:
+            out = self.ambassador.harness_command('start')
+            assert 'topic_id' in out, out
+            assert 'query' in out, out
+            topic_id = out['topic_id']
+            if topic_id is not None:
+                if topic_id in self.active_topics:
+                    raise Exception(
+                        'the harness handed out %r twice; set its '
+                        'max_active_topics to at least %d'
+                        % (topic_id, self.concurrency))
+                self.active_topics.add(topic_id)
+        return topic_id, out['query']
+
+    def stop(self, topic_id):
+        out = self.harness_command('stop', topic_id)
+        assert 'finished' in out, out
+        with self.command_lock:
+            self.active_topics.discard(topic_id)
+
+    def run_topic(self, topic_id, query):
+        '''Drive one topic from its first step to its `stop`.'''
+        logger.info('Starting topic %s', topic_id)
+        num_steps = 0
+        while not self.failed.is_set():
+            num_steps += 1
+            logger.info('Doing step %d for topic %s: %r',
+                        num_steps, topic_id, query)
+            with self.timings.timer('search'):
+                results = self.system.search(query, num_steps)
+            if not results:
+                break
+            assert len(results) % 2 == 0
+
+            with self.timings.timer('feedback'):
+                feedback = self.harness_command('step', topic_id, *results)
+            assert isinstance(feedback, list), feedback
+
+            with self.timings.timer('process_feedback'):
+                self.system.process_feedback(feedback)
+            if len(feedback) < self.batch_size:
+                break
+        else:
+            # another topic failed; leave this one unfinished
+            return
+        self.stop(topic_id)
+        with self.stats_lock:
+            self.num_topics += 1
+        logger.info('Stopped topic %s: %r', topic_id, query)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('timings: %s', self.timings.to_json())
+
+    def worker(self):
+        try:
+            while not self.failed.is_set():
+                topic_id, query = self.start()
+                if topic_id is None:
+                    break
+                self.run_topic(topic_id, query)
+        except Exception:
+            self.errors.append(sys.exc_info())
+            self.failed.set()
+
+    def run(self):
+        try:
+            out = self.harness_command('init')
+            assert 'num_topics' in out, out
+            threads = [threading.Thread(target=self.worker,
+                                        name='topic-worker-%d' % idx)
+                       for idx in xrange(self.concurrency)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.ambassador.close()
+        if self.errors:
+            # the first failure stopped the others, so report it
+            exc_type, exc_value, exc_tb = self.errors[0]
+            raise exc_type, exc_value, exc_tb
+        logger.info('finished %d topics in %.1f seconds, %.1f in search, '
+                    '%.1f in generating feedback, %.1f in processing '
+                    'feedback', self.num_topics,
+                    clock() - self.total_start,
+                    self.timings.total('search'),
+                    self.timings.total('feedback'),
+                    self.timings.total('process_feedback'))
+        logger.info('timings: %s', self.timings.to_json())
@@ -0,0 +1,50 @@
+'''Drive a Harness from the same Python process as the System.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+'''
+
+from __future__ import absolute_import
+import logging
+
+from trec_dd.harness.run import HarnessError
+from trec_dd.system.ambassador_cli import HarnessAmbassadorCLI
+
+logger = logging.getLogger(__name__)
+
+
+class InProcessAmbassador(HarnessAmbassadorCLI):
+    '''Facilitates the communication between a Harness and a System
+    that live in the same Python process.
+
+    This runs the same loop as :class:`HarnessAmbassadorCLI`, but
+    calls the :class:`~trec_dd.harness.run.Harness` methods directly,
+    so there is no subprocess or JSON round trip per command.  Errors
+    are raised as :class:`~trec_dd.harness.run.HarnessError`.
+
+    '''
+
+    def __init__(self, system, harness, batch_size=None):
+        if batch_size is None:
+            batch_size = harness.batch_size
+        super(InProcessAmbassador, self).__init__(system, None, batch_size)
+        self.harness = harness
+
+    def harness_command(self, command, *args):
+        if command == 'init':
+            out = self.harness.init()
+        elif command == 'start':
+            out = self.harness.start()
+        elif command == 'stop':
+            out = self.harness.stop(args[0])
+        elif command == 'step':
+            out = self.harness.step(args[0], list(args[1:]))
+        else:
+            raise HarnessError('unknown harness command: %r' % command)
+        if isinstance(out, dict) and 'error' in out:
+            raise HarnessError(out['error'])
+        return out
+
+    def close(self):
+        # make sure everything the harness wrote is in the run file
+        self.harness.close()
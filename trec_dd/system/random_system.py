@@ -10,7 +10,10 @@ from a set of known document ids.
 We feed this system into a HarnessAmbassador, which orchestrates the
 communication between the Harness and the system being
 evaluated. Because our random system is in python, we can use the
-Harness's python interface for simplicity.
+Harness's python interface for simplicity: by default the harness runs
+in this process and shares the label store loaded below.  Pass
+`--ambassador cli` or `--ambassador serve` to drive a separate
+`trec_dd_harness` process instead.
 '''
 from __future__ import absolute_import
 import argparse
@@ -26,9 +29,12 @@ from dossier.label import LabelStore
 import kvlayer
 import yakonfig
 
-from trec_dd.harness.run import Harness
-from trec_dd.harness.truth_data import parse_truth_data
-from trec_dd.system.ambassador_cli import HarnessAmbassadorCLI
+from trec_dd.harness.run import Harness, load_truth_data
+from trec_dd.utils.snapshot import TruthSnapshot
+from trec_dd.system.ambassador_cli import HarnessAmbassadorCLI, \
+    HarnessAmbassadorServer
+from trec_dd.system.ambassador_concurrent import ConcurrentAmbassador
+from trec_dd.system.ambassador_inprocess import InProcessAmbassador
 
 logger = logging.getLogger(__name__)
 
@@ -89,6 +95,8 @@ class StubDocumentStore(object):
                 yield doc_id
 
 def make_doc_store(label_store):
+    if isinstance(label_store, TruthSnapshot):
+        return make_doc_store_from_snapshot(label_store)
 
     all_topics = set()
     for label in label_store.everything():
@@ -118,6 +126,19 @@ def make_doc_store(label_store):
     doc_store = StubDocumentStore(topic_id_to_doc_ids)
     return doc_store
 
+def make_doc_store_from_snapshot(snapshot):
+    '''Build the same document store as :func:`make_doc_store` from a
+    compiled truth snapshot.
+    '''
+    topic_id_to_doc_ids = defaultdict(set)
+    for topic_id, query in snapshot.topics().iteritems():
+        for doc_id in snapshot.doc_ids(topic_id):
+            if not doc_id.strip():
+                logger.warn('skipping bogus document identifer: %r' % doc_id)
+                continue
+            topic_id_to_doc_ids[query].add(doc_id)
+    return StubDocumentStore(topic_id_to_doc_ids)
+
 def main():
     '''Run the random recommender system on a sequence of topics.
     '''
@@ -130,6 +151,15 @@ def main():
                    ' particular quality metric.')
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('--overwrite', action='store_true')
+    parser.add_argument('--ambassador', default='inprocess',
+                        choices=['inprocess', 'serve', 'cli'],
+                        help='how to talk to the harness: in this process, '
+                        'through one `trec_dd_harness serve` process, or '
+                        'one `trec_dd_harness` process per command')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='number of topics to run at once; with '
+                        '--ambassador serve or cli, the harness config '
+                        'must set max_active_topics at least this high')
     args = yakonfig.parse_args(parser, [yakonfig])
 
     logging.basicConfig(level=logging.DEBUG)
@@ -149,12 +179,27 @@ def main():
     kvl = kvlayer.client(kvl_config)
     label_store = LabelStore(kvl)
 
-    parse_truth_data(label_store, config['truth_data_path'])
+    snapshot = None
+    if config.get('truth_snapshot_path'):
+        snapshot = TruthSnapshot(config['truth_snapshot_path'])
+        doc_store = make_doc_store(snapshot)
+    else:
+        load_truth_data(kvl, label_store, config['truth_data_path'])
+        doc_store = make_doc_store(label_store)
 
     # Set up the system
-    doc_store = make_doc_store(label_store)
     system = RandomSystem(doc_store)
-    ambassador = HarnessAmbassadorCLI(system, args.config, batch_size)
+    if args.ambassador == 'inprocess':
+        if args.concurrency > config.get('max_active_topics', 1):
+            config = dict(config, max_active_topics=args.concurrency)
+        harness = Harness(config, kvl, label_store, snapshot=snapshot)
+        ambassador = InProcessAmbassador(system, harness, batch_size)
+    elif args.ambassador == 'serve':
+        ambassador = HarnessAmbassadorServer(system, args.config, batch_size)
+    else:
+        ambassador = HarnessAmbassadorCLI(system, args.config, batch_size)
+    if args.concurrency > 1:
+        ambassador = ConcurrentAmbassador(ambassador, args.concurrency)
     ambassador.run()
 
 
@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+
+from dossier.label import LabelStore
+import csv
+import kvlayer
+import os
+import pytest
+import threading
+
+from trec_dd.harness.run import Harness, HarnessError
+from trec_dd.harness.tests.test_harness import local_kvl
+from trec_dd.system.ambassador_concurrent import ConcurrentAmbassador
+from trec_dd.system.ambassador_inprocess import InProcessAmbassador
+from trec_dd.system.random_system import RandomSystem, make_doc_store
+
+
+def test_inprocess_run(local_kvl, tmpdir):
+    run_file_path = os.path.join(str(tmpdir), 'runfile.txt')
+    label_store = LabelStore(local_kvl)
+    harness = Harness(dict(run_file_path=run_file_path),
+                      local_kvl, label_store)
+    system = RandomSystem(make_doc_store(label_store))
+    ambassador = InProcessAmbassador(system, harness)
+    ambassador.run()
+
+    assert ambassador.num_topics == 3
+    rows = list(csv.reader(open(run_file_path), delimiter='\t'))
+    assert sorted(set(row[0] for row in rows)) == ['0', '1', '2']
+    # each topic has three documents, all submitted in one short batch
+    assert len(rows) == 9
+    for name in ['search', 'feedback', 'process_feedback']:
+        assert ambassador.timings.histograms[name].count == 3
+    assert harness.timings.histograms['step'].count == 3
+
+
+def test_inprocess_raises(local_kvl):
+    label_store = LabelStore(local_kvl)
+    harness = Harness(dict(), local_kvl, label_store)
+    ambassador = InProcessAmbassador(None, harness)
+    ambassador.init_harness()
+    ambassador.start()
+    with pytest.raises(HarnessError):
+        ambassador.harness_command('stop', 'not-a-topic')
+
+
+class BarrierSystem(object):
+    '''Submits each query's documents in sorted order, and holds every
+    first search until `num_topics` queries are being searched at once.
+    '''
+
+    def __init__(self, doc_store, num_topics):
+        self.doc_store = doc_store
+        self.num_topics = num_topics
+        self.searching = set()
+        self.all_searching = threading.Event()
+        self.lock = threading.Lock()
+
+    def search(self, query, page_number):
+        if page_number == 1:
+            with self.lock:
+                self.searching.add(query)
+                if len(self.searching) == self.num_topics:
+                    self.all_searching.set()
+            assert self.all_searching.wait(5), 'topics ran one at a time'
+        elif page_number > 1:
+            return []
+        doc_ids = sorted(self.doc_store.scan_ids(query))
+        return sum([[doc_id, 500] for doc_id in doc_ids], [])
+
+    def process_feedback(self, feedback):
+        pass
+
+
+def test_concurrent_run(local_kvl, tmpdir):
+    run_file_path = os.path.join(str(tmpdir), 'runfile.txt')
+    label_store = LabelStore(local_kvl)
+    harness = Harness(dict(run_file_path=run_file_path, batch_size=5,
+                           max_active_topics=3),
+                      local_kvl, label_store)
+    system = BarrierSystem(make_doc_store(label_store), 3)
+    ambassador = ConcurrentAmbassador(InProcessAmbassador(system, harness),
+                                      concurrency=3)
+    ambassador.run()
+
+    assert ambassador.num_topics == 3
+    rows = list(csv.reader(open(run_file_path), delimiter='\t'))
+    assert len(rows) == 9
+    assert ambassador.timings.histograms['feedback'].count == 3
+    # each topic's rows are together, with the documents in order
+    topic_ids = [row[0] for row in rows]
+    assert sorted(set(topic_ids)) == ['0', '1', '2']
+    assert all(topic_ids[idx] == topic_ids[idx - idx % 3]
+               for idx in xrange(9))
+    for start in xrange(0, 9, 3):
+        doc_ids = [row[2] for row in rows[start:start + 3]]
+        assert doc_ids == sorted(doc_ids)
+
+
+def test_concurrent_needs_active_topics(local_kvl):
+    label_store = LabelStore(local_kvl)
+    harness = Harness(dict(), local_kvl, label_store)
+    system = RandomSystem(make_doc_store(label_store))
+    with pytest.raises(ValueError) as excinfo:
+        ConcurrentAmbassador(InProcessAmbassador(system, harness),
+                             concurrency=2)
+    assert 'max_active_topics' in str(excinfo.value)
+
+
+def test_random_system_main(tmpdir, monkeypatch):
+    import yakonfig
+    from trec_dd.harness.tests.test_truth_data import truth_data_path
+    from trec_dd.system import random_system
+    run_file_path = str(tmpdir.join('runfile.txt'))
+    config_path = str(tmpdir.join('config.yaml'))
+    with open(config_path, 'w') as fh:
+        fh.write('harness:\n  truth_data_path: %s\n  run_file_path: %s\n'
+                 % (truth_data_path, run_file_path))
+    # the random system loads the truth data into a fresh local store
+    kvlayer.client(config={}, storage_type='local', namespace='test',
+                   app_name='test').delete_namespace()
+    monkeypatch.setattr('sys.argv', ['trec_dd_random_system',
+                                     '-c', config_path])
+    try:
+        random_system.main()
+    finally:
+        yakonfig.clear_global_config()
+
+    rows = list(csv.reader(open(run_file_path), delimiter='\t'))
+    assert sorted(set(row[0] for row in rows)) == \
+        ['DD15-1', 'DD15-2', 'DD15-3']
+    assert any(row[4] == '1' for row in rows)
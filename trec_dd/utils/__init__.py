@@ -5,8 +5,15 @@
 
 '''
 from collections import defaultdict
+import itertools
+
+from dossier.label import CorefValue
 
 def get_all_subtopics(label_store, topic_id):
+    if hasattr(label_store, 'all_subtopics'):
+        # a TruthSnapshot already knows each topic's subtopics
+        return label_store.all_subtopics(topic_id)
+
     labels = label_store.directly_connected(topic_id)
 
     def subtopic_from_label(label):
@@ -29,6 +36,77 @@ def get_all_subtopics(label_store, topic_id):
     return subtopics
 
 
+def get_topic_qrels(label_store, topic_id):
+    '''Return the graded judgments of `topic_id`, as a dict mapping
+    each doc_id to a dict of subtopic_id to the list of ratings its
+    passages got.  Negative labels are left out.
+    '''
+    if hasattr(label_store, 'topic_qrels'):
+        return label_store.topic_qrels(topic_id)
+
+    qrels = defaultdict(lambda: defaultdict(list))
+    for label in label_store.directly_connected(topic_id):
+        if label.value == CorefValue.Negative:
+            continue
+        qrels[label.other(topic_id)][label.subtopic_for(topic_id)].append(
+            label.rating)
+    return qrels
+
+
+class SubtopicUniverse(object):
+    '''The set of subtopic ids of every topic, gathered in one pass
+    over a label store.
+
+    Scorers call :func:`get_all_subtopics` once per topic.  On a
+    :class:`dossier.label.LabelStore` each call is a
+    ``directly_connected`` scan, and every scorer repeats them.
+    Passing a :class:`SubtopicUniverse` in place of the label store
+    makes each of those calls a dictionary lookup.
+
+    If `topic_ids` is given, only those topics are kept, and a label
+    counts for a topic if either of its content ids is that topic,
+    exactly as with ``directly_connected``.  Otherwise each label
+    counts for the topic named in its ``meta['topic_id']``.
+
+    The same pass keeps every topic's judgments for
+    :func:`get_topic_qrels`.
+    '''
+
+    def __init__(self, label_store, topic_ids=None):
+        self.subtopics = defaultdict(set)
+        self.qrels = defaultdict(
+            lambda: defaultdict(lambda: defaultdict(list)))
+        if topic_ids is not None:
+            topic_ids = set(topic_ids)
+        for label in label_store.everything():
+            if topic_ids is None:
+                topic_id = label.meta.get('topic_id')
+                if topic_id in (label.content_id1, label.content_id2):
+                    self._add(topic_id, label)
+                continue
+            for content_id in (label.content_id1, label.content_id2):
+                if content_id in topic_ids:
+                    self._add(content_id, label)
+
+    def _add(self, topic_id, label):
+        subtopic_id = label.subtopic_for(topic_id)
+        self.subtopics[topic_id].add(subtopic_id)
+        if label.value != CorefValue.Negative:
+            self.qrels[topic_id][label.other(topic_id)][subtopic_id].append(
+                label.rating)
+
+    def all_subtopics(self, topic_id):
+        '''Return the distinct subtopic ids labeled for `topic_id`.
+        '''
+        return list(self.subtopics.get(topic_id, ()))
+
+    def topic_qrels(self, topic_id):
+        '''Return the judgments of `topic_id`, as
+        :func:`get_topic_qrels` does.
+        '''
+        return self.qrels.get(topic_id, {})
+
+
 def get_best_subtopics(subtopic_pairs):
     '''Return the instance of each subtopic with the highest rating.
     '''
@@ -40,3 +118,46 @@ def get_best_subtopics(subtopic_pairs):
         best = max(data, key=lambda d: d[1])
         subtopics.append(best)
     return subtopics
+
+
+def labels_by_topic_and_doc(labels):
+    '''Group `labels` by the (topic_id, doc_id) pair they connect.
+
+    The topic side of each label is the one named by its
+    ``meta['topic_id']``.  Within each pair, labels are in the order
+    ``LabelStore.directly_connected(doc_id)`` would produce them.
+    '''
+    by_pair = defaultdict(list)
+    for label in labels:
+        topic_id = label.meta['topic_id']
+        if topic_id in (label.content_id1, label.content_id2):
+            by_pair[(topic_id, label.other(topic_id))].append(label)
+    for (topic_id, doc_id), pair_labels in by_pair.iteritems():
+        sort_pair_labels(topic_id, doc_id, pair_labels)
+    return by_pair
+
+
+def sort_pair_labels(topic_id, doc_id, labels):
+    '''Sort the `labels` between `topic_id` and `doc_id` in place, in
+    the order ``LabelStore.directly_connected(doc_id)`` produces them.
+    '''
+    labels.sort(key=lambda l: (l.subtopic_for(doc_id),
+                               l.subtopic_for(topic_id),
+                               l.annotator_id))
+
+
+def topic_labels_by_doc(label_store, topic_id):
+    '''Yield `((topic_id, doc_id), labels)` for every document with
+    labels for `topic_id`, as :func:`labels_by_topic_and_doc` groups
+    them, holding only one document's labels at a time.
+
+    ``directly_connected(topic_id)`` comes back sorted by the other
+    content id, so each document's labels are already together.
+    '''
+    labels = (label for label in label_store.directly_connected(topic_id)
+              if label.meta['topic_id'] == topic_id)
+    for doc_id, pair_labels in itertools.groupby(
+            labels, key=lambda label: label.other(topic_id)):
+        pair_labels = list(pair_labels)
+        sort_pair_labels(topic_id, doc_id, pair_labels)
+        yield (topic_id, doc_id), pair_labels
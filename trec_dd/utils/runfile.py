@@ -0,0 +1,734 @@
+'''trec_dd.utils.runfile reads and writes TREC DD run files.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+
+A run file is the record of a system's session with the harness.  The
+harness always writes it as tab-separated text, one line per result::
+
+  <topic> <iteration> <document-id> <confidence> <on_topic> <subtopic data>
+
+where the subtopic data is ``NULL`` or a pipe-delimited list of
+``subtopic_id:rating`` pairs.
+
+If ``binary_run_path`` is set in the ``harness`` section of
+config.yaml, the harness also writes a columnar binary run to that
+directory.  Reading it back is a handful of :class:`numpy.memmap`
+calls, with no text to parse or check.  All integers are
+little-endian.  The directory holds:
+
+``FORMAT``
+  the line ``trec_dd binary run 1``
+``ids``
+  the dictionary of topic and subtopic ids, one per line; an id's
+  code is its line number, counting from zero
+``steps``
+  the topic/iteration index: one ``(topic, iteration, first_row,
+  num_rows)`` row of uint32 per harness step
+``confidence``, ``on_topic``
+  one float64 and one uint8 per result
+``stream_end``, ``stream_ids``
+  document ids: the uint64 end offset of each result's id in the
+  bytes of ``stream_ids``
+``subtopic_end``, ``subtopics``, ``ratings``
+  subtopic data: the uint64 end offset of each result's entries in
+  ``subtopics`` (uint32 id codes) and ``ratings`` (int32)
+
+A step's row in ``steps`` is written after its data, so a run that
+was interrupted mid-step reads as if the step never happened, and the
+next writer truncates the leftovers.
+
+``trec_dd_convert_run`` converts a run between the two forms.
+'''
+
+from __future__ import absolute_import, print_function
+import argparse
+import bisect
+import os
+import shutil
+import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BINARY_FORMAT = 'trec_dd binary run 1\n'
+
+#: binary run column name -> struct format character, packed
+#: little-endian in its standard size, and numpy dtype
+COLUMNS = {
+    'steps': ('I', '<u4'),
+    'confidence': ('d', '<f8'),
+    'on_topic': ('B', '<u1'),
+    'stream_end': ('Q', '<u8'),
+    'subtopic_end': ('Q', '<u8'),
+    'subtopics': ('I', '<u4'),
+    'ratings': ('i', '<i4'),
+}
+
+
+class Result(object):
+    '''One line of a run file.
+
+    Results are read like the dicts :func:`trec_dd.scorer.run.load_run`
+    used to return, as ``result['rank']`` and so on, but keep their
+    fields in slots.  Subtopic ids are interned, so each distinct id
+    is stored once per process however many results mention it.
+    '''
+    __slots__ = ('rank', 'iteration', 'stream_id', 'confidence', 'on_topic',
+                 'subtopics')
+
+    def __init__(self, rank, iteration, stream_id, confidence, on_topic,
+                 subtopics):
+        self.rank = rank
+        self.iteration = iteration
+        self.stream_id = stream_id
+        self.confidence = confidence
+        self.on_topic = on_topic
+        #: tuple of (subtopic_id, rating) pairs
+        self.subtopics = subtopics
+
+    # scorers look fields up by name, as they did with dicts
+    __getitem__ = object.__getattribute__
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+def json_default(obj):
+    '''`default` for :func:`json.dumps` of runs holding :class:`Result`.
+    '''
+    if isinstance(obj, Result):
+        return obj.to_dict()
+    if isinstance(obj, TopicResults):
+        return list(obj)
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+#: one line of a text run file:
+#: <topic> <iteration> <document-id> <confidence> <on_topic> <subtopic data>
+RUN_LINE = '%s\t%s\t%s\t%.6f\t%d\t%s\n'
+
+
+def format_run_line(topic_id, iteration, stream_id, confidence, on_topic,
+                    subtopics):
+    '''Return one line of a text run file; `subtopics` is a sequence of
+    (subtopic_id, rating) pairs.
+    '''
+    if subtopics:
+        subtopic_stanza = '|'.join('%s:%d' % pair for pair in subtopics)
+    else:
+        subtopic_stanza = 'NULL'
+    return RUN_LINE % (topic_id, iteration, stream_id, confidence, on_topic,
+                       subtopic_stanza)
+
+
+class RunFileWriter(object):
+    '''Append to a text run file through one buffered file handle.
+
+    The file is opened on the first write and stays open until
+    :meth:`close`.  Written lines reach the file when :meth:`flush` is
+    called, which happens after every step if `flush_every` is
+    ``'step'``, or only at each topic's :meth:`stop` if it is
+    ``'stop'``.  If `fsync` is true, every flush also waits for the
+    operating system to put the file on disk.
+    '''
+
+    flush_choices = ('step', 'stop')
+
+    def __init__(self, path, flush_every='step', fsync=False,
+                 buffer_size=1 << 16):
+        if flush_every not in self.flush_choices:
+            raise ValueError('flush_every must be one of %r, not %r'
+                             % (self.flush_choices, flush_every))
+        self.path = path
+        self.flush_every = flush_every
+        self.fsync = fsync
+        self.buffer_size = buffer_size
+        self.fh = None
+
+    def write_step(self, topic_id, iteration, rows):
+        '''Write one step of `topic_id`.  `rows` are `(stream_id,
+        confidence, on_topic, subtopics)` tuples, with `subtopics` a
+        sequence of (subtopic_id, rating) pairs.
+        '''
+        if self.fh is None:
+            # *append* to the run file
+            self.fh = open(self.path, 'ab', self.buffer_size)
+        self.fh.write(''.join([
+            format_run_line(topic_id, iteration, stream_id, confidence,
+                            on_topic, subtopics)
+            for stream_id, confidence, on_topic, subtopics in rows]))
+        if self.flush_every == 'step':
+            self.flush()
+
+    def append_file(self, path):
+        '''Copy the lines of the text run file at `path` to the end of
+        this one, as one step.
+        '''
+        if self.fh is None:
+            self.fh = open(self.path, 'ab', self.buffer_size)
+        with open(path, 'rb') as fh:
+            shutil.copyfileobj(fh, self.fh, self.buffer_size)
+        if self.flush_every == 'step':
+            self.flush()
+
+    def stop(self):
+        '''Mark the end of a topic.'''
+        self.flush()
+
+    def size(self):
+        '''Flush, and return the size of the run file in bytes.'''
+        self.flush()
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path)
+
+    def flush(self):
+        if self.fh is None:
+            return
+        self.fh.flush()
+        if self.fsync:
+            os.fsync(self.fh.fileno())
+
+    def close(self):
+        if self.fh is None:
+            return
+        self.flush()
+        self.fh.close()
+        self.fh = None
+
+
+def truncate_text_run(path, size):
+    '''Cut the text run file at `path` back to its first `size` bytes,
+    and return the number of bytes cut off.
+
+    Raises :exc:`ValueError` if the file is shorter than `size`, or
+    if its first `size` bytes do not end with a whole line.
+    '''
+    actual = os.path.getsize(path) if os.path.exists(path) else 0
+    if actual < size:
+        raise ValueError('%r has %d bytes, fewer than the %d expected'
+                         % (path, actual, size))
+    if size > 0:
+        with open(path, 'rb') as fh:
+            fh.seek(size - 1)
+            if fh.read(1) != '\n':
+                raise ValueError('%r does not end a line at byte %d'
+                                 % (path, size))
+        _truncate(path, size)
+    elif actual > 0:
+        open(path, 'wb').close()
+    return actual - size
+
+
+def is_binary_run(path):
+    return os.path.isfile(os.path.join(path, 'FORMAT'))
+
+
+def iter_run(run_file_path):
+    '''Read a run file one topic at a time, checking its validity.
+
+    Yields `(topic_id, results)` for each topic in the order of the
+    run file, where `results` is a sequence of :class:`Result` in rank
+    order.  Only one topic's results are in memory at a time.
+    `run_file_path` may also be a binary run directory.
+    '''
+    if is_binary_run(run_file_path):
+        return BinaryRun(run_file_path).iter_topics()
+    return iter_text_run(run_file_path)
+
+
+def iter_text_run(run_file_path, offset=0):
+    ''':func:`iter_run` for text run files, starting `offset` bytes
+    into the file.
+
+    Raises :exc:`ValueError`, giving the byte offset of the line, if
+    the run file is invalid.
+    '''
+    def invalid(message):
+        where = 'byte %d' % pos
+        if offset == 0:
+            where = 'line %d (%s)' % (line_idx + 1, where)
+        return ValueError('%r is invalid at %s: %s'
+                          % (run_file_path, where, message))
+
+    prev_topic_id = None
+    seen_topic_ids = set()
+    results = []
+    no_subtopics = ()
+    with open(run_file_path) as fh:
+        fh.seek(offset)
+        next_pos = offset
+        for line_idx, line in enumerate(fh):
+            pos = next_pos
+            next_pos += len(line)
+            if line.startswith('#'): continue
+            parts = line.split()
+            if len(parts) != 6:
+                raise invalid('the line has %d parts instead of 6'
+                              % len(parts))
+
+            topic_id, iteration, stream_id, confidence, on_topic, subtopics_and_ratings = parts
+            on_topic = bool(int(on_topic))
+            confidence = float(confidence)
+
+            if prev_topic_id != topic_id:
+                ## switching to a new topic!!!
+                if topic_id in seen_topic_ids:
+                    raise invalid('it returns to the finished topic %r'
+                                  % topic_id)
+                if prev_topic_id is not None:
+                    yield prev_topic_id, results
+                results = []
+                seen_topic_ids.add(topic_id)
+                prev_topic_id = intern(topic_id)
+
+            if subtopics_and_ratings == 'NULL':
+                assert on_topic is False, (line, subtopics_and_ratings)
+                subtopics = no_subtopics
+            else:
+                subtopics = []
+                for rec in subtopics_and_ratings.split('|'):
+                    subtopic_id, rating = rec.split(':')
+                    subtopics.append((intern(subtopic_id), int(rating)))
+                subtopics = tuple(subtopics)
+
+            results.append(Result(len(results) + 1, int(iteration),
+                                  stream_id, confidence, on_topic,
+                                  subtopics))
+
+    if prev_topic_id is not None:
+        yield prev_topic_id, results
+
+
+def _pack(name, values):
+    '''Pack `values` as the column `name` is stored, whatever the
+    platform's sizes and byte order.
+    '''
+    return struct.pack('<%d%s' % (len(values), COLUMNS[name][0]), *values)
+
+
+def _truncate(path, size):
+    if os.path.getsize(path) > size:
+        with open(path, 'r+b') as fh:
+            fh.truncate(size)
+
+
+class BinaryRunWriter(object):
+    '''Append harness steps to a binary run directory at `path`,
+    creating it if needed.
+
+    Like :class:`RunFileWriter`, this opens its column files on the
+    first write and keeps buffered handles to them until :meth:`close`,
+    flushing after every step if `flush_every` is ``'step'``, or only
+    at each topic's :meth:`stop` if it is ``'stop'``, and syncing each
+    flush to disk if `fsync` is true.  The rows of the ``steps`` index
+    are held back until the columns they point into are flushed, so a
+    crash never leaves an index row without its data.
+
+    On opening the files, it reads the id dictionary and the size of
+    the run, and cuts off anything an unfinished step left behind, so
+    any number of processes may take turns writing the same run, as
+    harness commands do, as long as each closes the writer before the
+    next one writes.
+    '''
+
+    files = ('ids', 'stream_ids') + tuple(sorted(COLUMNS))
+
+    def __init__(self, path, flush_every='step', fsync=False,
+                 buffer_size=1 << 16):
+        if flush_every not in RunFileWriter.flush_choices:
+            raise ValueError('flush_every must be one of %r, not %r'
+                             % (RunFileWriter.flush_choices, flush_every))
+        self.path = path
+        self.flush_every = flush_every
+        self.fsync = fsync
+        self.buffer_size = buffer_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if not is_binary_run(path):
+            for name in self.files:
+                open(self._path(name), 'ab').close()
+            with open(self._path('FORMAT'), 'wb') as fh:
+                fh.write(BINARY_FORMAT)
+        #: file name -> open handle, or None when closed
+        self.fhs = None
+        #: packed ``steps`` rows not yet written
+        self.pending_steps = []
+
+    def _path(self, name):
+        return os.path.join(self.path, name)
+
+    def _last(self, name, size, default=0):
+        '''Return the last of the first `size` values of a column.'''
+        if size == 0:
+            return default
+        itemsize = int(COLUMNS[name][1][2:])
+        with open(self._path(name), 'rb') as fh:
+            fh.seek((size - 1) * itemsize)
+            return struct.unpack('<' + COLUMNS[name][0],
+                                 fh.read(itemsize))[0]
+
+    def recover(self):
+        '''Read the id dictionary and the size of the run, and cut off
+        anything a step that did not finish left behind.
+        '''
+        with open(self._path('ids'), 'rb') as fh:
+            ids = fh.read()
+        if ids and not ids.endswith('\n'):
+            ids = ids[:ids.rfind('\n') + 1]
+            _truncate(self._path('ids'), len(ids))
+        self.ids = dict((i, code) for code, i in enumerate(ids.splitlines()))
+
+        step_size = 4 * int(COLUMNS['steps'][1][2:])
+        num_steps = os.path.getsize(self._path('steps')) // step_size
+        _truncate(self._path('steps'), num_steps * step_size)
+        num_rows = 0
+        if num_steps:
+            num_rows = self._last('steps', 4 * num_steps - 1) + \
+                self._last('steps', 4 * num_steps)
+        self.steps_written = num_steps
+        self.num_rows = num_rows
+
+        for name in ('confidence', 'on_topic', 'stream_end', 'subtopic_end'):
+            _truncate(self._path(name), num_rows * int(COLUMNS[name][1][2:]))
+        self.stream_bytes = self._last('stream_end', num_rows)
+        _truncate(self._path('stream_ids'), self.stream_bytes)
+        self.num_subtopics = self._last('subtopic_end', num_rows)
+        for name in ('subtopics', 'ratings'):
+            _truncate(self._path(name),
+                      self.num_subtopics * int(COLUMNS[name][1][2:]))
+
+    def _open(self):
+        self.recover()
+        self.fhs = dict((name, open(self._path(name), 'ab',
+                                    self.buffer_size))
+                        for name in self.files)
+
+    def num_steps(self):
+        '''Flush, and return the number of steps in the run.'''
+        if self.fhs is not None:
+            self.flush()
+            return self.steps_written
+        step_size = 4 * int(COLUMNS['steps'][1][2:])
+        return os.path.getsize(self._path('steps')) // step_size
+
+    def truncate(self, num_steps):
+        '''Cut the run back to its first `num_steps` steps.'''
+        self.close()
+        if self.num_steps() < num_steps:
+            raise ValueError('%r has %d steps, fewer than the %d expected'
+                             % (self.path, self.num_steps(), num_steps))
+        step_size = 4 * int(COLUMNS['steps'][1][2:])
+        _truncate(self._path('steps'), num_steps * step_size)
+        self.recover()
+
+    def code(self, id_, new_ids):
+        '''Return the dictionary code of `id_`, adding it if needed.'''
+        if id_ not in self.ids:
+            self.ids[id_] = len(self.ids)
+            new_ids.append(id_)
+        return self.ids[id_]
+
+    def append_step(self, topic_id, iteration, rows):
+        '''Append one step of `topic_id`.  `rows` are `(stream_id,
+        confidence, on_topic, subtopics)` tuples, with `subtopics` a
+        sequence of (subtopic_id, rating) pairs.
+        '''
+        self.append_steps([(topic_id, iteration, rows)])
+
+    def append_steps(self, steps):
+        '''Append several `(topic_id, iteration, rows)` steps at once.'''
+        if self.fhs is None:
+            self._open()
+
+        new_ids = []
+        columns = dict((name, []) for name in COLUMNS)
+        stream_ids = []
+        num_rows = self.num_rows
+        stream_bytes = self.stream_bytes
+        num_subtopics = self.num_subtopics
+        for topic_id, iteration, rows in steps:
+            columns['steps'].extend([self.code(topic_id, new_ids),
+                                     int(iteration), num_rows, len(rows)])
+            num_rows += len(rows)
+            for stream_id, conf, topical, row_subtopics in rows:
+                stream_ids.append(stream_id)
+                stream_bytes += len(stream_id)
+                columns['stream_end'].append(stream_bytes)
+                columns['confidence'].append(conf)
+                columns['on_topic'].append(int(bool(topical)))
+                for subtopic_id, rating in row_subtopics:
+                    columns['subtopics'].append(
+                        self.code(subtopic_id, new_ids))
+                    columns['ratings'].append(rating)
+                num_subtopics += len(row_subtopics)
+                columns['subtopic_end'].append(num_subtopics)
+
+        if new_ids:
+            self.fhs['ids'].write(''.join(i + '\n' for i in new_ids))
+        self.fhs['stream_ids'].write(''.join(stream_ids))
+        for name in sorted(COLUMNS):
+            if name != 'steps':
+                self.fhs[name].write(_pack(name, columns[name]))
+        # the steps are only part of the run once `flush` writes this
+        self.pending_steps.append(_pack('steps', columns['steps']))
+
+        self.steps_written += len(steps)
+        self.num_rows = num_rows
+        self.stream_bytes = stream_bytes
+        self.num_subtopics = num_subtopics
+        if self.flush_every == 'step':
+            self.flush()
+
+    def stop(self):
+        '''Mark the end of a topic.'''
+        self.flush()
+
+    def flush(self):
+        '''Write out the columns, and then the index rows of the steps
+        appended since the last flush.
+        '''
+        if self.fhs is None:
+            return
+        for name in self.files:
+            if name == 'steps':
+                continue
+            self.fhs[name].flush()
+            if self.fsync:
+                os.fsync(self.fhs[name].fileno())
+        if self.pending_steps:
+            fh = self.fhs['steps']
+            fh.write(''.join(self.pending_steps))
+            self.pending_steps = []
+            fh.flush()
+            if self.fsync:
+                os.fsync(fh.fileno())
+
+    def close(self):
+        if self.fhs is None:
+            return
+        self.flush()
+        for fh in self.fhs.itervalues():
+            fh.close()
+        self.fhs = None
+
+
+class TopicResults(object):
+    '''The results of one topic of a :class:`BinaryRun`.
+
+    This is a sequence of :class:`Result`, built as they are read, and
+    also exposes the topic's slices of the run's columns.
+    '''
+
+    def __init__(self, run, steps, start, stop):
+        self.run = run
+        self.steps = steps
+        self.start = start
+        self.stop = stop
+        self.first_rows = [step[2] for step in steps]
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        rank = 1
+        for _, iteration, first_row, num_rows in self.steps:
+            for row in xrange(first_row, first_row + num_rows):
+                yield self._result(row, rank, int(iteration))
+                rank += 1
+
+    def _result(self, row, rank, iteration):
+        run = self.run
+        s0 = run.subtopic_start(row)
+        s1 = int(run.subtopic_end[row])
+        if s1 > s0:
+            ids = run.ids
+            subtopics = tuple(
+                (ids[code], rating) for code, rating in
+                zip(run.subtopics[s0:s1].tolist(),
+                    run.ratings[s0:s1].tolist()))
+        else:
+            subtopics = ()
+        return Result(rank, iteration, run.stream_id(row),
+                      float(run.confidence[row]),
+                      bool(run.on_topic[row]), subtopics)
+
+    def _at(self, idx):
+        # a topic's steps cover its rows contiguously, in rank order
+        row = self.start + idx
+        step = bisect.bisect_right(self.first_rows, row) - 1
+        return self._result(row, idx + 1, int(self.steps[step][1]))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._at(i) for i in xrange(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return self._at(idx)
+
+    def columns(self):
+        '''Return `(on_topic, rows, subtopics, ratings)` arrays for this
+        topic: a boolean per result, and for every subtopic entry, its
+        result's offset within the topic, its subtopic code in
+        :attr:`BinaryRun.ids` and its rating.
+        '''
+        run = self.run
+        s0 = run.subtopic_start(self.start)
+        s1 = int(run.subtopic_end[self.stop - 1])
+        ends = run.subtopic_end[self.start:self.stop].astype(np.int64) - s0
+        counts = np.diff(np.concatenate([[0], ends]))
+        rows = np.repeat(np.arange(len(self)), counts)
+        return (run.on_topic[self.start:self.stop].astype(bool), rows,
+                run.subtopics[s0:s1], run.ratings[s0:s1])
+
+
+class BinaryRun(object):
+    '''Read-only view of a binary run directory at `path`.
+
+    Opening one maps its columns with :class:`numpy.memmap`, which
+    takes about the same time for any size of run.
+    '''
+
+    def __init__(self, path):
+        if np is None:
+            raise ImportError('reading binary runs requires numpy')
+        self.path = path
+        with open(os.path.join(path, 'FORMAT'), 'rb') as fh:
+            if fh.read() != BINARY_FORMAT:
+                raise ValueError('%r is not a binary run' % path)
+        with open(os.path.join(path, 'ids'), 'rb') as fh:
+            self.ids = [intern(i) for i in fh.read().split('\n')[:-1]]
+        self.steps = self._map('steps').reshape(-1, 4)
+        self.num_rows = 0
+        if len(self.steps):
+            self.num_rows = int(self.steps[-1, 2] + self.steps[-1, 3])
+        for name in ('confidence', 'on_topic', 'stream_end', 'subtopic_end'):
+            setattr(self, name, self._map(name, self.num_rows))
+        num_subtopics = int(self.subtopic_end[-1]) if self.num_rows else 0
+        self.subtopics = self._map('subtopics', num_subtopics)
+        self.ratings = self._map('ratings', num_subtopics)
+        num_bytes = int(self.stream_end[-1]) if self.num_rows else 0
+        self.stream_ids = self._map('stream_ids', num_bytes, dtype='S1')
+
+    def _map(self, name, length=None, dtype=None):
+        path = os.path.join(self.path, name)
+        if dtype is None:
+            dtype = COLUMNS[name][1]
+        dtype = np.dtype(dtype)
+        available = os.path.getsize(path) // dtype.itemsize
+        if name == 'steps':
+            available -= available % 4
+        if length is None:
+            length = available
+        if length == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(length,))
+
+    def subtopic_start(self, row):
+        return int(self.subtopic_end[row - 1]) if row else 0
+
+    def stream_id(self, row):
+        start = int(self.stream_end[row - 1]) if row else 0
+        return self.stream_ids[start:self.stream_end[row]].tostring()
+
+    def iter_topics(self):
+        '''Yield `(topic_id, results)` for each topic, in run order,
+        where `results` is a :class:`TopicResults`.
+        '''
+        steps = self.steps.tolist()
+        seen_topic_codes = set()
+        idx = 0
+        while idx < len(steps):
+            topic_code = steps[idx][0]
+            if topic_code in seen_topic_codes:
+                raise ValueError('binary run %r returns to topic %r'
+                                 % (self.path, self.ids[topic_code]))
+            seen_topic_codes.add(topic_code)
+            end = idx
+            while end < len(steps) and steps[end][0] == topic_code:
+                end += 1
+            topic_steps = steps[idx:end]
+            start = topic_steps[0][2]
+            stop = topic_steps[-1][2] + topic_steps[-1][3]
+            if stop > start:
+                yield (self.ids[topic_code],
+                       TopicResults(self, topic_steps, start, stop))
+            idx = end
+
+
+def steps_from_results(topic_id, results):
+    '''Group one topic's `results` back into the `(topic_id, iteration,
+    rows)` steps of :meth:`BinaryRunWriter.append_steps`.
+    '''
+    steps = []
+    for result in results:
+        if not steps or steps[-1][1] != result.iteration:
+            steps.append((topic_id, result.iteration, []))
+        steps[-1][2].append((result.stream_id, result.confidence,
+                             result.on_topic, result.subtopics))
+    return steps
+
+
+def text_to_binary(run_file_path, binary_run_path):
+    '''Convert a text run file to a new binary run, and return the
+    number of results converted.
+    '''
+    if os.path.exists(binary_run_path):
+        raise ValueError('%r already exists' % binary_run_path)
+    writer = BinaryRunWriter(binary_run_path, flush_every='stop')
+    num_results = 0
+    for topic_id, results in iter_text_run(run_file_path):
+        # one step per iteration, written a topic at a time
+        writer.append_steps(steps_from_results(topic_id, results))
+        writer.stop()
+        num_results += len(results)
+    writer.close()
+    return num_results
+
+
+def binary_to_text(binary_run_path, run_file_path):
+    '''Convert a binary run to a text run file, and return the number
+    of results converted.
+    '''
+    num_results = 0
+    with open(run_file_path, 'wb') as fh:
+        for topic_id, results in BinaryRun(binary_run_path).iter_topics():
+            for result in results:
+                fh.write(format_run_line(
+                    topic_id, result.iteration, result.stream_id,
+                    result.confidence, result.on_topic, result.subtopics))
+                num_results += 1
+    return num_results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='convert a TREC DD run between the text run file '
+        'the harness writes and a binary run directory')
+    parser.add_argument('input_path',
+                        help='text run file or binary run directory')
+    parser.add_argument('output_path',
+                        help='binary run directory or text run file to '
+                        'create')
+    args = parser.parse_args()
+
+    if os.path.exists(args.output_path):
+        sys.exit('%r already exists' % args.output_path)
+    try:
+        if is_binary_run(args.input_path):
+            num_results = binary_to_text(args.input_path, args.output_path)
+        else:
+            num_results = text_to_binary(args.input_path, args.output_path)
+    except ValueError, exc:
+        sys.exit(str(exc))
+    print('converted %d results' % num_results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+'''trec_dd.utils.snapshot compiles the truth data into one compact,
+memory-mapped file.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+
+Loading labels from a kvlayer backend means a full scan of the label
+table in every process that needs them.  A truth snapshot holds the
+same information laid out for lookups straight out of a memory map,
+so opening one costs a few reads no matter how many labels it holds.
+
+All integers are little-endian unsigned 32-bit.  After a header, the
+file holds these sections:
+
+``strings``
+  every distinct string once, as ``count + 1`` offsets followed by
+  the UTF-8 bytes they point into
+``topics``
+  sorted by topic id: ``(topic_id, topic_name, first_subtopic,
+  num_subtopics, first_record, num_records)``
+``subtopics``
+  the string ids of each topic's subtopics
+``records``
+  one per (topic, document) pair, sorted by document id within each
+  topic: ``(doc_id, first_entry, num_entries, negative)``
+``entries``
+  one per label: ``(subtopic_id, subtopic_name, passage_text,
+  rating)``, with :data:`NEGATIVE_RATING` as the rating of negative
+  labels
+
+Build one with ``trec_dd_harness compile``.
+'''
+
+from __future__ import absolute_import
+from array import array
+import mmap
+import os
+import struct
+import sys
+
+from dossier.label import CorefValue
+
+from trec_dd.utils import labels_by_topic_and_doc
+
+MAGIC = 'TRECDDT2'
+HEADER = struct.Struct('<8s10I')
+TOPIC = struct.Struct('<6I')
+RECORD = struct.Struct('<4I')
+ENTRY = struct.Struct('<4I')
+
+#: the rating stored for a negative label
+NEGATIVE_RATING = 0xffffffff
+
+
+def _uint32_array(values):
+    a = array('I', values)
+    assert a.itemsize == 4
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+
+def compile_snapshot(label_store, snapshot_path):
+    '''Write every label in `label_store` to a snapshot at
+    `snapshot_path`, and return the number of labels written.
+    '''
+    strings = {}
+
+    def intern_string(s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        if s not in strings:
+            strings[s] = len(strings)
+        return strings[s]
+
+    topic_names = {}
+    topic_subtopics = {}
+
+    def labels():
+        for label in label_store.everything():
+            topic_id = label.meta['topic_id']
+            topic_names[topic_id] = label.meta['topic_name']
+            if topic_id in (label.content_id1, label.content_id2):
+                topic_subtopics.setdefault(topic_id, set()).add(
+                    label.subtopic_for(topic_id))
+            yield label
+    by_pair = labels_by_topic_and_doc(labels())
+
+    docs_by_topic = {}
+    for topic_id, doc_id in by_pair:
+        docs_by_topic.setdefault(topic_id, []).append(doc_id)
+
+    topics = []
+    subtopics = []
+    records = []
+    entries = []
+    num_labels = 0
+    for topic_id in sorted(topic_names):
+        topic_subs = sorted(topic_subtopics.get(topic_id, ()))
+        doc_ids = sorted(docs_by_topic.get(topic_id, ()))
+        topics.extend([intern_string(topic_id),
+                       intern_string(topic_names[topic_id]),
+                       len(subtopics), len(topic_subs),
+                       len(records) // 4, len(doc_ids)])
+        subtopics.extend(intern_string(s) for s in topic_subs)
+        for doc_id in doc_ids:
+            labels = by_pair[(topic_id, doc_id)]
+            negative = any(l.value == CorefValue.Negative for l in labels)
+            records.extend([intern_string(doc_id), len(entries) // 4,
+                            len(labels), int(negative)])
+            for label in labels:
+                if label.value == CorefValue.Negative:
+                    rating = NEGATIVE_RATING
+                else:
+                    rating = label.rating
+                entries.extend([
+                    intern_string(label.subtopic_for(topic_id)),
+                    intern_string(label.meta['subtopic_name']),
+                    intern_string(label.meta['passage_text']),
+                    rating])
+            num_labels += len(labels)
+
+    ordered = sorted(strings, key=strings.get)
+    offsets = [0]
+    for s in ordered:
+        offsets.append(offsets[-1] + len(s))
+    blob = ''.join(ordered)
+
+    sections = [_uint32_array(offsets), blob, _uint32_array(topics),
+                _uint32_array(subtopics), _uint32_array(records),
+                _uint32_array(entries)]
+    positions = []
+    pos = HEADER.size
+    for section in sections:
+        positions.append(pos)
+        if isinstance(section, array):
+            pos += len(section) * section.itemsize
+        else:
+            pos += len(section)
+        # keep the integer sections aligned
+        pos += -pos % 4
+
+    header = HEADER.pack(MAGIC, len(ordered), positions[0], positions[1],
+                         len(topics) // 6, positions[2],
+                         positions[3], len(records) // 4, positions[4],
+                         len(entries) // 4, positions[5])
+    tmp_path = snapshot_path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        fh.write(header)
+        for pos, section in zip(positions, sections):
+            fh.write('\0' * (pos - fh.tell()))
+            if isinstance(section, array):
+                section.tofile(fh)
+            else:
+                fh.write(section)
+    os.rename(tmp_path, snapshot_path)
+    return num_labels
+
+
+class TruthSnapshot(object):
+    '''Read-only view of a snapshot written by :func:`compile_snapshot`.
+
+    Nothing is decoded up front; every lookup reads straight out of
+    the memory map.  Snapshots can stand in for a
+    :class:`dossier.label.LabelStore` wherever trec_dd only needs
+    topics, subtopics and per-document feedback.
+
+    .. automethod:: topics
+    .. automethod:: all_subtopics
+    .. automethod:: doc_ids
+    .. automethod:: feedback
+    .. automethod:: topic_qrels
+    '''
+
+    def __init__(self, snapshot_path):
+        self.snapshot_path = snapshot_path
+        with open(snapshot_path, 'rb') as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.num_strings, self._offsets_pos, self._blob_pos,
+         self.num_topics, self._topics_pos, self._subtopics_pos,
+         self.num_records, self._records_pos, self.num_entries,
+         self._entries_pos) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('%r is not a truth snapshot; snapshots from '
+                             'older versions must be recompiled'
+                             % snapshot_path)
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return self.num_entries
+
+    def _string(self, idx):
+        start, end = struct.unpack_from('<2I', self.mm,
+                                        self._offsets_pos + 4 * idx)
+        return self.mm[self._blob_pos + start:self._blob_pos + end]
+
+    def _topic(self, idx):
+        return TOPIC.unpack_from(self.mm, self._topics_pos + TOPIC.size * idx)
+
+    def _record(self, idx):
+        return RECORD.unpack_from(self.mm,
+                                  self._records_pos + RECORD.size * idx)
+
+    def _find_topic(self, topic_id):
+        lo, hi = 0, self.num_topics
+        while lo < hi:
+            mid = (lo + hi) // 2
+            topic = self._topic(mid)
+            mid_id = self._string(topic[0])
+            if mid_id == topic_id:
+                return topic
+            elif mid_id < topic_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _find_record(self, topic_id, doc_id):
+        topic = self._find_topic(topic_id)
+        if topic is None:
+            return None
+        lo, hi = topic[4], topic[4] + topic[5]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self._record(mid)
+            mid_id = self._string(record[0])
+            if mid_id == doc_id:
+                return record
+            elif mid_id < doc_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def topics(self):
+        '''Return a dict mapping every topic_id to its topic name.
+        '''
+        topics = {}
+        for idx in xrange(self.num_topics):
+            topic = self._topic(idx)
+            topics[self._string(topic[0])] = self._string(topic[1])
+        return topics
+
+    def all_subtopics(self, topic_id):
+        '''Return the distinct subtopic ids labeled for `topic_id`.
+        '''
+        topic = self._find_topic(topic_id)
+        if topic is None:
+            return []
+        return [self._string(struct.unpack_from(
+                    '<I', self.mm, self._subtopics_pos + 4 * idx)[0])
+                for idx in xrange(topic[2], topic[2] + topic[3])]
+
+    def doc_ids(self, topic_id):
+        '''Yield every document id with a label for `topic_id`.
+        '''
+        topic = self._find_topic(topic_id)
+        if topic is None:
+            return
+        for idx in xrange(topic[4], topic[4] + topic[5]):
+            yield self._string(self._record(idx)[0])
+
+    def feedback(self, topic_id, doc_id):
+        '''Return the harness's subtopic feedback for `doc_id` on
+        `topic_id`: one dict per label, or an empty list if there are
+        no labels or any of them is negative.
+        '''
+        record = self._find_record(topic_id, doc_id)
+        if record is None or record[3]:
+            return []
+        subtopic_feedback = []
+        for idx in xrange(record[1], record[1] + record[2]):
+            subtopic_id, subtopic_name, passage_text, rating = \
+                ENTRY.unpack_from(self.mm,
+                                  self._entries_pos + ENTRY.size * idx)
+            subtopic_feedback.append({
+                'subtopic_id': self._string(subtopic_id),
+                'subtopic_name': self._string(subtopic_name),
+                'passage_text': self._string(passage_text),
+                'rating': rating,
+            })
+        return subtopic_feedback
+
+    def topic_qrels(self, topic_id):
+        '''Return the judgments of `topic_id` as a dict mapping each
+        doc_id to a dict of subtopic_id to the list of ratings its
+        passages got, leaving out negative labels, like
+        :func:`trec_dd.utils.get_topic_qrels`.
+        '''
+        topic = self._find_topic(topic_id)
+        qrels = {}
+        if topic is None:
+            return qrels
+        for record_idx in xrange(topic[4], topic[4] + topic[5]):
+            doc_id, first_entry, num_entries, _ = self._record(record_idx)
+            doc_qrels = {}
+            for idx in xrange(first_entry, first_entry + num_entries):
+                subtopic_id, _, _, rating = ENTRY.unpack_from(
+                    self.mm, self._entries_pos + ENTRY.size * idx)
+                if rating == NEGATIVE_RATING:
+                    continue
+                doc_qrels.setdefault(self._string(subtopic_id), []).append(
+                    rating)
+            if doc_qrels:
+                qrels[self._string(doc_id)] = doc_qrels
+        return qrels
@@ -0,0 +1,27 @@
+from __future__ import absolute_import
+
+import sys
+import time
+
+from .. import timing
+
+
+def test_clock_is_monotonic():
+    if sys.platform.startswith('linux'):
+        assert timing.clock is not time.time
+    times = [timing.clock() for _ in xrange(1000)]
+    assert times == sorted(times)
+
+
+def test_timings_clock_set_back(monkeypatch):
+    times = iter([100.0, 99.5, 100.0, 100.25])
+    monkeypatch.setattr(timing, 'clock', lambda: next(times))
+    timings = timing.Timings()
+    for _ in xrange(2):
+        with timings.timer('step'):
+            pass
+    step = timings.to_dict()['step']
+    # the clock went back half a second during the first step
+    assert step['min'] == 0.0
+    assert step['max'] == step['total'] == 0.25
+    assert step['buckets'] == {'1': 1, '262144': 1}
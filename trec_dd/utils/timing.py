@@ -0,0 +1,172 @@
+'''trec_dd.utils.timing keeps latency histograms of the phases of a run.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+
+Recording a latency costs a clock read and a few integer updates, so
+the harness and the ambassadors keep their :class:`Timings` on all the
+time.  :meth:`Timings.to_dict` gives, for each phase, the number of
+calls, the total, mean, min and max seconds, approximate percentiles,
+and the histogram itself, as counts of latencies under each power of
+two microseconds.
+'''
+
+from __future__ import absolute_import, division
+import json
+import sys
+import threading
+import time
+
+
+def _monotonic_clock():
+    '''Return a function reading the POSIX monotonic clock through
+    :mod:`ctypes`, since Python 2's :mod:`time` has none, or None if
+    it cannot be read here.
+    '''
+    try:
+        import ctypes
+    except ImportError:
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    # CLOCK_MONOTONIC
+    clock_id = 6 if sys.platform == 'darwin' else 1
+    # glibc before 2.17 keeps clock_gettime in librt
+    for lib_name in (None, 'librt.so.1'):
+        try:
+            clock_gettime = ctypes.CDLL(lib_name).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_gettime.restype = ctypes.c_int
+
+        def monotonic():
+            # a new struct each call, as several threads share the clock
+            ts = timespec()
+            if clock_gettime(clock_id, ctypes.byref(ts)) != 0:
+                raise OSError('clock_gettime(CLOCK_MONOTONIC) failed')
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        try:
+            monotonic()
+        except OSError:
+            return None
+        return monotonic
+    return None
+
+
+#: a clock that never goes backwards: :func:`time.monotonic` on Python
+#: 3 and ``clock_gettime(CLOCK_MONOTONIC)`` on Python 2.  Where neither
+#: is available it is the wall clock, so a latency can come out
+#: negative when the clock is set back, and is then counted as zero.
+clock = getattr(time, 'monotonic', None) or _monotonic_clock() or time.time
+
+class LatencyHistogram(object):
+    '''Counts of latencies in buckets that double in width: bucket `i`
+    holds the latencies of at least ``2 ** (i - 1)`` and under ``2 **
+    i`` microseconds, and bucket 0 those under one microsecond.
+    '''
+
+    num_buckets = 40
+
+    def __init__(self):
+        self.counts = [0] * self.num_buckets
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, seconds):
+        seconds = max(seconds, 0.0)
+        idx = min(int(seconds * 1e6).bit_length(), self.num_buckets - 1)
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        '''Return an upper bound on the `fraction` quantile, in seconds:
+        the top of the bucket it falls in, or the largest latency.
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        return min(2 ** idx / 1e6, self.max)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.min or 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            # upper bound in microseconds -> count
+            'buckets': dict((str(2 ** idx), count)
+                            for idx, count in enumerate(self.counts)
+                            if count),
+        }
+
+
+class Timer(object):
+    '''Adds the time spent in a ``with`` block to a :class:`Timings`.'''
+
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = clock()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timings.add(self.name, clock() - self.start)
+
+
+class Timings(object):
+    '''A :class:`LatencyHistogram` for each named phase, safe to add
+    to from several threads.
+    '''
+
+    def __init__(self):
+        self.histograms = dict()
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.add(seconds)
+
+    def timer(self, name):
+        '''Return a context manager that times its block as `name`.'''
+        return Timer(self, name)
+
+    def total(self, name):
+        '''Return the seconds spent in `name` so far.'''
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            return 0.0
+        return histogram.total
+
+    def to_dict(self):
+        with self.lock:
+            return dict((name, histogram.to_dict())
+                        for name, histogram in self.histograms.iteritems())
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)